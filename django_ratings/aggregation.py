@@ -4,8 +4,17 @@ This file is for aggregation records from Rating,Agg tables to Agg and TotalRate
 
 import logging
 
+from time import mktime
 from datetime import datetime, timedelta
-from django_ratings.models import Rating, Agg, TotalRate
+
+from django.conf import settings
+from django.db import models, transaction, connection
+
+from django_ratings import percentiles, caching, karma, partitions
+from django_ratings.models import Rating, Agg, TotalRate, TotalRateShard, Watermark, Leaderboard, \
+        AnonymousVote, UserKarma, group_targets, \
+        RATINGS_CACHE, RATINGS_LEADERBOARDS, RATINGS_KARMA_INCREMENTAL, MINIMAL_ANONYMOUS_IP_DELAY
+from django_ratings.signals import total_rate_changed
 
 logger = logging.getLogger('django_ratings')
 
@@ -18,42 +27,365 @@ DELTA_TIME_DAY = -24*60*60
 
 TIMES_ALL = {DELTA_TIME_YEAR : 'year', DELTA_TIME_MONTH : 'month', DELTA_TIME_DAY : 'day'}
 
-def transfer_agg_to_totalrate():
+# name of the watermark used by incremental aggregation
+WATERMARK_AGG = 'agg'
+# names of watermarks used by chunked aggregation to resume a killed run
+WATERMARK_STAGE = 'stage'
+WATERMARK_RUN = 'run'
+
+# stages of chunked aggregation, stored in WATERMARK_STAGE once done
+STAGE_SHARDS = 1
+STAGE_RATINGS = 2
+STAGE_AGGS = 3
+STAGE_TOTALRATE = 4
+STAGE_VOTES = 5
+STAGE_LEADERBOARDS = 6
+STAGE_KARMA = 7
+
+def get_max_id(model):
+    return model.objects.aggregate(max_id=models.Max('pk'))['max_id'] or 0
+
+def get_new_targets(model, watermark):
+    """
+    Return (targets, max_id) where targets is a set of (target_ct_id, target_id)
+    pairs of model's records created since the watermark.
+    """
+    last_id = Watermark.objects.get_value(watermark)
+    max_id = get_max_id(model)
+    targets = set(model.objects.filter(pk__gt=last_id, pk__lte=max_id).values_list('target_ct', 'target_id').distinct())
+    return targets, max_id
+
+def get_rated_targets(timenow):
+    """
+    Return set of (target_ct_id, target_id) pairs of ratings a run started
+    at timenow moves to Agg.
+
+    Every run moves all these ratings away, so ids of new ratings may be
+    reused (SQLite, InnoDB after a restart) and can't serve as a watermark.
+    """
+    time_limit = timenow - timedelta(seconds=min(TIMES_ALL.keys()))
+    return set(Rating.objects.filter(time__lte=time_limit).values_list('target_ct', 'target_id').distinct())
+
+def get_totalrates(targets):
+    """
+    Return dict mapping given (target_ct_id, target_id) pairs to their
+    TotalRate amounts, pairs without TotalRate are left out.
+    """
+    amounts = {}
+    for target_ct_id, ids in group_targets(targets):
+        for target_id, amount in TotalRate.objects.filter(target_ct=target_ct_id, target_id__in=ids).values_list('target_id', 'amount'):
+            amounts[(target_ct_id, target_id)] = amount
+    return amounts
+
+def transfer_agg_to_totalrate(targets=None):
     """
     Transfer aggregation data from table Agg to table TotalRate
+
+    targets: if given, only TotalRate records of these
+        (target_ct_id, target_id) pairs are recomputed
     """
     logger.info("transfer_agg_to_totalrate BEGIN")
-    if TotalRate.objects.count() != 0:
-        TotalRate.objects.all().delete()
-    Agg.objects.agg_to_totalrate()
+    if targets is None:
+        if TotalRate.objects.count() != 0:
+            TotalRate.objects.all().delete()
+        Agg.objects.agg_to_totalrate()
+        if RATINGS_CACHE:
+            caching.totals.invalidate_all()
+    elif targets:
+        old_amounts = get_totalrates(targets)
+        Agg.objects.agg_to_totalrate(targets)
+        new_amounts = get_totalrates(targets)
+        for target in targets:
+            amount = new_amounts.get(target, 0) - old_amounts.get(target, 0)
+            if amount:
+                total_rate_changed.send(sender=TotalRate, target_ct_id=target[0], target_id=target[1], amount=amount)
+        if RATINGS_CACHE:
+            for target_ct_id, target_id in targets:
+                caching.totals.invalidate(target_ct_id, target_id)
+    percentiles.index.invalidate()
     logger.info("transfer_agg_to_totalrate END")
 
 
-def transfer_agg_to_agg():
+def transfer_shards_to_totalrate():
+    """
+    Fold amounts collected in TotalRateShard to TotalRate
+    """
+    logger.info("transfer_shards_to_totalrate BEGIN")
+    folded = TotalRateShard.objects.fold()
+    logger.info("transfer_shards_to_totalrate END, %d objects folded" % folded)
+
+
+def transfer_totalrate_to_karma():
+    """
+    Recompute karma of all users from TotalRate
+    """
+    logger.info("transfer_totalrate_to_karma BEGIN")
+    # changes not applied yet by this transaction are included in the recomputed karma
+    karma.deltas.discard()
+    UserKarma.objects.total_rate_to_karma()
+    logger.info("transfer_totalrate_to_karma END")
+
+
+def transfer_totalrate_to_leaderboards():
+    """
+    Recompute top rated objects of all leaderboards
+    """
+    logger.info("transfer_totalrate_to_leaderboards BEGIN")
+    Leaderboard.objects.refresh()
+    logger.info("transfer_totalrate_to_leaderboards END")
+
+
+def transfer_agg_to_agg(timenow=None, target_ct_id=None):
     """
     aggregation data from table Agg to table Agg
     """
     logger.info("transfer_agg_to_agg BEGIN")
-    timenow = datetime.now()
+    timenow = timenow or datetime.now()
     for t in TIMES_ALL:
         TIME_DELTA = t
         time_agg = timenow - timedelta(seconds=TIME_DELTA)
-        Agg.objects.move_agg_to_agg(time_agg, TIMES_ALL[t])
-    Agg.objects.agg_assume()
+        Agg.objects.move_agg_to_agg(time_agg, TIMES_ALL[t], target_ct_id)
+    Agg.objects.agg_assume(target_ct_id)
     logger.info("transfer_agg_to_agg END")
 
 
-def transfer_data():
+def get_rating_content_types(time_limit):
+    "Return ids of content types rated not later than time_limit."
+    return list(Rating.objects.filter(time__lte=time_limit).order_by().values_list('target_ct', flat=True).distinct())
+
+
+def get_rating_chunks(time_limit, chunk_days, target_ct_id=None):
+    """
+    Split ratings not newer than time_limit into chunks, yield
+    (target_ct_id, time_from, time_to) tuples, each chunk holding ratings of
+    one content type rated in (time_from, time_to], time_from of the first
+    chunk of every content type is None.
+
+    target_ct_id: if given, only ratings of this content type are split
+    """
+    delta = timedelta(days=chunk_days)
+    if target_ct_id is None:
+        ct_ids = get_rating_content_types(time_limit)
+    else:
+        ct_ids = [target_ct_id]
+    for target_ct_id in ct_ids:
+        oldest = Rating.objects.filter(target_ct=target_ct_id, time__lte=time_limit).aggregate(oldest=models.Min('time'))['oldest']
+        if oldest is None:
+            continue
+        time_from, time_to = None, min(oldest + delta, time_limit)
+        while True:
+            yield target_ct_id, time_from, time_to
+            if time_to >= time_limit:
+                break
+            time_from, time_to = time_to, min(time_to + delta, time_limit)
+
+
+def get_agg_content_types():
+    "Return ids of content types present in Agg or TotalRate."
+    ct_ids = set(Agg.objects.order_by().values_list('target_ct', flat=True).distinct())
+    ct_ids.update(TotalRate.objects.order_by().values_list('target_ct', flat=True).distinct())
+    return sorted(ct_ids)
+
+
+def transfer_rate_to_agg_chunked(timenow, chunk_days, run, target_ct_id=None):
+    """
+    Move ratings to Agg in chunks of one content type and chunk_days days,
+    every chunk is passed to run.
+
+    target_ct_id: if given, only ratings of this content type are moved
+    """
+    logger.info("transfer_rate_to_agg BEGIN")
+    for t in sorted(TIMES_ALL.keys(), reverse=True):
+        time_agg = timenow - timedelta(seconds=t)
+        if partitions.is_enabled() and target_ct_id is None:
+            run(partitions.move_partitions_to_agg, time_agg, TIMES_ALL[t])
+        for chunk_ct_id, time_from, time_to in get_rating_chunks(time_agg, chunk_days, target_ct_id):
+            run(Rating.objects.move_rate_to_agg, time_to, TIMES_ALL[t], chunk_ct_id, time_from)
+    logger.info("transfer_rate_to_agg END")
+
+
+def transfer_agg_to_totalrate_chunked(targets, run):
+    """
+    Recompute TotalRate one content type (or one chunk of given targets) at
+    a time, every chunk is passed to run.
+    """
+    logger.info("transfer_agg_to_totalrate BEGIN")
+    if targets is None:
+        for target_ct_id in get_agg_content_types():
+            run(Agg.objects.agg_to_totalrate, None, target_ct_id)
+        if RATINGS_CACHE:
+            caching.totals.invalidate_all()
+        percentiles.index.invalidate()
+    else:
+        for target_ct_id, ids in group_targets(targets):
+            run(transfer_agg_to_totalrate, [(target_ct_id, target_id) for target_id in ids])
+    logger.info("transfer_agg_to_totalrate END")
+
+
+def run_in_transaction(func, *args):
+    "Run func in its own transaction, committed once it returns."
+    return transaction.commit_on_success(func)(*args)
+
+
+def transfer_content_type(args):
+    """
+    Run one stage of chunked aggregation for a single content type, called
+    in worker processes by transfer_content_types. args is a tuple
+    (stage, target_ct_id, timestamp of the run, chunk_days).
+    """
+    stage, target_ct_id, timestamp, chunk_days = args
+    # never share the connection inherited from the parent process
+    connection.close()
+    timenow = datetime.fromtimestamp(timestamp)
+    try:
+        if stage == STAGE_RATINGS:
+            transfer_rate_to_agg_chunked(timenow, chunk_days, run_in_transaction, target_ct_id)
+        elif stage == STAGE_AGGS:
+            run_in_transaction(transfer_agg_to_agg, timenow, target_ct_id)
+        elif stage == STAGE_TOTALRATE:
+            run_in_transaction(Agg.objects.agg_to_totalrate, None, target_ct_id)
+    finally:
+        connection.close()
+    return target_ct_id
+
+
+def transfer_content_types(stage, ct_ids, timenow, chunk_days, workers):
+    """
+    Run one stage of chunked aggregation for every given content type, in a
+    pool of workers processes with their own database connections.
+    """
+    from multiprocessing import Pool
+
+    timestamp = int(mktime(timenow.timetuple()))
+    # forked workers must not inherit an open connection
+    connection.close()
+    pool = Pool(workers)
+    try:
+        pool.map(transfer_content_type, [(stage, target_ct_id, timestamp, chunk_days) for target_ct_id in ct_ids], 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_workers(workers):
+    """
+    Return number of worker processes to use, SQLite doesn't handle
+    concurrent writers so it always gets one.
+    """
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        return 1
+    return max(1, workers)
+
+
+def transfer_data(incremental=False, recompute_karma=False, chunk_days=None, workers=1):
     """
     transfer data from table Rating to table Agg
+
+    incremental: only recompute TotalRate for objects that were rated since
+        the last run instead of rebuilding the whole table
+
+    recompute_karma: recompute karma of all users afterwards, done anyway
+        after a full run when RATINGS_KARMA_INCREMENTAL is set because
+        a full rebuild of TotalRate doesn't report individual changes
+
+    chunk_days: if given, work is split into chunks - by content type and
+        chunk_days long time ranges of ratings - each committed in its own
+        transaction instead of letting the caller manage one transaction for
+        the whole run. Finished stages are recorded in WATERMARK_STAGE, a run
+        that was killed is resumed from the first unfinished stage.
+
+    workers: number of processes moving ratings and aggregations of
+        different content types in parallel, only used with chunk_days
     """
     logger.info("transfer_data BEGIN")
-    timenow = datetime.now()
-    for t in sorted(TIMES_ALL.keys(), reverse=True):
-        TIME_DELTA = t
-        time_agg = timenow - timedelta(seconds=TIME_DELTA)
-        Rating.objects.move_rate_to_agg(time_agg, TIMES_ALL[t])
-    transfer_agg_to_agg()
-    transfer_agg_to_totalrate()
-    logger.info("transfer_data END")
+    if chunk_days is not None:
+        run = run_in_transaction
+        stage = Watermark.objects.get_value(WATERMARK_STAGE)
+        workers = get_workers(workers)
+    else:
+        run = lambda func, *args: func(*args)
+        stage = 0
+
+    def checkpoint(stage):
+        if chunk_days is not None:
+            run(Watermark.objects.set_value, WATERMARK_STAGE, stage)
 
+    if stage:
+        # keep the time limits of the killed run
+        timenow = datetime.fromtimestamp(Watermark.objects.get_value(WATERMARK_RUN))
+        logger.info("transfer_data resuming run from %s after stage %d" % (timenow, stage))
+    else:
+        timenow = datetime.now().replace(microsecond=0)
+        if chunk_days is not None:
+            run(Watermark.objects.set_value, WATERMARK_RUN, int(mktime(timenow.timetuple())))
+
+    targets = None
+    if incremental:
+        targets = get_rated_targets(timenow)
+        # a resumed run may have moved some of the ratings to Agg already
+        targets.update(get_new_targets(Agg, WATERMARK_AGG)[0])
+        logger.info("transfer_data found %d objects with new ratings" % len(targets))
+
+    if stage < STAGE_SHARDS:
+        run(transfer_shards_to_totalrate)
+        checkpoint(STAGE_SHARDS)
+
+    if stage < STAGE_RATINGS:
+        if chunk_days is not None and workers > 1:
+            if partitions.is_enabled():
+                for t in sorted(TIMES_ALL.keys(), reverse=True):
+                    run(partitions.move_partitions_to_agg, timenow - timedelta(seconds=t), TIMES_ALL[t])
+            ct_ids = get_rating_content_types(timenow - timedelta(seconds=min(TIMES_ALL.keys())))
+            transfer_content_types(STAGE_RATINGS, ct_ids, timenow, chunk_days, workers)
+        elif chunk_days is not None:
+            transfer_rate_to_agg_chunked(timenow, chunk_days, run)
+        else:
+            for t in sorted(TIMES_ALL.keys(), reverse=True):
+                TIME_DELTA = t
+                time_agg = timenow - timedelta(seconds=TIME_DELTA)
+                Rating.objects.move_rate_to_agg(time_agg, TIMES_ALL[t])
+        checkpoint(STAGE_RATINGS)
+
+    if stage < STAGE_AGGS:
+        if chunk_days is not None and workers > 1:
+            transfer_content_types(STAGE_AGGS, get_agg_content_types(), timenow, chunk_days, workers)
+        elif chunk_days is not None:
+            for target_ct_id in get_agg_content_types():
+                run(transfer_agg_to_agg, timenow, target_ct_id)
+        else:
+            transfer_agg_to_agg(timenow)
+        checkpoint(STAGE_AGGS)
+
+    if stage < STAGE_TOTALRATE:
+        if chunk_days is not None and workers > 1 and targets is None:
+            transfer_content_types(STAGE_TOTALRATE, get_agg_content_types(), timenow, chunk_days, workers)
+            if RATINGS_CACHE:
+                caching.totals.invalidate_all()
+            percentiles.index.invalidate()
+        elif chunk_days is not None:
+            transfer_agg_to_totalrate_chunked(targets, run)
+        else:
+            transfer_agg_to_totalrate(targets)
+        checkpoint(STAGE_TOTALRATE)
+
+    if stage < STAGE_VOTES:
+        run(AnonymousVote.objects.purge, timenow - timedelta(seconds=MINIMAL_ANONYMOUS_IP_DELAY))
+        checkpoint(STAGE_VOTES)
+
+    if stage < STAGE_LEADERBOARDS:
+        if RATINGS_LEADERBOARDS:
+            run(transfer_totalrate_to_leaderboards)
+        checkpoint(STAGE_LEADERBOARDS)
+
+    if stage < STAGE_KARMA:
+        if recompute_karma or (RATINGS_KARMA_INCREMENTAL and not incremental):
+            run(transfer_totalrate_to_karma)
+        checkpoint(STAGE_KARMA)
+
+    def finish():
+        # records created by this run are already accounted for
+        Watermark.objects.set_value(WATERMARK_AGG, get_max_id(Agg))
+        if chunk_days is not None:
+            Watermark.objects.set_value(WATERMARK_STAGE, 0)
+    run(finish)
+    logger.info("transfer_data END")
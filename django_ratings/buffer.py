@@ -0,0 +1,170 @@
+"""
+Buffered ingestion of ratings.
+
+When RATINGS_BUFFERED is switched on, views don't call Rating.save() on the
+request thread, they append the rating to the process-wide ``votes`` buffer
+instead. The buffer is flushed in batches - once it holds RATINGS_BUFFER_SIZE
+ratings, once the oldest rating waits for RATINGS_BUFFER_TIMEOUT seconds and
+when the interpreter shuts down. Every flush saves the ratings using
+Rating.objects.bulk_rate.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+
+from django.db import transaction
+
+from django_ratings.models import Rating, RATING_ACCEPTED, RATINGS_BUFFER_SIZE, RATINGS_BUFFER_TIMEOUT
+
+logger = logging.getLogger('django_ratings')
+
+
+class VoteBuffer(object):
+    """
+    Thread safe buffer of unsaved ratings.
+
+    Besides the ratings themselves, the buffer keeps counters describing its
+    state, see stats().
+    """
+    def __init__(self, size=RATINGS_BUFFER_SIZE, timeout=RATINGS_BUFFER_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+
+        self._pending = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._wakeup = threading.Event()
+
+        self.flushes = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, rating, wait=True):
+        """
+        Buffer a single unsaved rating, flush if the buffer is full.
+
+        wait: if False, a full buffer is flushed by the background thread
+            and the caller returns immediately, unless the buffer has no
+            timeout and therefore no thread
+        """
+        if rating.time is None:
+            rating.time = datetime.now()
+
+        self._lock.acquire()
+        try:
+            self._pending.append(rating)
+            if self._oldest is None:
+                self._oldest = time.time()
+            full = len(self._pending) >= self.size
+        finally:
+            self._lock.release()
+
+        self._start_flusher()
+        if full:
+            if wait or self._flusher is None:
+                self.flush()
+            else:
+                self._wakeup.set()
+
+    def flush(self):
+        """
+        Write all buffered ratings into the database, return the number of
+        ratings that were actually saved.
+        """
+        self._flush_lock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                batch, self._pending, self._oldest = self._pending, [], None
+            finally:
+                self._lock.release()
+
+            if not batch:
+                return 0
+
+            start = time.time()
+            try:
+                saved = self._write(batch)
+            except Exception:
+                self.failed += len(batch)
+                logger.exception('Failed to flush %d buffered ratings.' % len(batch))
+                saved = 0
+            else:
+                self.flushed += saved
+                self.dropped += len(batch) - saved
+
+            self.last_flush_latency = time.time() - start
+            self.total_flush_latency += self.last_flush_latency
+            self.flushes += 1
+            return saved
+        finally:
+            self._flush_lock.release()
+
+    def stats(self):
+        "Return counters describing the buffer."
+        return {
+            'queue_depth': len(self._pending),
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'last_flush_latency': self.last_flush_latency,
+            'total_flush_latency': self.total_flush_latency,
+        }
+
+    def _write(self, batch):
+        """
+        Save the batch in its own transaction. A flush started within a
+        managed transaction, e.g. a request's one, only uses a savepoint and
+        leaves committing to the transaction's owner.
+        """
+        if not transaction.is_managed():
+            return transaction.commit_on_success(self._save)(batch)
+
+        sid = transaction.savepoint()
+        try:
+            saved = self._save(batch)
+        except Exception:
+            transaction.savepoint_rollback(sid)
+            raise
+        transaction.savepoint_commit(sid)
+        return saved
+
+    def _save(self, batch):
+        return Rating.objects.bulk_rate(batch).count(RATING_ACCEPTED)
+
+    def _start_flusher(self):
+        if self._flusher is not None or not self.timeout:
+            return
+        self._lock.acquire()
+        try:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, name='django_ratings.buffer')
+                self._flusher.setDaemon(True)
+                self._flusher.start()
+        finally:
+            self._lock.release()
+
+    def _flush_periodically(self):
+        while True:
+            self._wakeup.wait(self.timeout)
+            self._wakeup.clear()
+            oldest = self._oldest
+            if len(self._pending) >= self.size or (oldest is not None and time.time() - oldest >= self.timeout):
+                self.flush()
+
+
+# global buffer used by views when RATINGS_BUFFERED is set
+votes = VoteBuffer()
+atexit.register(votes.flush)
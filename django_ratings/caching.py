@@ -0,0 +1,193 @@
+"""
+Cache of total rates read by TotalRateManager.
+
+The cache is switched on by RATINGS_CACHE. It uses the backend given by
+RATINGS_CACHE_BACKEND (an URI understood by django.core.cache.get_cache),
+the project's default cache or, if that is the dummy one, a local memory cache.
+Records are invalidated when a rating changes them and all of them are
+dropped at once when the aggregation job rebuilds the TotalRate table, in
+both cases once the change commits.
+
+The same backend holds the index of recently rated objects, switched on by
+RATINGS_VOTED_INDEX.
+"""
+
+import random
+
+from django.conf import settings
+from django.core.cache import cache, get_cache
+from django.core.cache.backends.dummy import CacheClass as DummyCache
+from django.core.cache.backends.locmem import CacheClass as LocMemCache
+
+from django_ratings import transactions
+
+RATINGS_CACHE_BACKEND = getattr(settings, 'RATINGS_CACHE_BACKEND', None)
+RATINGS_CACHE_TIMEOUT = getattr(settings, 'RATINGS_CACHE_TIMEOUT', 300)
+# timeout for objects that haven't been rated yet
+RATINGS_CACHE_UNRATED_TIMEOUT = getattr(settings, 'RATINGS_CACHE_UNRATED_TIMEOUT', 60)
+RATINGS_CACHE_PREFIX = getattr(settings, 'RATINGS_CACHE_PREFIX', 'django_ratings')
+# how long are users remembered in the index of recently rated objects
+RATINGS_VOTED_TIMEOUT = getattr(settings, 'RATINGS_VOTED_TIMEOUT', 24*60*60)
+
+# generations and versions should outlive any cached value, 30 days is memcached's maximum
+GENERATION_TIMEOUT = 30*24*60*60
+
+def get_backend():
+    "Return the cache used by django_ratings."
+    if RATINGS_CACHE_BACKEND:
+        return get_cache(RATINGS_CACHE_BACKEND)
+    if isinstance(cache, DummyCache):
+        return get_cache('locmem://')
+    return cache
+
+def is_shared(backend):
+    "Tell whether given cache is seen by all processes."
+    return not isinstance(backend, (DummyCache, LocMemCache))
+
+backend = get_backend()
+
+
+class TotalRateCache(object):
+    """
+    Total rates keyed by content type and object id. Besides the values the
+    instance keeps number of hits and misses.
+
+    Every value is stored with a stamp - the generation of the whole cache
+    and the version of the object read before the database was queried -
+    and only served while both still match. Invalidation replaces the
+    version (or the generation) once the change commits, so a reader that
+    fetched the old total before that can't cache it under the new stamp.
+    """
+    def __init__(self, backend, timeout=RATINGS_CACHE_TIMEOUT, unrated_timeout=RATINGS_CACHE_UNRATED_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+        self.unrated_timeout = unrated_timeout
+        self.generation_key = '%s:totalrate:generation' % RATINGS_CACHE_PREFIX
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, ct_id, object_id):
+        return '%s:totalrate:%s:%s' % (RATINGS_CACHE_PREFIX, ct_id, object_id)
+
+    def _version_key(self, ct_id, object_id):
+        return '%s:totalrate:version:%s:%s' % (RATINGS_CACHE_PREFIX, ct_id, object_id)
+
+    def _init(self, key):
+        """
+        Store a new token under key unless there is one, return it or None
+        if another process stored one meanwhile.
+        """
+        token = random.getrandbits(64)
+        if self.backend.add(key, token, GENERATION_TIMEOUT):
+            return token
+        return None
+
+    def get(self, ct_id, object_id):
+        """
+        Return tuple (amount, stamp), amount is None if it is not cached.
+        The stamp has to be passed to set() along with the amount read from
+        the database.
+        """
+        found, stamps = self.get_many([(ct_id, object_id)])
+        return found.get((ct_id, object_id)), stamps[(ct_id, object_id)]
+
+    def get_many(self, targets):
+        """
+        Return tuple (found, stamps) where found is a dict mapping
+        (ct_id, object_id) pairs from targets to their cached total rates,
+        missing ones are left out, and stamps maps all pairs to stamps for
+        set_many(). Uses a single request to the cache.
+        """
+        targets = list(targets)
+        keys = [self.generation_key]
+        for ct_id, object_id in targets:
+            keys.extend([self._version_key(ct_id, object_id), self._key(ct_id, object_id)])
+        cached = self.backend.get_many(keys)
+
+        generation = cached.get(self.generation_key)
+        found, stamps = {}, {}
+        for target in targets:
+            stamp = generation, cached.get(self._version_key(*target))
+            value = cached.get(self._key(*target))
+            if value is not None and None not in stamp and value[:2] == stamp:
+                found[target] = value[2]
+            stamps[target] = stamp
+        self.hits += len(found)
+        self.misses += len(targets) - len(found)
+        return found, stamps
+
+    def set(self, ct_id, object_id, amount, stamp):
+        self.set_many({(ct_id, object_id): amount}, {(ct_id, object_id): stamp})
+
+    def set_many(self, amounts, stamps):
+        """
+        Cache amounts given as dict mapping (ct_id, object_id) pairs to
+        total rates, with stamps returned by get_many(). Amounts of objects
+        invalidated since are not stored.
+        """
+        generation = None
+        for target, amount in amounts.items():
+            stamp_generation, version = stamps[target]
+            if stamp_generation is None:
+                if generation is None:
+                    generation = self._init(self.generation_key)
+                stamp_generation = generation
+            if version is None:
+                version = self._init(self._version_key(*target))
+            if stamp_generation is None or version is None:
+                continue
+            timeout = amount and self.timeout or self.unrated_timeout
+            self.backend.set(self._key(*target), (stamp_generation, version, amount), timeout)
+
+    def invalidate(self, ct_id, object_id):
+        "Drop cached total rate of given object once the current transaction commits."
+        transactions.on_commit(self._invalidate, ct_id, object_id)
+
+    def _invalidate(self, ct_id, object_id):
+        self.backend.set(self._version_key(ct_id, object_id), random.getrandbits(64), GENERATION_TIMEOUT)
+
+    def invalidate_all(self):
+        "Drop all cached total rates once the current transaction commits."
+        transactions.on_commit(self._invalidate_all)
+
+    def _invalidate_all(self):
+        self.backend.set(self.generation_key, random.getrandbits(64), GENERATION_TIMEOUT)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class VotedIndex(object):
+    """
+    Objects recently rated by a voter - a user or an IP address within one
+    MINIMAL_ANONYMOUS_IP_DELAY long period, see models.get_voter. Only a
+    positive answer is certain, voters missing in the index are checked by
+    the database.
+    """
+    def __init__(self, backend, timeout=RATINGS_VOTED_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+
+    def _key(self, voter, ct_id, object_id):
+        return '%s:voted:%s:%s:%s' % (RATINGS_CACHE_PREFIX, voter, ct_id, object_id)
+
+    def contains(self, voter, ct_id, object_id):
+        return self.backend.get(self._key(voter, ct_id, object_id)) is not None
+
+    def contains_many(self, votes):
+        """
+        Return set of (voter, ct_id, object_id) tuples from votes that are
+        in the index.
+        """
+        keys = dict((self._key(*vote), vote) for vote in votes)
+        return set(keys[k] for k in self.backend.get_many(keys.keys()))
+
+    def add(self, voter, ct_id, object_id, timeout=None):
+        self.backend.set(self._key(voter, ct_id, object_id), 1, timeout or self.timeout)
+
+
+# global cache used by TotalRateManager when RATINGS_CACHE is set
+totals = TotalRateCache(backend)
+
+# global index used by Rating.save() and views when RATINGS_VOTED_INDEX is set
+voted = VotedIndex(backend)
@@ -0,0 +1,112 @@
+"""
+Map between models and their content type ids shared by the whole library.
+
+All content types are loaded into the cache of ContentType.objects with one
+query on the first lookup, every following lookup - by model, instance or
+id - is a dict access. The map counts lookups served from memory and queries
+issued per thread, see stats() and
+django_ratings.middleware.ContentTypeStatsMiddleware.
+"""
+
+import threading
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_syncdb
+
+class ContentTypeMap(object):
+    """
+    Lookups are served from the cache of ContentType.objects, so the
+    instances are the same ones the rest of the project gets. The cache is
+    filled with all content types at once whenever a lookup misses it.
+    """
+    def __init__(self):
+        self._stats = threading.local()
+        self.clear()
+
+    def clear(self):
+        "Forget all loaded content types."
+        # content types of models that no longer exist, not cached by ContentType.objects
+        self._stale = {}
+        self._warm = False
+
+    def _count(self, name):
+        setattr(self._stats, name, getattr(self._stats, name, 0) + 1)
+
+    def _get_cache(self):
+        return ContentType.objects.__class__._cache
+
+    def warm(self):
+        "Load all content types using one query."
+        self._count('queries')
+        cache = self._get_cache()
+        for ct in ContentType.objects.all():
+            if ct.model_class() is None:
+                self._stale[ct.pk] = ct
+            elif ct.pk not in cache:
+                ContentType.objects._add_to_cache(ct)
+        self._warm = True
+
+    def _lookup(self, key):
+        cache = self._get_cache()
+        if key not in cache and key not in self._stale and (not self._warm or not cache):
+            # not loaded yet or ContentType.objects' cache was cleared since
+            self.warm()
+        if key in cache or key in self._stale:
+            self._count('hits')
+        else:
+            self._count('queries')
+
+    def get_for_model(self, model):
+        """
+        Return ContentType of given model class or instance, proxy models
+        share the content type of the model they proxy for.
+        """
+        if not isinstance(model, type):
+            model = model.__class__
+        opts = model._meta
+        while getattr(opts, 'proxy', False):
+            model = opts.proxy_for_model
+            opts = model._meta
+
+        # new models get their content type created
+        self._lookup((opts.app_label, opts.object_name.lower()))
+        return ContentType.objects.get_for_model(model)
+
+    def get_id(self, model):
+        "Return id of ContentType of given model class or instance."
+        return self.get_for_model(model).pk
+
+    def get_for_id(self, ct_id):
+        "Return ContentType with given id."
+        self._lookup(ct_id)
+        if ct_id in self._stale:
+            return self._stale[ct_id]
+        return ContentType.objects.get_for_id(ct_id)
+
+    def get_model(self, ct_id):
+        "Return model class of ContentType with given id, None if it doesn't exist."
+        return self.get_for_id(ct_id).model_class()
+
+    def stats(self):
+        """
+        Return numbers of lookups served from memory (hits) and queries
+        issued (queries) by the current thread since the last reset_stats().
+        """
+        return {
+            'hits': getattr(self._stats, 'hits', 0),
+            'queries': getattr(self._stats, 'queries', 0),
+        }
+
+    def reset_stats(self):
+        self._stats.hits = 0
+        self._stats.queries = 0
+
+
+# global map used throughout django_ratings
+content_types = ContentTypeMap()
+
+def clear_content_types(sender, **kwargs):
+    "Content types get recreated with new ids when the database is flushed."
+    content_types.clear()
+
+post_syncdb.connect(clear_content_types)
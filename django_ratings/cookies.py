@@ -0,0 +1,132 @@
+"""
+Compact signed format of the cookie remembering objects rated by a visitor.
+
+Votes are (content type id, object id) pairs packed as varints, encoded with
+URL safe base64 and signed with HMAC keyed by SECRET_KEY, so a vote takes
+3-6 bytes instead of a ``ct:id,`` string and the cookie can't be forged to
+hide votes.
+
+Cookies in the old comma separated format carry no signature. They are only
+understood until RATINGS_LEGACY_COOKIES_UNTIL (a datetime) and get replaced
+by signed ones, see set_votes_cookie and
+django_ratings.middleware.VotesCookieMiddleware. By default they are
+understood for RATINGS_MAX_COOKIE_AGE after the process started - cookies
+issued before the upgrade expire by then, so visitors keep their votes.
+"""
+
+import hmac
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils.hashcompat import sha_constructor
+
+RATINGS_LEGACY_COOKIES_UNTIL = getattr(settings, 'RATINGS_LEGACY_COOKIES_UNTIL', None)
+
+# legacy cookies are accepted for one cookie lifetime from here by default
+STARTED = datetime.now()
+
+# separates the packed votes from their signature
+SEPARATOR = '.'
+# number of signature bytes kept in the cookie
+SIGNATURE_LENGTH = 8
+
+def pack_varint(value):
+    "Return value as an unsigned LEB128 varint."
+    bytes = []
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            bytes.append(chr(byte | 0x80))
+        else:
+            bytes.append(chr(byte))
+            return ''.join(bytes)
+
+def unpack_varints(data):
+    "Return list of integers packed in data by pack_varint."
+    values = []
+    value = shift = 0
+    for char in data:
+        byte = ord(char)
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    if shift:
+        raise ValueError('Truncated varint.')
+    return values
+
+def _b64encode(data):
+    return urlsafe_b64encode(data).rstrip('=')
+
+def _b64decode(data):
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def get_signature(data):
+    return hmac.new('django_ratings' + settings.SECRET_KEY, data, sha_constructor).digest()[:SIGNATURE_LENGTH]
+
+def encode_votes(votes):
+    "Return cookie value for given list of (ct_id, object_id) pairs."
+    data = ''.join(pack_varint(ct_id) + pack_varint(object_id) for ct_id, object_id in votes)
+    return '%s%s%s' % (_b64encode(data), SEPARATOR, _b64encode(get_signature(data)))
+
+def is_legacy(value):
+    "Return True if cookie value is in the old comma separated format."
+    return ':' in value
+
+def get_legacy_deadline():
+    "Return the time until which cookies in the old format are understood."
+    if RATINGS_LEGACY_COOKIES_UNTIL is not None:
+        return RATINGS_LEGACY_COOKIES_UNTIL
+    from django_ratings.models import RATINGS_MAX_COOKIE_AGE
+    return STARTED + timedelta(seconds=RATINGS_MAX_COOKIE_AGE)
+
+def accepts_legacy():
+    return datetime.now() < get_legacy_deadline()
+
+def decode_votes(value):
+    """
+    Return list of (ct_id, object_id) pairs stored in cookie value. The old
+    comma separated format is accepted until RATINGS_LEGACY_COOKIES_UNTIL.
+    Broken or forged cookies give an empty list.
+    """
+    try:
+        value = str(value)
+    except UnicodeEncodeError:
+        return []
+    if not value:
+        return []
+
+    if is_legacy(value):
+        if not accepts_legacy():
+            return []
+        votes = []
+        for vote in value.split(','):
+            try:
+                ct_id, object_id = vote.split(':')
+                votes.append((int(ct_id), int(object_id)))
+            except ValueError:
+                continue
+        return votes
+
+    try:
+        data, signature = value.split(SEPARATOR)
+        data, signature = _b64decode(data), _b64decode(signature)
+        if signature != get_signature(data):
+            return []
+        values = unpack_varints(data)
+    except (ValueError, TypeError):
+        return []
+    return zip(values[::2], values[1::2])
+
+def set_votes_cookie(response, votes):
+    "Store given list of (ct_id, object_id) pairs in a signed cookie."
+    from django_ratings.models import RATINGS_COOKIE_NAME, RATINGS_MAX_COOKIE_AGE
+    expires = datetime.strftime(datetime.utcnow() + timedelta(seconds=RATINGS_MAX_COOKIE_AGE), "%a, %d-%b-%Y %H:%M:%S GMT")
+    domain = settings.SESSION_COOKIE_DOMAIN
+    response.set_cookie(RATINGS_COOKIE_NAME, value=encode_votes(votes),
+            max_age=RATINGS_MAX_COOKIE_AGE, expires=expires,  path='/',
+            domain=domain, secure=None)
@@ -0,0 +1,284 @@
+"""
+Streaming export and import of ratings data, used by the export_ratings and
+import_ratings management commands.
+
+Records of Rating, Agg, TotalRate and UserKarma are read in primary key
+ordered chunks and written as JSON lines (one object with a "model" key per
+line) or CSV (one model per file), so memory use doesn't depend on the size
+of the tables. Content types are written as "app_label.model" so the data
+can be loaded into a database with different content type ids. User ids are
+kept as they are.
+
+Import writes batches with executemany() without any duplicity checks.
+AnonymousVote records of imported anonymous ratings that can still block new
+ratings are recreated. TotalRate records are skipped, TotalRate is rebuilt
+from Agg and Rating at the end instead.
+"""
+
+import csv
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.contrib.contenttypes.models import ContentType
+from django.utils import simplejson
+
+from django_ratings import caching, percentiles
+from django_ratings.models import Rating, Agg, TotalRate, UserKarma, AnonymousVote, Leaderboard, \
+        get_day_key, get_vote_bucket, PERIOD_DIVISORS, PERIOD_CHOICES, MINIMAL_ANONYMOUS_IP_DELAY, \
+        RATINGS_CACHE, RATINGS_LEADERBOARDS
+from django_ratings.content_types import content_types
+
+# number of records read or written at once
+CHUNK_SIZE = 1000
+
+# exported models in the order they are exported and imported, with their
+# (column, type) pairs
+MODELS = (
+    ('rating', Rating, (
+        ('target_ct_id', 'ct'),
+        ('target_id', 'int'),
+        ('time', 'datetime'),
+        ('user_id', 'int'),
+        ('amount', 'decimal'),
+        ('ip_address', 'str'),
+    )),
+    ('agg', Agg, (
+        ('target_ct_id', 'ct'),
+        ('target_id', 'int'),
+        ('time', 'date'),
+        ('people', 'int'),
+        ('amount', 'decimal'),
+        ('period', 'str'),
+        ('detract', 'int'),
+    )),
+    ('totalrate', TotalRate, (
+        ('target_ct_id', 'ct'),
+        ('target_id', 'int'),
+        ('amount', 'decimal'),
+    )),
+    ('userkarma', UserKarma, (
+        ('user_id', 'int'),
+        ('karma', 'decimal'),
+    )),
+)
+MODEL_NAMES = [name for name, model, columns in MODELS]
+# models exported by default, TotalRate is computed from the rest on import
+DEFAULT_MODEL_NAMES = [name for name in MODEL_NAMES if name != 'totalrate']
+
+def get_spec(name):
+    for spec in MODELS:
+        if spec[0] == name:
+            return spec
+    raise ValueError('Unknown model %r, use one of %s.' % (name, ', '.join(MODEL_NAMES)))
+
+
+def _dump_value(type, value):
+    if value is None:
+        return None
+    if type == 'ct':
+        ct = content_types.get_for_id(value)
+        return '%s.%s' % (ct.app_label, ct.model)
+    if type in ('datetime', 'date'):
+        return value.isoformat()
+    if type == 'decimal':
+        return str(value)
+    return value
+
+def _load_value(type, value, cts):
+    if value is None or value == '':
+        if type == 'str':
+            return ''
+        return None
+    if type == 'ct':
+        if value not in cts:
+            try:
+                app_label, model = value.split('.')
+                cts[value] = ContentType.objects.get(app_label=app_label, model=model).pk
+            except (ValueError, ContentType.DoesNotExist):
+                raise ValueError('Unknown content type %r.' % value)
+        return cts[value]
+    if type == 'int':
+        return int(value)
+    if type == 'datetime':
+        # strptime of Python 2.5 doesn't know %f
+        value, microseconds = (value.split('.', 1) + [''])[:2]
+        time = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+        return time.replace(microsecond=int(microseconds.ljust(6, '0')[:6]))
+    if type == 'date':
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    if type == 'decimal':
+        return Decimal(value)
+    return value
+
+
+def export_records(name, chunk_size=CHUNK_SIZE):
+    """
+    Yield records of given model as dicts mapping column names to
+    serializable values, chunk_size records are fetched at once.
+    """
+    name, model, columns = get_spec(name)
+    pk = model._meta.pk.attname
+    qset = model._default_manager.order_by(pk).values_list(pk, *[c for c, t in columns])
+    last = None
+    while True:
+        chunk = qset
+        if last is not None:
+            chunk = chunk.filter(**{'%s__gt' % pk: last})
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        for row in chunk:
+            yield dict((c, _dump_value(t, v)) for (c, t), v in zip(columns, row[1:]))
+        last = chunk[-1][0]
+
+def write_jsonl(names, out, chunk_size=CHUNK_SIZE):
+    "Write records of given models to file out as JSON lines, return their count."
+    count = 0
+    for name in names:
+        for record in export_records(name, chunk_size):
+            record['model'] = name
+            out.write(simplejson.dumps(record) + '\n')
+            count += 1
+    return count
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    return value
+
+def write_csv(name, out, chunk_size=CHUNK_SIZE):
+    "Write records of given model to file out as CSV, return their count."
+    columns = [c for c, t in get_spec(name)[2]]
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    count = 0
+    for record in export_records(name, chunk_size):
+        writer.writerow([_csv_value(record[c]) for c in columns])
+        count += 1
+    return count
+
+
+def read_jsonl(lines):
+    "Yield (model name, record) pairs from JSON lines."
+    for line in lines:
+        if line.strip():
+            record = simplejson.loads(line)
+            yield record.pop('model'), record
+
+def read_csv(name, lines):
+    "Yield (model name, record) pairs from CSV with a header row."
+    for record in csv.DictReader(lines):
+        yield name, record
+
+
+def insert_records(name, records, cts):
+    "Insert given records of one model using one executemany() call."
+    name, model, columns = get_spec(name)
+    qn = connection.ops.quote_name
+    ops = connection.ops
+
+    rows = []
+    for record in records:
+        row = dict((c, _load_value(t, record.get(c), cts)) for c, t in columns)
+        if model is Rating:
+            row['day'] = get_day_key(row['time'])
+        elif model is Agg:
+            day = get_day_key(row['time'])
+            row['bucket'] = day - day % PERIOD_DIVISORS[dict(PERIOD_CHOICES)[row['period']]]
+        rows.append(row)
+
+    if model is UserKarma:
+        # karma is one record per user, imported records replace existing ones
+        UserKarma.objects.filter(user__in=[row['user_id'] for row in rows]).delete()
+
+    names = rows and sorted(rows[0].keys()) or []
+    types = dict(columns)
+    def to_db(column, value):
+        if value is None:
+            return None
+        if types.get(column) == 'datetime':
+            return ops.value_to_db_datetime(value)
+        if types.get(column) == 'date':
+            return ops.value_to_db_date(value)
+        if types.get(column) == 'decimal':
+            return ops.value_to_db_decimal(value, 10, 2)
+        return value
+
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join(map(qn, names)),
+        ', '.join(['%s'] * len(names)),
+    )
+    cursor = connection.cursor()
+    cursor.executemany(sql, [[to_db(c, row[c]) for c in names] for row in rows])
+
+    if model is Rating:
+        insert_votes(rows)
+
+def insert_votes(rows):
+    """
+    Recreate AnonymousVote records of given imported anonymous ratings, so
+    that the voters can't rate the objects again. Votes that would already
+    be purged and votes present in the database are skipped.
+    """
+    oldest = get_vote_bucket(datetime.now() - timedelta(seconds=MINIMAL_ANONYMOUS_IP_DELAY))
+    votes = {}
+    for row in rows:
+        if row['user_id'] is not None or not row['ip_address']:
+            continue
+        vote = (row['target_ct_id'], row['target_id'], row['ip_address'], get_vote_bucket(row['time']))
+        if vote[3] >= oldest and vote not in votes:
+            votes[vote] = Rating(target_ct_id=vote[0], target_id=vote[1], ip_address=vote[2], time=row['time'])
+    if not votes:
+        return
+
+    existing = AnonymousVote.objects.filter(
+            bucket__in=set(v[3] for v in votes),
+            ip_address__in=set(v[2] for v in votes)
+        ).values_list('target_ct', 'target_id', 'ip_address', 'bucket')
+    for vote in existing:
+        votes.pop(vote, None)
+    AnonymousVote.objects.insert_many(votes.values())
+
+def import_records(records, chunk_size=CHUNK_SIZE):
+    """
+    Insert (model name, record) pairs in batches of chunk_size records, each
+    batch committed in its own transaction. TotalRate records are skipped.
+    Return dict mapping model names to numbers of imported records.
+
+    Raises ValueError on records that can't be imported, batches before
+    the broken record stay committed.
+    """
+    cts = {}
+    counts = {}
+    batch, batch_name = [], None
+    insert = transaction.commit_on_success(insert_records)
+    for name, record in records:
+        get_spec(name)
+        if name == 'totalrate':
+            continue
+        if batch and (name != batch_name or len(batch) >= chunk_size):
+            insert(batch_name, batch, cts)
+            batch = []
+        batch_name = name
+        batch.append(record)
+        counts[name] = counts.get(name, 0) + 1
+    if batch:
+        insert(batch_name, batch, cts)
+    return counts
+
+def recompute_totalrate():
+    """
+    Rebuild TotalRate after an import from Agg and ratings not aggregated
+    yet, shards, the cache, the percentile index and leaderboards included.
+    No ratings are moved, that is left to the regular aggregation.
+    """
+    TotalRate.objects.all().delete()
+    Agg.objects.agg_to_totalrate()
+    Rating.objects.rate_to_totalrate()
+    if RATINGS_CACHE:
+        caching.totals.invalidate_all()
+    percentiles.index.invalidate()
+    if RATINGS_LEADERBOARDS:
+        Leaderboard.objects.refresh()
@@ -0,0 +1,73 @@
+"""
+Indexes spanning several columns.
+
+Django can only declare single column indexes (db_index), so models list
+tuples of field names in their composite_indexes attribute. Indexes of
+models created by syncdb are added by the post_syncdb handler in
+django_ratings.models, South migrations call create_index and drop_index
+directly. Both name the index the same way, so either path leaves the
+database with the same indexes.
+
+create_index skips indexes that exist already or whose table or columns
+don't exist yet - South sends post_syncdb for tables of the initial
+migration, before later migrations renamed them and added their columns.
+"""
+
+from django.conf import settings
+from django.db import connection
+from django.db.backends.util import truncate_name
+
+def get_columns(model, fields):
+    return [model._meta.get_field(f).column for f in fields]
+
+def get_index_name(model, fields):
+    name = '%s_%s' % (model._meta.db_table, '_'.join(get_columns(model, fields)))
+    return truncate_name(name, connection.ops.max_name_length())
+
+def index_exists(cursor, model, name):
+    engine = settings.DATABASE_ENGINE
+    if engine == 'sqlite3':
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = %s", (name,))
+    elif engine == 'mysql':
+        cursor.execute('''SELECT 1 FROM information_schema.statistics
+                 WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s''', (model._meta.db_table, name))
+    else:
+        cursor.execute("SELECT 1 FROM pg_class WHERE relkind = 'i' AND relname = %s", (name,))
+    return cursor.fetchone() is not None
+
+def create_index(model, fields):
+    """
+    Create index on given fields of model unless it exists or its table or
+    some of its columns are missing, return True if it was created.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    columns = get_columns(model, fields)
+    name = get_index_name(model, fields)
+
+    cursor = connection.cursor()
+    if table not in connection.introspection.get_table_list(cursor):
+        return False
+    existing = [row[0] for row in connection.introspection.get_table_description(cursor, table)]
+    if [c for c in columns if c not in existing] or index_exists(cursor, model, name):
+        return False
+    cursor.execute('CREATE INDEX %s ON %s (%s)' % (qn(name), qn(table), ', '.join(map(qn, columns))))
+    return True
+
+def drop_index(model, fields):
+    "Drop index on given fields of model if it exists."
+    qn = connection.ops.quote_name
+    name = get_index_name(model, fields)
+    cursor = connection.cursor()
+    if not index_exists(cursor, model, name):
+        return
+    if settings.DATABASE_ENGINE == 'mysql':
+        cursor.execute('DROP INDEX %s ON %s' % (qn(name), qn(model._meta.db_table)))
+    else:
+        cursor.execute('DROP INDEX %s' % qn(name))
+
+def create_composite_indexes(sender, created_models, **kwargs):
+    "Create composite_indexes of models created by syncdb."
+    for model in created_models:
+        for fields in getattr(model, 'composite_indexes', ()):
+            create_index(model, fields)
@@ -0,0 +1,101 @@
+"""
+Measurements of rating template tags, views and manager methods.
+
+With RATINGS_INSTRUMENTATION set, every call of a function decorated by
+instrumented() is measured - wall time, number of queries (only recorded by
+Django when DEBUG is on) and number of total rate cache hits - and reported
+with the ``measured`` signal. Sinks listed in RATINGS_METRICS_SINKS are
+connected to it, LoggingSink and StatsdSink are provided. When the setting
+is off, instrumented() returns the function untouched, so there is no
+overhead at all.
+"""
+
+import logging
+import socket
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.functional import wraps
+
+from django_ratings import caching
+from django_ratings.signals import measured
+
+RATINGS_INSTRUMENTATION = getattr(settings, 'RATINGS_INSTRUMENTATION', False)
+RATINGS_METRICS_SINKS = getattr(settings, 'RATINGS_METRICS_SINKS', ('django_ratings.instrumentation.LoggingSink',))
+RATINGS_STATSD_HOST = getattr(settings, 'RATINGS_STATSD_HOST', 'localhost')
+RATINGS_STATSD_PORT = getattr(settings, 'RATINGS_STATSD_PORT', 8125)
+RATINGS_STATSD_PREFIX = getattr(settings, 'RATINGS_STATSD_PREFIX', 'django_ratings')
+
+logger = logging.getLogger('django_ratings')
+
+def measure(name, func, *args, **kwargs):
+    "Call func with given arguments and report the call as name."
+    queries = len(connection.queries)
+    hits = caching.totals.hits
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        measured.send(
+                sender=func,
+                name=name,
+                queries=len(connection.queries) - queries,
+                seconds=time.time() - start,
+                cache_hits=caching.totals.hits - hits
+            )
+
+def instrumented(name, enabled=None):
+    """
+    Decorator reporting calls of the function as name, does nothing unless
+    enabled (defaults to RATINGS_INSTRUMENTATION).
+    """
+    if enabled is None:
+        enabled = RATINGS_INSTRUMENTATION
+    def decorator(func):
+        if not enabled:
+            return func
+        def wrapper(*args, **kwargs):
+            return measure(name, func, *args, **kwargs)
+        return wraps(func)(wrapper)
+    return decorator
+
+
+class LoggingSink(object):
+    "Logs every measurement on debug level."
+    def __call__(self, sender, name, queries, seconds, cache_hits, **kwargs):
+        logger.debug('%s: %.2f ms, %d queries, %d cache hits' % (name, seconds * 1000, queries, cache_hits))
+
+
+class StatsdSink(object):
+    "Sends measurements to statsd over UDP, errors are ignored."
+    def __init__(self, host=RATINGS_STATSD_HOST, port=RATINGS_STATSD_PORT, prefix=RATINGS_STATSD_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, sender, name, queries, seconds, cache_hits, **kwargs):
+        key = '%s.%s' % (self.prefix, name)
+        data = '\n'.join([
+            '%s.time:%d|ms' % (key, seconds * 1000),
+            '%s.queries:%d|c' % (key, queries),
+            '%s.cache_hits:%d|c' % (key, cache_hits),
+        ])
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+
+def load_sinks(paths=RATINGS_METRICS_SINKS):
+    "Instantiate sinks given by dotted paths and connect them to measured."
+    sinks = []
+    for path in paths:
+        module, attr = path.rsplit('.', 1)
+        sink = getattr(__import__(module, {}, {}, [attr]), attr)()
+        measured.connect(sink, weak=False)
+        sinks.append(sink)
+    return sinks
+
+if RATINGS_INSTRUMENTATION:
+    sinks = load_sinks()
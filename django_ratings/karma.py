@@ -1,5 +1,16 @@
+import logging
+import threading
+
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django_ratings import transactions
+from django_ratings.content_types import content_types
+
+# maximal number of object ids resolved to owners at once
+OWNERS_CHUNK_SIZE = 500
+
+logger = logging.getLogger('django_ratings')
 
 class KarmaSources(object):
     """
@@ -7,31 +18,217 @@ class KarmaSources(object):
     that should be involved in calculating user's karma must be register
     afunction that, when given a Model instance will either return it's owner
     or None if not applicable.
+
+    Proxy models and subclasses of a registered model share its
+    registration. Registrations are also indexed by content type id, so
+    owners of rated objects can be resolved from (target_ct_id, target_id)
+    pairs without fetching the objects when owner_field is given. Proxy
+    models share the content type of their concrete model, so a registered
+    proxy resolves owners of all objects rated under that content type,
+    unless the concrete model is registered itself.
     """
     def __init__(self):
         self._registry = {}
-    
-    def register(self, model, owner_getter, weight=1):
-        "Register a model class with it's owner_getter."
-        if model in self._registry and self._registry[model] != (owner_getter, weight):
+        # concrete model -> registered proxy model
+        self._proxies = {}
+        self._clear_index()
+
+    def _clear_index(self):
+        # registered model class or any of its descendants -> source or None
+        self._by_model = {}
+        # content type id -> (model, source) or None
+        self._by_ct = {}
+        self._content_types = None
+
+    def register(self, model, owner_getter, weight=1, owner_field=None):
+        """
+        Register a model class with it's owner_getter.
+
+        owner_field: optional lookup path (eg. 'author' or 'article__author')
+            from the model to the owning User. When given, owners can be
+            found with a single query for many objects and owner_getter may
+            be None.
+        """
+        if owner_getter is None and owner_field is None:
+            raise ImproperlyConfigured('Either owner_getter or owner_field has to be given for %s model.' % model)
+        if model in self._registry and self._registry[model] != (owner_getter, weight, owner_field):
             raise ImproperlyConfigured('Cannot register %s model twice with different getters.')
 
-        self._registry[model] = (owner_getter, weight)
+        if getattr(getattr(model, '_meta', None), 'proxy', False):
+            concrete = model
+            while concrete._meta.proxy:
+                concrete = concrete._meta.proxy_for_model
+            if self._proxies.get(concrete, model) is not model:
+                raise ImproperlyConfigured('Cannot register both %s and %s, proxies of %s share its content type.' % (
+                        self._proxies[concrete], model, concrete))
+            self._proxies[concrete] = model
+
+        self._registry[model] = (owner_getter, weight, owner_field)
+        self._clear_index()
+
+    def get_source(self, model):
+        """
+        Return (owner_getter, weight, owner_field) registered for model class
+        or its nearest registered ancestor, None if there is none.
+        """
+        if model not in self._by_model:
+            source = None
+            for cls in model.__mro__:
+                if cls in self._registry:
+                    source = self._registry[cls]
+                    break
+            self._by_model[model] = source
+        return self._by_model[model]
+
+    def get_source_for_ct(self, ct_id):
+        """
+        Return tuple (model, (owner_getter, weight, owner_field)) for given
+        content type id or None if its model is not a karma source. The
+        model is the registered proxy if only a proxy of the content type's
+        model (or of its ancestor) is registered.
+        """
+        if ct_id not in self._by_ct:
+            model = content_types.get_model(ct_id)
+            source = model is not None and self.get_source(model) or None
+            if model is not None and source is None:
+                for cls in model.__mro__:
+                    if cls in self._proxies:
+                        model = self._proxies[cls]
+                        source = self.get_source(model)
+                        break
+            self._by_ct[ct_id] = source and (model, source)
+        return self._by_ct[ct_id]
 
     def get_owner(self, instance):
         """
         Get the owner of given model, return None if there is no owner or the
         model class is not registered.
         """
-        if instance.__class__ in self._registry:
-            owner_getter, weight = self._registry[instance.__class__]
-            return owner_getter(instance), weight
+        source = self.get_source(instance.__class__)
+        if source is None:
+            return None
+
+        owner_getter, weight, owner_field = source
+        if owner_getter is None:
+            owner = instance
+            for attr in owner_field.split('__'):
+                owner = getattr(owner, attr)
+            return owner, weight
+        return owner_getter(instance), weight
+
+    def get_owner_ids(self, model, ids):
+        """
+        Return dict mapping primary keys of given objects of model to primary
+        keys of their owners, objects without owner are left out. Uses one
+        query if owner_field is registered for the model.
+        """
+        owner_getter, weight, owner_field = self.get_source(model)
+        if owner_field:
+            owners = model._default_manager.filter(pk__in=ids).values_list('pk', owner_field)
+            return dict((pk, owner_id) for pk, owner_id in owners if owner_id is not None)
+
+        owners = {}
+        for pk, obj in model._default_manager.in_bulk(ids).items():
+            owner = owner_getter(obj)
+            if owner is not None:
+                owners[pk] = owner.pk
+        return owners
+
+    def get_karmas(self, amounts, chunk_size=OWNERS_CHUNK_SIZE):
+        """
+        Return dict mapping user ids to weighted sums of given amounts, which
+        is a dict mapping (target_ct_id, target_id) pairs to total rates.
+        Owners are resolved in chunks of chunk_size objects, with one query
+        per chunk for models registered with owner_field.
+        """
+        by_ct = {}
+        for (target_ct_id, target_id), amount in amounts.items():
+            if amount:
+                by_ct.setdefault(target_ct_id, {})[target_id] = amount
 
-        return None
+        karmas = {}
+        for target_ct_id, ct_amounts in by_ct.items():
+            source = self.get_source_for_ct(target_ct_id)
+            if source is None:
+                continue
+            model, (owner_getter, weight, owner_field) = source
+            ids = ct_amounts.keys()
+            for i in range(0, len(ids), chunk_size):
+                for pk, owner_id in self.get_owner_ids(model, ids[i:i + chunk_size]).items():
+                    karmas[owner_id] = karmas.get(owner_id, 0) + ct_amounts[pk] * weight
+        return karmas
 
     def registered_content_types(self):
-        return map(ContentType.objects.get_for_model, self._registry.keys())
+        if self._content_types is None:
+            self._content_types = map(content_types.get_for_model, self._registry.keys())
+        return list(self._content_types)
+
+
+class KarmaDeltas(object):
+    """
+    Applies changes of total rates to karma of objects' owners. Changes
+    made within one transaction are coalesced and applied in a transaction
+    of their own once it commits, changes of rolled back transactions are
+    dropped. Connected to total_rate_changed signal when
+    RATINGS_KARMA_INCREMENTAL is set.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def _get_pending(self):
+        """
+        Return changes collected in the current transaction, None if there
+        are none.
+        """
+        pending = getattr(self._local, 'pending', None)
+        if pending is None or pending[0] != transactions.get_transaction_id():
+            return None
+        return pending[1]
+
+    def receive(self, sender, target_ct_id, target_id, amount, **kwargs):
+        pending = self._get_pending()
+        key = (target_ct_id, target_id)
+        if pending is not None:
+            pending[key] = pending.get(key, 0) + amount
+            return
+        pending = {key: amount}
+        self._local.pending = (transactions.get_transaction_id(), pending)
+        transactions.on_commit(self._apply_committed, pending)
+
+    def _apply_committed(self, pending):
+        if getattr(self._local, 'pending', (None, None))[1] is pending:
+            self._local.pending = None
+        # a vote must not fail because of its owner's karma, karma gets
+        # fixed by the next aggregation with recompute_karma
+        try:
+            transaction.commit_on_success(self.apply)(pending)
+        except Exception:
+            logger.exception('Failed to apply karma changes.')
+
+    def apply(self, pending):
+        """
+        Apply changes given as dict mapping (target_ct_id, target_id) pairs
+        to changes of their total rates, return number of affected users.
+        """
+        from django_ratings.models import UserKarma
+
+        karmas = sources.get_karmas(pending)
+        if karmas:
+            UserKarma.objects.add_karmas(karmas)
+        return len(karmas)
+
+    def discard(self):
+        """
+        Drop changes collected in the current transaction, called when karma
+        gets recomputed from total rates that already include them.
+        """
+        pending = self._get_pending()
+        if pending is not None:
+            pending.clear()
 
 
 # global registry of karma sources
 sources = KarmaSources()
+
+# global applier of karma changes
+deltas = KarmaDeltas()
@@ -1,12 +1,63 @@
-from django.core.management.base import NoArgsCommand
+from optparse import make_option
+from datetime import datetime, timedelta
+
+from django.core.management.base import NoArgsCommand, CommandError
 from django.db import transaction
 
 # Logging must be inicialized
-from django_ratings.aggregation import transfer_data
+from django_ratings.aggregation import transfer_data, get_rating_chunks, get_agg_content_types, TIMES_ALL
+from django_ratings.models import Rating
+from django_ratings.content_types import content_types
 
 class Command(NoArgsCommand):
     help = 'Aggregate ratings'
 
-    @transaction.commit_on_success
+    option_list = NoArgsCommand.option_list + (
+        make_option('--incremental', action='store_true', dest='incremental', default=False,
+            help='Only recompute total rates of objects rated since the last run.'),
+        make_option('--karma', action='store_true', dest='karma', default=False,
+            help='Recompute karma of all users from total rates.'),
+        make_option('--chunk-days', action='store', type='int', dest='chunk_days', default=30,
+            help='Move ratings to aggregations in chunks of one content type and this many days, '
+                'each committed separately. 0 runs everything in one transaction.'),
+        make_option('--workers', action='store', type='int', dest='workers', default=1,
+            help='Number of processes aggregating different content types in parallel.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only print the chunks that would be processed.'),
+    )
+
     def handle(self, **options):
-        transfer_data()
+        chunk_days = options.get('chunk_days', 30) or None
+        workers = options.get('workers', 1)
+        if workers > 1 and chunk_days is None:
+            raise CommandError('--workers cannot be used with --chunk-days=0.')
+        if options.get('dry_run', False):
+            self.print_plan(chunk_days or 365*100)
+            return
+
+        if chunk_days is None:
+            transaction.commit_on_success(transfer_data)(
+                    incremental=options.get('incremental', False),
+                    recompute_karma=options.get('karma', False)
+                )
+        else:
+            transfer_data(
+                    incremental=options.get('incremental', False),
+                    recompute_karma=options.get('karma', False),
+                    chunk_days=chunk_days,
+                    workers=workers
+                )
+
+    def print_plan(self, chunk_days):
+        timenow = datetime.now()
+        for t in sorted(TIMES_ALL.keys(), reverse=True):
+            time_agg = timenow - timedelta(seconds=t)
+            for target_ct_id, time_from, time_to in get_rating_chunks(time_agg, chunk_days):
+                ratings = Rating.objects.filter(target_ct=target_ct_id, time__lte=time_to)
+                if time_from is not None:
+                    ratings = ratings.filter(time__gt=time_from)
+                print 'ratings of %s from %s to %s by %s: %d' % (
+                    content_types.get_for_id(target_ct_id), time_from or '-', time_to, TIMES_ALL[t], ratings.count()
+                )
+        for target_ct_id in get_agg_content_types():
+            print 'aggregations and total rates of %s' % content_types.get_for_id(target_ct_id)
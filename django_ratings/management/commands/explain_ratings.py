@@ -0,0 +1,47 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.contrib.contenttypes.models import ContentType
+
+from django_ratings.models import Rating, TotalRate, Agg, AnonymousVote, get_vote_bucket
+from django_ratings.content_types import content_types
+
+EXPLAIN = {
+    'sqlite3': 'EXPLAIN QUERY PLAN',
+}
+
+def get_queries():
+    """
+    Return list of (name, queryset) pairs of the hot queries, filled with
+    sample values.
+    """
+    ct_id = content_types.get_id(ContentType)
+    now = datetime.now()
+    return [
+        ('TotalRate.get_for_object', TotalRate.objects.filter(target_ct=ct_id, target_id=1).values('amount')),
+        ('TotalRate.get_normalized_rating', TotalRate.objects.filter(target_ct=ct_id, amount__lt=1, amount__gt=0).values('id')),
+        ('TotalRate.get_top_objects', TotalRate.objects.order_by('-amount').values_list('target_ct', 'target_id')[:10]),
+        ('TotalRate.get_top_objects for model', TotalRate.objects.filter(target_ct__in=[ct_id]).order_by('-amount').values_list('target_ct', 'target_id')[:10]),
+        ('Rating user duplicity', Rating.objects.filter(target_ct=ct_id, target_id=1, user=1).values('id')),
+        ('AnonymousVote duplicity', AnonymousVote.objects.filter(target_ct=ct_id, target_id=1, ip_address='127.0.0.1', bucket=get_vote_bucket(now)).values('id')),
+        ('Rating.move_rate_to_agg', Rating.objects.get_movable(now).values('target_ct', 'target_id')),
+        ('Rating.move_rate_to_agg chunk', Rating.objects.get_movable(now, ct_id, now).values('target_ct', 'target_id')),
+        ('Agg.move_agg_to_agg', Agg.objects.get_movable(now).order_by().values('target_ct', 'target_id')),
+        ('Agg.move_agg_to_agg chunk', Agg.objects.get_movable(now, ct_id).order_by().values('target_ct', 'target_id')),
+    ]
+
+class Command(NoArgsCommand):
+    help = 'Print query plans of the hot rating queries'
+
+    def handle_noargs(self, **options):
+        explain = EXPLAIN.get(settings.DATABASE_ENGINE, 'EXPLAIN')
+        cursor = connection.cursor()
+        for name, qset in get_queries():
+            sql, params = qset.query.as_sql()
+            cursor.execute('%s %s' % (explain, sql), params)
+            print name
+            for row in cursor.fetchall():
+                print '    ' + ' '.join(map(unicode, row))
+            print
@@ -0,0 +1,42 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from django_ratings.dumps import write_jsonl, write_csv, get_spec, MODEL_NAMES, DEFAULT_MODEL_NAMES, CHUNK_SIZE
+
+class Command(NoArgsCommand):
+    help = 'Export ratings data as JSON lines or CSV'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', action='store', dest='format', default='jsonl',
+            help='Output format, jsonl or csv.'),
+        make_option('--models', action='store', dest='models', default=','.join(DEFAULT_MODEL_NAMES),
+            help='Comma separated models to export, any of %s, defaults to %s. CSV takes just one.' % (', '.join(MODEL_NAMES), ', '.join(DEFAULT_MODEL_NAMES))),
+        make_option('--output', action='store', dest='output', default=None,
+            help='File to write to, defaults to standard output.'),
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size', default=CHUNK_SIZE,
+            help='Number of records fetched at once.'),
+    )
+
+    def handle_noargs(self, **options):
+        names = [n.strip() for n in options['models'].split(',') if n.strip()]
+        try:
+            map(get_spec, names)
+        except ValueError, e:
+            raise CommandError(str(e))
+        if options['format'] not in ('jsonl', 'csv'):
+            raise CommandError('Unknown format %r.' % options['format'])
+        if options['format'] == 'csv' and len(names) != 1:
+            raise CommandError('CSV export takes exactly one model.')
+
+        out = options['output'] and open(options['output'], 'wb') or sys.stdout
+        try:
+            if options['format'] == 'csv':
+                count = write_csv(names[0], out, options['chunk_size'])
+            else:
+                count = write_jsonl(names, out, options['chunk_size'])
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        sys.stderr.write('Exported %d records.\n' % count)
@@ -0,0 +1,49 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from django_ratings.dumps import read_jsonl, read_csv, import_records, recompute_totalrate, get_spec, CHUNK_SIZE
+
+class Command(BaseCommand):
+    help = 'Import ratings data exported by export_ratings'
+    args = '[file]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default='jsonl',
+            help='Input format, jsonl or csv.'),
+        make_option('--model', action='store', dest='model', default=None,
+            help='Model stored in CSV input.'),
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size', default=CHUNK_SIZE,
+            help='Number of records inserted in one transaction.'),
+        make_option('--no-recompute', action='store_false', dest='recompute', default=True,
+            help='Keep TotalRate as it is instead of rebuilding it from the imported data.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Only one file can be imported at once.')
+        lines = args and open(args[0], 'rb') or sys.stdin
+
+        if options['format'] == 'csv':
+            if not options['model']:
+                raise CommandError('CSV import needs --model.')
+            try:
+                get_spec(options['model'])
+            except ValueError, e:
+                raise CommandError(str(e))
+            records = read_csv(options['model'], lines)
+        elif options['format'] == 'jsonl':
+            records = read_jsonl(lines)
+        else:
+            raise CommandError('Unknown format %r.' % options['format'])
+
+        try:
+            counts = import_records(records, options['chunk_size'])
+        except ValueError, e:
+            raise CommandError('Import failed, already imported batches were kept: %s' % e)
+        if options['recompute']:
+            transaction.commit_on_success(recompute_totalrate)()
+        for name, count in sorted(counts.items()):
+            sys.stderr.write('Imported %d %s records.\n' % (count, name))
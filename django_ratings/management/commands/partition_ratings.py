@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+from django_ratings import partitions
+
+class Command(NoArgsCommand):
+    help = 'Create daily partitions of the Rating table (PostgreSQL only)'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days-ahead', action='store', type='int', dest='days_ahead', default=7,
+            help='Number of future days to create partitions for.'),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, **options):
+        if not partitions.is_supported():
+            raise CommandError('Partitioning of ratings is only supported on PostgreSQL.')
+        for name in partitions.create_partitions(days_ahead=options.get('days_ahead', 7)):
+            print 'Created partition %s' % name
@@ -0,0 +1,33 @@
+import logging
+
+from django_ratings.content_types import content_types
+from django_ratings.cookies import set_votes_cookie
+
+logger = logging.getLogger('django_ratings')
+
+class ContentTypeStatsMiddleware(object):
+    """
+    Logs how many content type lookups of each request were served from
+    django_ratings.content_types without a query.
+    """
+    def process_request(self, request):
+        content_types.reset_stats()
+
+    def process_response(self, request, response):
+        stats = content_types.stats()
+        logger.debug('%s: %d content type lookups served from memory, %d queries' % (
+            request.path, stats['hits'], stats['queries']
+        ))
+        return response
+
+class VotesCookieMiddleware(object):
+    """
+    Replaces cookies of rated objects in the old unsigned format with signed
+    ones, install it while old cookies are understood, see
+    django_ratings.cookies.
+    """
+    def process_response(self, request, response):
+        from django_ratings.views import VOTES_ATTR, REISSUE_ATTR
+        if getattr(request, REISSUE_ATTR, False):
+            set_votes_cookie(response, getattr(request, VOTES_ATTR)[0])
+        return response
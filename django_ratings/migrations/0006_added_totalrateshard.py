@@ -0,0 +1,100 @@
+
+from south.db import db
+from django.db import models
+from django_ratings.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding model 'TotalRateShard'
+        db.create_table('django_ratings_totalrateshard', (
+            ('id', models.AutoField(primary_key=True)),
+            ('target_ct', models.ForeignKey(orm['contenttypes.ContentType'], db_index=True)),
+            ('target_id', models.PositiveIntegerField(_('Object ID'))),
+            ('shard', models.PositiveIntegerField(_('Shard'))),
+            ('amount', models.DecimalField(_('Amount'), max_digits=10, decimal_places=2)),
+        ))
+        db.send_create_signal('django_ratings', ['TotalRateShard'])
+        
+        # Creating unique_together for [target_ct, target_id, shard] on TotalRateShard.
+        db.create_unique('django_ratings_totalrateshard', ['target_ct_id', 'target_id', 'shard'])
+        
+    
+    
+    def backwards(self, orm):
+        # Deleting unique_together for [target_ct, target_id, shard] on TotalRateShard.
+        db.delete_unique('django_ratings_totalrateshard', ['target_ct_id', 'target_id', 'shard'])
+        
+        # Deleting model 'TotalRateShard'
+        db.delete_table('django_ratings_totalrateshard')
+    
+    
+    models = {
+        'django_ratings.rating': {
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('models.CharField', ["_('IP Address')"], {'max_length': '"15"', 'blank': 'True'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {'db_index': 'True'}),
+            'time': ('models.DateTimeField', ["_('Time')"], {'default': 'datetime.now', 'editable': 'False'}),
+            'user': ('models.ForeignKey', ['User'], {'null': 'True', 'blank': 'True'})
+        },
+        'auth.user': {
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        },
+        'django_ratings.agg': {
+            'Meta': {'ordering': "('-time',)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'detract': ('models.IntegerField', ["_('Detract')"], {'default': '0', 'max_length': '1'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'people': ('models.IntegerField', ["_('People')"], {}),
+            'period': ('models.CharField', ["_('Period')"], {'max_length': '"1"'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {'db_index': 'True'}),
+            'time': ('models.DateField', ["_('Time')"], {})
+        },
+        'django_ratings.userkarma': {
+            'karma': ('models.DecimalField', ["_('Karma')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'user': ('models.ForeignKey', ['User'], {'primary_key': 'True'})
+        },
+        'django_ratings.totalrate': {
+            'Meta': {'unique_together': "(('target_ct','target_id',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'django_ratings.watermark': {
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'name': ('models.CharField', ["_('Name')"], {'unique': 'True', 'max_length': '30'}),
+            'time': ('models.DateTimeField', ["_('Time')"], {'default': 'datetime.now'}),
+            'value': ('models.IntegerField', ["_('Value')"], {'default': '0'})
+        },
+        'django_ratings.leaderboard': {
+            'Meta': {'ordering': "('content_type','window','position',)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'content_type': ('models.ForeignKey', ['ContentType'], {'related_name': "'leaderboards'", 'null': 'True', 'blank': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'position': ('models.PositiveIntegerField', ["_('Position')"], {}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'related_name': "'leaderboard_entries'"}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {}),
+            'window': ('models.CharField', ["_('Window')"], {'max_length': '1'})
+        },
+        'django_ratings.totalrateshard': {
+            'Meta': {'unique_together': "(('target_ct','target_id','shard',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'shard': ('models.PositiveIntegerField', ["_('Shard')"], {}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label','model'),)", 'db_table': "'django_content_type'"},
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        }
+    }
+    
+    complete_apps = ['django_ratings']
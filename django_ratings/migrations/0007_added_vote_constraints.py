@@ -0,0 +1,162 @@
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from south.db import db
+from django.db import models, connection
+from django_ratings.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding model 'AnonymousVote'
+        db.create_table('django_ratings_anonymousvote', (
+            ('id', models.AutoField(primary_key=True)),
+            ('target_ct', models.ForeignKey(orm['contenttypes.ContentType'])),
+            ('target_id', models.PositiveIntegerField(_('Object ID'))),
+            ('ip_address', models.CharField(_('IP Address'), max_length="15")),
+            ('bucket', models.IntegerField(_('Bucket'))),
+        ))
+        db.send_create_signal('django_ratings', ['AnonymousVote'])
+        
+        # Recording votes of recent anonymous ratings
+        self.add_anonymous_votes(orm)
+        
+        # Creating unique_together for [target_ct, target_id, ip_address, bucket] on AnonymousVote.
+        db.create_unique('django_ratings_anonymousvote', ['target_ct_id', 'target_id', 'ip_address', 'bucket'])
+        
+        # Deleting duplicate ratings of users
+        self.delete_duplicate_ratings(orm)
+        
+        # Creating unique_together for [target_ct, target_id, user] on Rating.
+        db.create_unique('django_ratings_rating', ['target_ct_id', 'target_id', 'user_id'])
+        
+    
+    def add_anonymous_votes(self, orm):
+        """
+        Record anonymous ratings of the last MINIMAL_ANONYMOUS_IP_DELAY
+        seconds in AnonymousVote, so that their addresses can't vote again
+        right after the deploy.
+        """
+        since = datetime.now() - timedelta(seconds=MINIMAL_ANONYMOUS_IP_DELAY)
+        ratings = orm['django_ratings.Rating'].objects.filter(user__isnull=True, time__gte=since).exclude(ip_address='')
+        votes = set((target_ct_id, target_id, ip_address, get_vote_bucket(time)) for target_ct_id, target_id, ip_address, time in \
+                ratings.values_list('target_ct', 'target_id', 'ip_address', 'time'))
+        if not votes:
+            return
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.executemany('''INSERT INTO %s (target_ct_id, target_id, ip_address, bucket) VALUES (%%s, %%s, %%s, %%s)''' % \
+                qn('django_ratings_anonymousvote'), list(votes))
+    
+    def delete_duplicate_ratings(self, orm):
+        """
+        Keep only the first rating of every user and object, the old check
+        before insert let concurrent duplicates through. Their amounts are
+        subtracted from TotalRate.
+        """
+        Rating = orm['django_ratings.Rating']
+        TotalRate = orm['django_ratings.TotalRate']
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('''SELECT target_ct_id, target_id, user_id, MIN(id)
+                 FROM %s
+                 WHERE user_id IS NOT NULL
+                 GROUP BY target_ct_id, target_id, user_id
+                 HAVING COUNT(*) > 1''' % qn(Rating._meta.db_table))
+        for target_ct_id, target_id, user_id, first_id in cursor.fetchall():
+            duplicates = Rating.objects.filter(target_ct=target_ct_id, target_id=target_id, user=user_id).exclude(id=first_id)
+            amount = sum([Decimal(str(a)) for a in duplicates.values_list('amount', flat=True)])
+            duplicates.delete()
+            TotalRate.objects.filter(target_ct=target_ct_id, target_id=target_id).update(amount=models.F('amount') - amount)
+    
+    
+    def backwards(self, orm):
+        # Deleting unique_together for [target_ct, target_id, user] on Rating.
+        db.delete_unique('django_ratings_rating', ['target_ct_id', 'target_id', 'user_id'])
+        
+        # Deleting unique_together for [target_ct, target_id, ip_address, bucket] on AnonymousVote.
+        db.delete_unique('django_ratings_anonymousvote', ['target_ct_id', 'target_id', 'ip_address', 'bucket'])
+        
+        # Deleting model 'AnonymousVote'
+        db.delete_table('django_ratings_anonymousvote')
+    
+    
+    models = {
+        'django_ratings.rating': {
+            'Meta': {'unique_together': "(('target_ct','target_id','user',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('models.CharField', ["_('IP Address')"], {'max_length': '"15"', 'blank': 'True'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {'db_index': 'True'}),
+            'time': ('models.DateTimeField', ["_('Time')"], {'default': 'datetime.now', 'editable': 'False'}),
+            'user': ('models.ForeignKey', ['User'], {'null': 'True', 'blank': 'True'})
+        },
+        'auth.user': {
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        },
+        'django_ratings.agg': {
+            'Meta': {'ordering': "('-time',)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'detract': ('models.IntegerField', ["_('Detract')"], {'default': '0', 'max_length': '1'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'people': ('models.IntegerField', ["_('People')"], {}),
+            'period': ('models.CharField', ["_('Period')"], {'max_length': '"1"'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {'db_index': 'True'}),
+            'time': ('models.DateField', ["_('Time')"], {})
+        },
+        'django_ratings.userkarma': {
+            'karma': ('models.DecimalField', ["_('Karma')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'user': ('models.ForeignKey', ['User'], {'primary_key': 'True'})
+        },
+        'django_ratings.totalrate': {
+            'Meta': {'unique_together': "(('target_ct','target_id',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'django_ratings.watermark': {
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'name': ('models.CharField', ["_('Name')"], {'unique': 'True', 'max_length': '30'}),
+            'time': ('models.DateTimeField', ["_('Time')"], {'default': 'datetime.now'}),
+            'value': ('models.IntegerField', ["_('Value')"], {'default': '0'})
+        },
+        'django_ratings.leaderboard': {
+            'Meta': {'ordering': "('content_type','window','position',)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'content_type': ('models.ForeignKey', ['ContentType'], {'related_name': "'leaderboards'", 'null': 'True', 'blank': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'position': ('models.PositiveIntegerField', ["_('Position')"], {}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'related_name': "'leaderboard_entries'"}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {}),
+            'window': ('models.CharField', ["_('Window')"], {'max_length': '1'})
+        },
+        'django_ratings.totalrateshard': {
+            'Meta': {'unique_together': "(('target_ct','target_id','shard',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'shard': ('models.PositiveIntegerField', ["_('Shard')"], {}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'django_ratings.anonymousvote': {
+            'Meta': {'unique_together': "(('target_ct','target_id','ip_address','bucket',),)"},
+            'bucket': ('models.IntegerField', ["_('Bucket')"], {}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('models.CharField', ["_('IP Address')"], {'max_length': '"15"'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label','model'),)", 'db_table': "'django_content_type'"},
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        }
+    }
+    
+    complete_apps = ['django_ratings']
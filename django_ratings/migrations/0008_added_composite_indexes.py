@@ -0,0 +1,121 @@
+from south.db import db
+from django.db import models
+from django_ratings.models import *
+from django_ratings import indexes
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding index on 'Rating', fields ['time']
+        db.create_index('django_ratings_rating', ['time'])
+        
+        # Adding index on 'Rating', fields ['target_ct', 'time']
+        indexes.create_index(Rating, ('target_ct', 'time'))
+        
+        # Adding index on 'TotalRate', fields ['target_ct', 'amount']
+        indexes.create_index(TotalRate, ('target_ct', 'amount'))
+        
+        # Adding index on 'TotalRate', fields ['amount']
+        db.create_index('django_ratings_totalrate', ['amount'])
+        
+        # Adding index on 'AnonymousVote', fields ['bucket']
+        db.create_index('django_ratings_anonymousvote', ['bucket'])
+        
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting index on 'AnonymousVote', fields ['bucket']
+        db.delete_index('django_ratings_anonymousvote', ['bucket'])
+        
+        # Deleting index on 'TotalRate', fields ['amount']
+        db.delete_index('django_ratings_totalrate', ['amount'])
+        
+        # Deleting index on 'TotalRate', fields ['target_ct', 'amount']
+        indexes.drop_index(TotalRate, ('target_ct', 'amount'))
+        
+        # Deleting index on 'Rating', fields ['target_ct', 'time']
+        indexes.drop_index(Rating, ('target_ct', 'time'))
+        
+        # Deleting index on 'Rating', fields ['time']
+        db.delete_index('django_ratings_rating', ['time'])
+    
+    
+    models = {
+        'django_ratings.rating': {
+            'Meta': {'unique_together': "(('target_ct','target_id','user',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('models.CharField', ["_('IP Address')"], {'max_length': '"15"', 'blank': 'True'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {'db_index': 'True'}),
+            'time': ('models.DateTimeField', ["_('Time')"], {'default': 'datetime.now', 'editable': 'False', 'db_index': 'True'}),
+            'user': ('models.ForeignKey', ['User'], {'null': 'True', 'blank': 'True'})
+        },
+        'auth.user': {
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        },
+        'django_ratings.agg': {
+            'Meta': {'ordering': "('-time',)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'detract': ('models.IntegerField', ["_('Detract')"], {'default': '0', 'max_length': '1'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'people': ('models.IntegerField', ["_('People')"], {}),
+            'period': ('models.CharField', ["_('Period')"], {'max_length': '"1"'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {'db_index': 'True'}),
+            'time': ('models.DateField', ["_('Time')"], {})
+        },
+        'django_ratings.userkarma': {
+            'karma': ('models.DecimalField', ["_('Karma')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'user': ('models.ForeignKey', ['User'], {'primary_key': 'True'})
+        },
+        'django_ratings.totalrate': {
+            'Meta': {'unique_together': "(('target_ct','target_id',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2', 'db_index': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'django_ratings.watermark': {
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'name': ('models.CharField', ["_('Name')"], {'unique': 'True', 'max_length': '30'}),
+            'time': ('models.DateTimeField', ["_('Time')"], {'default': 'datetime.now'}),
+            'value': ('models.IntegerField', ["_('Value')"], {'default': '0'})
+        },
+        'django_ratings.leaderboard': {
+            'Meta': {'ordering': "('content_type','window','position',)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'content_type': ('models.ForeignKey', ['ContentType'], {'related_name': "'leaderboards'", 'null': 'True', 'blank': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'position': ('models.PositiveIntegerField', ["_('Position')"], {}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'related_name': "'leaderboard_entries'"}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {}),
+            'window': ('models.CharField', ["_('Window')"], {'max_length': '1'})
+        },
+        'django_ratings.totalrateshard': {
+            'Meta': {'unique_together': "(('target_ct','target_id','shard',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'shard': ('models.PositiveIntegerField', ["_('Shard')"], {}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'django_ratings.anonymousvote': {
+            'Meta': {'unique_together': "(('target_ct','target_id','ip_address','bucket',),)"},
+            'bucket': ('models.IntegerField', ["_('Bucket')"], {'db_index': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('models.CharField', ["_('IP Address')"], {'max_length': '"15"'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label','model'),)", 'db_table': "'django_content_type'"},
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        }
+    }
+    
+    complete_apps = ['django_ratings']
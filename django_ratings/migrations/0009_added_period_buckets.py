@@ -0,0 +1,127 @@
+from south.db import db
+from django.db import models
+from django_ratings.models import *
+from django_ratings import indexes
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding field 'Rating.day'
+        db.add_column('django_ratings_rating', 'day', models.IntegerField(_('Day'), default=0, editable=False))
+        
+        # Adding field 'Agg.bucket'
+        db.add_column('django_ratings_agg', 'bucket', models.IntegerField(_('Bucket'), default=0, editable=False))
+        
+        # Filling day keys of ratings
+        day, params = get_day_key_sql('time')
+        db.execute('UPDATE django_ratings_rating SET day = %s' % day, params)
+        
+        # Filling buckets of aggregations, the day key minus its remainder by the period's divisor
+        divisor = 'CASE period %s ELSE 1 END' % ' '.join(
+            "WHEN '%s' THEN %d" % (period, PERIOD_DIVISORS[name]) for period, name in PERIOD_CHOICES
+        )
+        day, params = get_day_key_sql('time')
+        db.execute('UPDATE django_ratings_agg SET bucket = %s - %s %%%% (%s)' % (day, day, divisor), params * 2)
+        
+        # Adding index on 'Agg', fields ['detract', 'bucket']
+        indexes.create_index(Agg, ('detract', 'bucket'))
+        
+        # Adding index on 'Agg', fields ['detract', 'time']
+        indexes.create_index(Agg, ('detract', 'time'))
+        
+    
+    def backwards(self, orm):
+        
+        # Deleting index on 'Agg', fields ['detract', 'time']
+        indexes.drop_index(Agg, ('detract', 'time'))
+        
+        # Deleting index on 'Agg', fields ['detract', 'bucket']
+        indexes.drop_index(Agg, ('detract', 'bucket'))
+        
+        # Deleting field 'Agg.bucket'
+        db.delete_column('django_ratings_agg', 'bucket')
+        
+        # Deleting field 'Rating.day'
+        db.delete_column('django_ratings_rating', 'day')
+    
+    
+    models = {
+        'django_ratings.rating': {
+            'Meta': {'unique_together': "(('target_ct','target_id','user',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('models.CharField', ["_('IP Address')"], {'max_length': '"15"', 'blank': 'True'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'day': ('models.IntegerField', ["_('Day')"], {'default': '0', 'editable': 'False'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {'db_index': 'True'}),
+            'time': ('models.DateTimeField', ["_('Time')"], {'default': 'datetime.now', 'editable': 'False', 'db_index': 'True'}),
+            'user': ('models.ForeignKey', ['User'], {'null': 'True', 'blank': 'True'})
+        },
+        'auth.user': {
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        },
+        'django_ratings.agg': {
+            'Meta': {'ordering': "('-time',)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'bucket': ('models.IntegerField', ["_('Bucket')"], {'default': '0', 'editable': 'False'}),
+            'detract': ('models.IntegerField', ["_('Detract')"], {'default': '0', 'max_length': '1'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'people': ('models.IntegerField', ["_('People')"], {}),
+            'period': ('models.CharField', ["_('Period')"], {'max_length': '"1"'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {'db_index': 'True'}),
+            'time': ('models.DateField', ["_('Time')"], {})
+        },
+        'django_ratings.userkarma': {
+            'karma': ('models.DecimalField', ["_('Karma')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'user': ('models.ForeignKey', ['User'], {'primary_key': 'True'})
+        },
+        'django_ratings.totalrate': {
+            'Meta': {'unique_together': "(('target_ct','target_id',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2', 'db_index': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'django_ratings.watermark': {
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'name': ('models.CharField', ["_('Name')"], {'unique': 'True', 'max_length': '30'}),
+            'time': ('models.DateTimeField', ["_('Time')"], {'default': 'datetime.now'}),
+            'value': ('models.IntegerField', ["_('Value')"], {'default': '0'})
+        },
+        'django_ratings.leaderboard': {
+            'Meta': {'ordering': "('content_type','window','position',)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'content_type': ('models.ForeignKey', ['ContentType'], {'related_name': "'leaderboards'", 'null': 'True', 'blank': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'position': ('models.PositiveIntegerField', ["_('Position')"], {}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'related_name': "'leaderboard_entries'"}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {}),
+            'window': ('models.CharField', ["_('Window')"], {'max_length': '1'})
+        },
+        'django_ratings.totalrateshard': {
+            'Meta': {'unique_together': "(('target_ct','target_id','shard',),)"},
+            'amount': ('models.DecimalField', ["_('Amount')"], {'max_digits': '10', 'decimal_places': '2'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'shard': ('models.PositiveIntegerField', ["_('Shard')"], {}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {'db_index': 'True'}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'django_ratings.anonymousvote': {
+            'Meta': {'unique_together': "(('target_ct','target_id','ip_address','bucket',),)"},
+            'bucket': ('models.IntegerField', ["_('Bucket')"], {'db_index': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('models.CharField', ["_('IP Address')"], {'max_length': '"15"'}),
+            'target_ct': ('models.ForeignKey', ['ContentType'], {}),
+            'target_id': ('models.PositiveIntegerField', ["_('Object ID')"], {})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label','model'),)", 'db_table': "'django_content_type'"},
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        }
+    }
+    
+    complete_apps = ['django_ratings']
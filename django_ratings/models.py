@@ -1,22 +1,59 @@
-from datetime import datetime, timedelta
+import operator
+import random
+from time import mktime
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 
-from django.db import models, connection
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models.signals import post_syncdb
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import ugettext_lazy as _
 
-from django_ratings import karma
+from django_ratings import karma, percentiles, caching, partitions, indexes
+from django_ratings.signals import total_rate_changed
+from django_ratings.content_types import content_types
+from django_ratings.instrumentation import instrumented
 
 # ratings - specific settings
 ANONYMOUS_KARMA = getattr(settings, 'ANONYMOUS_KARMA', 1)
 INITIAL_USER_KARMA = getattr(settings, 'ANONYMOUS_KARMA', 4)
 MINIMAL_ANONYMOUS_IP_DELAY = getattr(settings, 'MINIMAL_ANONYMOUS_IP_DELAY', 1800)
 RATINGS_COOKIE_NAME = getattr(settings, 'RATINGS_COOKIE_NAME', 'ratings_voted')
-RATINGS_MAX_COOKIE_LENGTH = getattr(settings, 'RATINGS_MAX_COOKIE_LENGTH', 20)
+# a vote takes 4-8 characters of the signed cookie, 100 of them fit in 1KB
+RATINGS_MAX_COOKIE_LENGTH = getattr(settings, 'RATINGS_MAX_COOKIE_LENGTH', 100)
 RATINGS_MAX_COOKIE_AGE = getattr(settings, 'RATINGS_MAX_COOKIE_AGE', 3600)
+# buffered vote ingestion, see django_ratings.buffer
+RATINGS_BUFFERED = getattr(settings, 'RATINGS_BUFFERED', False)
+RATINGS_BUFFER_SIZE = getattr(settings, 'RATINGS_BUFFER_SIZE', 100)
+RATINGS_BUFFER_TIMEOUT = getattr(settings, 'RATINGS_BUFFER_TIMEOUT', 5)
+# compute normalized ratings from in-memory index, see django_ratings.percentiles
+RATINGS_PERCENTILE_INDEX = getattr(settings, 'RATINGS_PERCENTILE_INDEX', False)
+# cache total rates, see django_ratings.caching
+RATINGS_CACHE = getattr(settings, 'RATINGS_CACHE', False)
+# materialized top rated lists, see Leaderboard
+RATINGS_LEADERBOARDS = getattr(settings, 'RATINGS_LEADERBOARDS', False)
+RATINGS_LEADERBOARD_SIZE = getattr(settings, 'RATINGS_LEADERBOARD_SIZE', 100)
+RATINGS_LEADERBOARD_LIVE = getattr(settings, 'RATINGS_LEADERBOARD_LIVE', False)
+# number of TotalRateShard rows per object for given 'app_label.model' content types,
+# normalized ratings and top objects only see the shards once they are folded
+RATINGS_TOTALRATE_SHARDS = getattr(settings, 'RATINGS_TOTALRATE_SHARDS', {})
+# remember recently rated objects in cache, see caching.VotedIndex
+RATINGS_VOTED_INDEX = getattr(settings, 'RATINGS_VOTED_INDEX', False)
+# keep karma up to date on every rating, see karma.KarmaDeltas
+RATINGS_KARMA_INCREMENTAL = getattr(settings, 'RATINGS_KARMA_INCREMENTAL', False)
+
+if RATINGS_PERCENTILE_INDEX and not caching.is_shared(caching.backend):
+    # invalidations by the aggregation job would never reach other processes
+    raise ImproperlyConfigured('RATINGS_PERCENTILE_INDEX requires a cache shared by all processes, '
+            'set CACHE_BACKEND or RATINGS_CACHE_BACKEND.')
+
+# attributes holding total rate and its rank fetched by TotalRateManager.prefetch_for_objects
+PREFETCHED_TOTAL_RATE = '_ratings_total_rate'
+PREFETCHED_RANK = '_ratings_rank'
 
 PERIOD_CHOICES = (
     ('d', 'day'),
@@ -24,15 +61,140 @@ PERIOD_CHOICES = (
     ('y', 'year'),
 )
 
+WINDOW_CHOICES = (
+    ('d', 'day'),
+    ('w', 'week'),
+    ('m', 'month'),
+    ('a', 'all time'),
+)
+WINDOW_DAYS = {'d': 1, 'w': 7, 'm': 30}
+
+# Agg buckets are YYYYMMDD integers, months and years have trailing zeros,
+# eg. 20090315, 20090300 and 20090000; a bucket of given period is computed
+# by subtracting the remainder after division by its divisor
+PERIOD_DIVISORS = {'day': 1, 'month': 100, 'year': 10000}
+
+# maximal number of object ids used in one IN clause
+TARGETS_CHUNK_SIZE = 500
+# maximal number of amounts ranked by one query
+RANKS_CHUNK_SIZE = 200
+
+def group_targets(targets, chunk_size=TARGETS_CHUNK_SIZE):
+    """
+    Group (target_ct_id, target_id) pairs by content type, yield
+    (target_ct_id, [target_id, ...]) with at most chunk_size ids each.
+    """
+    by_ct = {}
+    for target_ct_id, target_id in targets:
+        by_ct.setdefault(target_ct_id, set()).add(target_id)
+    for target_ct_id, ids in sorted(by_ct.items()):
+        ids = sorted(ids)
+        for i in range(0, len(ids), chunk_size):
+            yield target_ct_id, ids[i:i + chunk_size]
+
+def fetch_targets(targets, hints=None):
+    """
+    Return objects for given (target_ct_id, target_id) pairs in the same
+    order, using one query per model. Objects that no longer exist are
+    left out.
+
+    Params:
+        targets: iterable of (target_ct_id, target_id) pairs
+        hints: optional dict mapping model classes to dicts with
+            'select_related' and/or 'only' field lists for their queries
+    """
+    targets = list(targets)
+    hints = hints or {}
+    by_ct = {}
+    for target_ct_id, target_id in targets:
+        by_ct.setdefault(target_ct_id, []).append(target_id)
+
+    objects = {}
+    for target_ct_id, ids in by_ct.items():
+        model = content_types.get_model(target_ct_id)
+        qset = model._default_manager.all()
+        hint = hints.get(model, {})
+        if hint.get('select_related'):
+            qset = qset.select_related(*hint['select_related'])
+        if hint.get('only'):
+            qset = qset.only(*hint['only'])
+        for pk, obj in qset.in_bulk(ids).items():
+            objects[(target_ct_id, pk)] = obj
+
+    return [objects[t] for t in targets if t in objects]
+
 class UserKarmaManager(models.Manager):
-    def total_rate_to_karma(self):
+    def total_rate_to_karma(self, chunk_size=TARGETS_CHUNK_SIZE):
+        """
+        Recompute karma of all users from TotalRate of objects they own.
+
+        Owners are resolved in chunks of chunk_size objects, karma is summed
+        in memory and written with two executemany() calls.
+        """
+        karmas = {}
+        ct_ids = TotalRate.objects.order_by().values_list('target_ct', flat=True).distinct()
+        for ct_id in ct_ids:
+            if karma.sources.get_source_for_ct(ct_id) is None:
+                continue
+            amounts = dict(((ct_id, pk), amount) for pk, amount in \
+                    TotalRate.objects.filter(target_ct=ct_id).values_list('target_id', 'amount'))
+            for owner_id, k in karma.sources.get_karmas(amounts, chunk_size).items():
+                karmas[owner_id] = karmas.get(owner_id, 0) + k
+        self.set_karmas(karmas)
+
+    def add_karmas(self, karmas):
+        """
+        Add karma to users given as dict mapping user ids to karma deltas.
+
+        Users without karma get their record inserted one at a time, another
+        process may insert it meanwhile and then the karma is added to it.
+        """
+        qn = connection.ops.quote_name
+        ops = connection.ops
+        table = qn(self.model._meta.db_table)
+        update_sql = 'UPDATE %s SET karma = karma + %%s WHERE user_id = %%s' % table
+        insert_sql = 'INSERT INTO %s (user_id, karma) VALUES (%%s, %%s)' % table
+
+        existing = set(self.filter(user__in=karmas.keys()).values_list('user', flat=True))
+
+        cursor = connection.cursor()
+        updates = [(ops.value_to_db_decimal(Decimal(str(k)), 10, 2), user_id) for user_id, k in karmas.items() if user_id in existing]
+        if updates:
+            cursor.executemany(update_sql, updates)
+        for user_id, k in karmas.items():
+            if user_id in existing:
+                continue
+            k = ops.value_to_db_decimal(Decimal(str(k)), 10, 2)
+            sid = transaction.savepoint()
+            try:
+                cursor.execute(insert_sql, (user_id, k))
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                cursor.execute(update_sql, (k, user_id))
+            else:
+                transaction.savepoint_commit(sid)
+        transaction.commit_unless_managed()
+
+    def set_karmas(self, karmas):
+        """
+        Set karma of users given as dict mapping user ids to karma, karma of
+        all other users is set to 0.
+        """
+        qn = connection.ops.quote_name
+        ops = connection.ops
+        table = qn(self.model._meta.db_table)
+
+        existing = set(self.values_list('user', flat=True))
         self.all().update(karma=0)
-        for r in TotalRate.objects.filter(target_ct__in=karma.sources.registered_content_types()):
-            owner, weight = karma.sources.get_owner(r.target)
-            amount = r.amount * weight
-            updated = self.filter(user=owner).update(karma=models.F('karma') + amount)
-            if updated == 0:
-                self.create(user=owner, karma=amount)
+
+        cursor = connection.cursor()
+        updates = [(ops.value_to_db_decimal(Decimal(str(k)), 10, 2), user_id) for user_id, k in karmas.items() if user_id in existing]
+        if updates:
+            cursor.executemany('UPDATE %s SET karma = %%s WHERE user_id = %%s' % table, updates)
+        inserts = [(user_id, ops.value_to_db_decimal(Decimal(str(k)), 10, 2)) for user_id, k in karmas.items() if user_id not in existing]
+        if inserts:
+            cursor.executemany('INSERT INTO %s (user_id, karma) VALUES (%%s, %%s)' % table, inserts)
+        transaction.commit_unless_managed()
 
 class UserKarma(models.Model):
     user = models.ForeignKey(User, primary_key=True)
@@ -46,6 +208,42 @@ class UserKarma(models.Model):
 
 class TotalRateManager(models.Manager):
 
+    def add_amount(self, target_ct_id, target_id, amount):
+        """
+        Add amount to the total rate of given object, create the record if
+        the object has not been rated yet.
+        """
+        shards = get_shard_count(target_ct_id)
+        if shards > 1:
+            TotalRateShard.objects.add_amount(target_ct_id, target_id, random.randrange(shards), amount)
+        else:
+            self._add_amount(target_ct_id, target_id, amount)
+        if RATINGS_PERCENTILE_INDEX:
+            percentiles.index.update(target_ct_id, target_id, amount)
+        if RATINGS_CACHE:
+            caching.totals.invalidate(target_ct_id, target_id)
+        if RATINGS_LEADERBOARDS and RATINGS_LEADERBOARD_LIVE:
+            Leaderboard.objects.add_amount(target_ct_id, target_id, amount)
+        total_rate_changed.send(sender=self.model, target_ct_id=target_ct_id, target_id=target_id, amount=amount)
+
+    def _add_amount(self, target_ct_id, target_id, amount):
+        cnt = self.filter(target_ct=target_ct_id, target_id=target_id).update(amount=models.F('amount') + amount)
+        if cnt == 0:
+            self.create(target_ct_id=target_ct_id, target_id=target_id, amount=amount)
+
+    def add_amounts(self, ratings):
+        """
+        Denormalize amounts of given ratings into TotalRate, issuing only
+        one update per rated object.
+        """
+        deltas = {}
+        for r in ratings:
+            key = (r.target_ct_id, r.target_id)
+            deltas[key] = deltas.get(key, 0) + r.amount
+        for (target_ct_id, target_id), amount in deltas.items():
+            self.add_amount(target_ct_id, target_id, amount)
+
+    @instrumented('totalrate.get_normalized_rating')
     def get_normalized_rating(self, obj, top, step=None):
         """
         Returns rating normalized from min to top rounded to step
@@ -68,9 +266,15 @@ class TotalRateManager(models.Manager):
             op_gt = "lt"
             ref = -top
 
-        ct = ContentType.objects.get_for_model(obj)
-        more = self.filter(target_ct=ct, **{'amount__' + op_lt: total, 'amount__' + op_gt: 0 }).count()
-        total = self.filter(target_ct=ct, **{'amount__' + op_gt: 0 }).count()
+        ct = content_types.get_for_model(obj)
+        rank = getattr(obj, PREFETCHED_RANK, None)
+        if rank is None and RATINGS_PERCENTILE_INDEX:
+            rank = percentiles.index.get_rank(ct.pk, total)
+        if rank is not None:
+            more, total = rank
+        else:
+            more = self.filter(target_ct=ct, **{'amount__' + op_lt: total, 'amount__' + op_gt: 0 }).count()
+            total = self.filter(target_ct=ct, **{'amount__' + op_gt: 0 }).count()
 
         if total == 0:
             # First rating
@@ -81,11 +285,14 @@ class TotalRateManager(models.Manager):
         result = percentil * ref
         if step:
             result = (result / step).quantize(1) * step
+        # keep Decimal even when top is an int equal to the result
+        top = Decimal(str(top))
         result = max(-top, result)
         result = min(top, result)
         return result.quantize(1)
 
 
+    @instrumented('totalrate.get_for_object')
     def get_for_object(self, obj):
         """
         Return the agg rating for a given object.
@@ -93,26 +300,154 @@ class TotalRateManager(models.Manager):
         Params:
                 obj: object to work with
         """
-        content_type = ContentType.objects.get_for_model(obj)
+        if hasattr(obj, PREFETCHED_TOTAL_RATE):
+            return getattr(obj, PREFETCHED_TOTAL_RATE)
+        content_type = content_types.get_for_model(obj)
+        if RATINGS_CACHE:
+            amount, stamp = caching.totals.get(content_type.pk, obj.pk)
+            if amount is not None:
+                return amount
         try:
-            return self.values('amount').get(target_ct=content_type, target_id=obj.pk)['amount']
+            amount = self.values('amount').get(target_ct=content_type, target_id=obj.pk)['amount']
         except self.model.DoesNotExist:
-            return 0
+            amount = 0
+        if get_shard_count(content_type.pk) > 1:
+            amount += TotalRateShard.objects.get_sums(content_type.pk, [obj.pk]).get(obj.pk, 0)
+        if RATINGS_CACHE:
+            caching.totals.set(content_type.pk, obj.pk, amount, stamp)
+        return amount
+
+    def get_for_objects(self, objs):
+        """
+        Return dict mapping (content_type_id, pk) of given objects to their
+        agg ratings using one query. Objects without rating are mapped to 0.
+
+        Params:
+                objs: list or queryset of objects, models can be mixed
+        """
+        result = {}
+        by_ct = {}
+        for obj in objs:
+            ct_id = content_types.get_id(obj)
+            by_ct.setdefault(ct_id, set()).add(obj.pk)
+            result[(ct_id, obj.pk)] = 0
+
+        if RATINGS_CACHE and result:
+            cached, stamps = caching.totals.get_many(result.keys())
+            result.update(cached)
+            for ct_id, object_id in cached:
+                by_ct[ct_id].discard(object_id)
+                if not by_ct[ct_id]:
+                    del by_ct[ct_id]
+
+        if not by_ct:
+            return result
 
+        q = reduce(operator.or_, [models.Q(target_ct=ct_id, target_id__in=ids) for ct_id, ids in by_ct.items()])
+        for target_ct_id, target_id, amount in self.filter(q).values_list('target_ct', 'target_id', 'amount'):
+            result[(target_ct_id, target_id)] = amount
+        for ct_id, ids in by_ct.items():
+            if get_shard_count(ct_id) > 1:
+                for target_id, amount in TotalRateShard.objects.get_sums(ct_id, ids).items():
+                    result[(ct_id, target_id)] += amount
 
-    def get_top_objects(self, count, mods=[]):
+        if RATINGS_CACHE:
+            amounts = {}
+            for ct_id, ids in by_ct.items():
+                for object_id in ids:
+                    amounts[(ct_id, object_id)] = result[(ct_id, object_id)]
+            caching.totals.set_many(amounts, stamps)
+        return result
+
+    def get_ranks(self, target_ct_id, amounts, chunk_size=RANKS_CHUNK_SIZE):
+        """
+        Return dict mapping given non-zero amounts to tuples (worse, total)
+        where total is the number of objects of given content type with
+        amount of the same sign and worse is the number of those that are
+        closer to zero, as counted by get_normalized_rating. Uses one query
+        per chunk_size amounts.
+        """
+        qn = connection.ops.quote_name
+        ops = connection.ops
+        table = qn(self.model._meta.db_table)
+
+        amounts = sorted(set(amounts))
+        ranks = {}
+        for i in range(0, len(amounts), chunk_size):
+            chunk = amounts[i:i + chunk_size]
+            selects = [
+                'SELECT 0, COUNT(*) FROM %s WHERE target_ct_id = %%s AND amount > 0' % table,
+                'SELECT 1, COUNT(*) FROM %s WHERE target_ct_id = %%s AND amount < 0' % table,
+            ]
+            params = [target_ct_id, target_ct_id]
+            for j, amount in enumerate(chunk):
+                if amount > 0:
+                    where = 'amount > 0 AND amount < %s'
+                else:
+                    where = 'amount > %s AND amount < 0'
+                selects.append('SELECT %d, COUNT(*) FROM %s WHERE target_ct_id = %%s AND %s' % (j + 2, table, where))
+                params.extend([target_ct_id, ops.value_to_db_decimal(Decimal(str(amount)), 10, 2)])
+
+            cursor = connection.cursor()
+            cursor.execute(' UNION ALL '.join(selects), params)
+            counts = dict(cursor.fetchall())
+            for j, amount in enumerate(chunk):
+                ranks[amount] = counts[j + 2], amount > 0 and counts[0] or counts[1]
+        return ranks
+
+    def prefetch_for_objects(self, objs, attr=None):
+        """
+        Fetch agg ratings for all given objects at once and remember them on
+        the objects, so that following get_for_object calls don't hit the
+        database. Unless RATINGS_PERCENTILE_INDEX is set, ranks of the
+        ratings are fetched as well - with one query per content type - for
+        get_normalized_rating.
+
+        Params:
+                objs: list or queryset of objects, models can be mixed
+                attr: if given, also store the rating as this attribute
+        """
+        objs = list(objs)
+        ratings = self.get_for_objects(objs)
+
+        ranks = {}
+        if not RATINGS_PERCENTILE_INDEX:
+            by_ct = {}
+            for (ct_id, object_id), amount in ratings.items():
+                if amount:
+                    by_ct.setdefault(ct_id, set()).add(amount)
+            for ct_id, amounts in by_ct.items():
+                for amount, rank in self.get_ranks(ct_id, amounts).items():
+                    ranks[(ct_id, amount)] = rank
+
+        for obj in objs:
+            ct_id = content_types.get_id(obj)
+            amount = ratings[(ct_id, obj.pk)]
+            setattr(obj, PREFETCHED_TOTAL_RATE, amount)
+            if (ct_id, amount) in ranks:
+                setattr(obj, PREFETCHED_RANK, ranks[(ct_id, amount)])
+            if attr:
+                setattr(obj, attr, amount)
+        return objs
+
+
+    @instrumented('totalrate.get_top_objects')
+    def get_top_objects(self, count, mods=[], hints=None):
         """
         Return count objects with the highest rating.
 
         Params:
             count: number of objects to return
             mods: if specified, limit the result to given model classes
+            hints: optional dict mapping model classes to dicts with
+                'select_related' and/or 'only' field lists used when
+                fetching objects of that model, see fetch_targets
         """
         qset = self.order_by('-amount')
         kw = {}
         if mods:
-            kw['target_ct__in'] = [ContentType.objects.get_for_model(m).pk for m in mods]
-        return [o.target for o in qset.filter(**kw)[:count]]
+            kw['target_ct__in'] = [content_types.get_id(m) for m in mods]
+        return fetch_targets(qset.filter(**kw).values_list('target_ct', 'target_id')[:count], hints)
 
 class TotalRate(models.Model):
     """
@@ -121,10 +456,13 @@ class TotalRate(models.Model):
     target_ct = models.ForeignKey(ContentType, db_index=True)
     target_id = models.PositiveIntegerField(_('Object ID'))
     target = generic.GenericForeignKey('target_ct', 'target_id')
-    amount = models.DecimalField(_('Amount'), max_digits=10, decimal_places=2)
+    amount = models.DecimalField(_('Amount'), max_digits=10, decimal_places=2, db_index=True)
 
     objects = TotalRateManager()
 
+    # normalized ratings and top objects of one model, see django_ratings.indexes
+    composite_indexes = (('target_ct', 'amount'),)
+
     def __unicode__(self):
         return u'%s points for %s' % (self.amount, self.target)
 
@@ -135,46 +473,392 @@ class TotalRate(models.Model):
 
 
 
+_shard_counts = None
+
+def get_day_key(time):
+    "Return YYYYMMDD integer of given date or datetime."
+    return time.year * 10000 + time.month * 100 + time.day
+
+def get_bucket_time(bucket):
+    "Return the first day of given bucket."
+    return date(bucket // 10000, bucket // 100 % 100 or 1, bucket % 100 or 1)
+
+def get_day_key_sql(column):
+    """
+    Return tuple (sql, params) of SQL expression computing get_day_key of
+    given date or datetime column.
+    """
+    qn = connection.ops.quote_name
+    engine = settings.DATABASE_ENGINE
+    if engine == 'sqlite3':
+        return 'CAST(strftime(%%s, %s) AS INTEGER)' % qn(column), ['%Y%m%d']
+    elif engine == 'mysql':
+        return 'CAST(DATE_FORMAT(%s, %%s) AS SIGNED)' % qn(column), ['%Y%m%d']
+    return 'CAST(to_char(%s, %%s) AS INTEGER)' % qn(column), ['YYYYMMDD']
+
+def get_bucket_sql(column, time_format):
+    """
+    Return SQL expression computing bucket of given period from column holding
+    day keys or buckets, ready to be used in a query with parameters.
+    """
+    qn = connection.ops.quote_name
+    divisor = PERIOD_DIVISORS[time_format]
+    if divisor == 1:
+        return qn(column)
+    return '(%s - %s %%%% %d)' % (qn(column), qn(column), divisor)
+
+def get_shard_count(target_ct_id):
+    """
+    Return number of TotalRateShard rows used for objects of given content
+    type, see RATINGS_TOTALRATE_SHARDS.
+    """
+    global _shard_counts
+    if not RATINGS_TOTALRATE_SHARDS:
+        return 1
+    if _shard_counts is None:
+        counts = {}
+        for label, count in RATINGS_TOTALRATE_SHARDS.items():
+            model = models.get_model(*label.split('.', 1))
+            if model is None:
+                raise ImproperlyConfigured('RATINGS_TOTALRATE_SHARDS refers to unknown model %r.' % label)
+            counts[content_types.get_id(model)] = count
+        _shard_counts = counts
+    return _shard_counts.get(target_ct_id, 1)
+
+class TotalRateShardManager(models.Manager):
+
+    def add_amount(self, target_ct_id, target_id, shard, amount):
+        cnt = self.filter(target_ct=target_ct_id, target_id=target_id, shard=shard).update(amount=models.F('amount') + amount)
+        if cnt == 0:
+            self.create(target_ct_id=target_ct_id, target_id=target_id, shard=shard, amount=amount)
+
+    def get_sums(self, target_ct_id, target_ids):
+        """
+        Return dict mapping given object ids to sums of their shards.
+        """
+        qset = self.filter(target_ct=target_ct_id, target_id__in=target_ids).values('target_id').annotate(amount_sum=models.Sum('amount'))
+        return dict((row['target_id'], row['amount_sum']) for row in qset)
+
+    def fold(self):
+        """
+        Add amounts collected in shards to TotalRate. Shard rows are
+        decremented rather than deleted so that votes coming in meanwhile
+        are not lost.
+        """
+        qn = connection.ops.quote_name
+        ops = connection.ops
+        rows = list(self.exclude(amount=0).values_list('id', 'target_ct', 'target_id', 'amount'))
+
+        deltas = {}
+        for pk, target_ct_id, target_id, amount in rows:
+            deltas[(target_ct_id, target_id)] = deltas.get((target_ct_id, target_id), 0) + amount
+        for (target_ct_id, target_id), amount in deltas.items():
+            TotalRate.objects._add_amount(target_ct_id, target_id, amount)
+
+        sql = '''UPDATE %(shard_table)s SET amount = amount - %%s WHERE id = %%s''' % {
+            'shard_table': qn(self.model._meta.db_table),
+        }
+        cursor = connection.cursor()
+        cursor.executemany(sql, [(ops.value_to_db_decimal(amount, 10, 2), pk) for pk, target_ct_id, target_id, amount in rows])
+        return len(deltas)
+
+    def reset(self, target_ct_id=None, target_ids=None):
+        """
+        Zero shards of objects whose TotalRate is being rebuilt from Agg,
+        their ratings are already counted there. Without target_ct_id all
+        shards are reset, without target_ids all shards of the content type.
+        """
+        qn = connection.ops.quote_name
+        where, params = ['amount <> 0'], []
+        if target_ct_id is not None:
+            where.append('target_ct_id = %s')
+            params.append(target_ct_id)
+        if target_ids is not None:
+            where.append('target_id IN (%s)' % ', '.join(['%s'] * len(target_ids)))
+            params.extend(target_ids)
+
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET amount = 0 WHERE %s' % (qn(self.model._meta.db_table), ' AND '.join(where)), params)
+
+class TotalRateShard(models.Model):
+    """
+    Part of total rate of an object, spreading updates of very popular
+    objects over more rows. See RATINGS_TOTALRATE_SHARDS.
+    """
+    target_ct = models.ForeignKey(ContentType, db_index=True)
+    target_id = models.PositiveIntegerField(_('Object ID'))
+    target = generic.GenericForeignKey('target_ct', 'target_id')
+    shard = models.PositiveIntegerField(_('Shard'))
+    amount = models.DecimalField(_('Amount'), max_digits=10, decimal_places=2)
+
+    objects = TotalRateShardManager()
+
+    def __unicode__(self):
+        return u'%s points for %s (shard %s)' % (self.amount, self.target, self.shard)
+
+    class Meta:
+        verbose_name = _('Total rate shard')
+        verbose_name_plural = _('Total rate shards')
+        unique_together = (('target_ct', 'target_id', 'shard',),)
+
+
+class LeaderboardManager(models.Manager):
+
+    def refresh(self, size=RATINGS_LEADERBOARD_SIZE, now=None):
+        """
+        Recompute all leaderboards - one across all content types and one
+        for every rated content type, for each window from WINDOW_CHOICES.
+
+        New entries are computed first and replace the old ones within one
+        transaction, so readers never see empty leaderboards.
+
+        size: number of objects kept on every leaderboard
+        """
+        now = now or datetime.now()
+        qn = connection.ops.quote_name
+        ops = connection.ops
+
+        window_sql = '''SELECT
+                    target_ct_id, target_id, SUM(amount)
+                 FROM (
+                    SELECT target_ct_id, target_id, amount FROM %(agg_table)s WHERE time >= %%s
+                    UNION ALL
+                    SELECT target_ct_id, target_id, amount FROM %(rating_table)s WHERE time >= %%s
+                 ) window_rates
+                 %(where)s
+                 GROUP BY target_ct_id, target_id
+                 ORDER BY 3 DESC
+                 LIMIT %(size)d'''
+        insert_sql = '''INSERT INTO %(leaderboard_table)s
+                    (content_type_id, %(window)s, position, target_ct_id, target_id, amount)
+                 VALUES
+                    (%%s, %%s, %%s, %%s, %%s, %%s)''' % {
+            'leaderboard_table': qn(self.model._meta.db_table),
+            'window': qn('window'),
+        }
+
+        ct_ids = [None] + list(TotalRate.objects.values_list('target_ct', flat=True).distinct())
+        cursor = connection.cursor()
+        entries = []
+        for window, name in WINDOW_CHOICES:
+            for ct_id in ct_ids:
+                if window in WINDOW_DAYS:
+                    since = now - timedelta(days=WINDOW_DAYS[window])
+                    where, params = '', [ops.value_to_db_date(since.date()), ops.value_to_db_datetime(since)]
+                    if ct_id is not None:
+                        where = 'WHERE target_ct_id = %s'
+                        params.append(ct_id)
+                    cursor.execute(window_sql % {
+                        'agg_table': qn(Agg._meta.db_table),
+                        'rating_table': qn(Rating._meta.db_table),
+                        'where': where,
+                        'size': size,
+                    }, params)
+                    rows = [r for r in cursor.fetchall() if r[2] > 0]
+                else:
+                    qset = TotalRate.objects.filter(amount__gt=0).order_by('-amount')
+                    if ct_id is not None:
+                        qset = qset.filter(target_ct=ct_id)
+                    rows = qset.values_list('target_ct', 'target_id', 'amount')[:size]
+
+                entries.extend([
+                        (ct_id, window, position, target_ct_id, target_id, ops.value_to_db_decimal(Decimal(str(amount)), 10, 2))
+                        for position, (target_ct_id, target_id, amount) in enumerate(rows)
+                    ])
+
+        cursor.execute('DELETE FROM %s' % qn(self.model._meta.db_table))
+        cursor.executemany(insert_sql, entries)
+        transaction.commit_unless_managed()
+
+    def add_amount(self, target_ct_id, target_id, amount):
+        """
+        Add amount to all entries of given object, objects that are not on
+        a leaderboard will only get there with the next refresh.
+        """
+        self.filter(target_ct=target_ct_id, target_id=target_id).update(amount=models.F('amount') + amount)
+
+    def get_top_objects(self, count, mods=[], window='a', hints=None):
+        """
+        Return count objects with the highest rating in given window.
+
+        Params:
+            count: number of objects to return, at most RATINGS_LEADERBOARD_SIZE
+            mods: if specified, limit the result to given model classes
+            window: one of WINDOW_CHOICES
+            hints: see fetch_targets
+        """
+        boards = [None]
+        if mods:
+            boards = [content_types.get_id(m) for m in mods]
+
+        entries = []
+        for ct_id in boards:
+            qset = self.filter(window=window).order_by('-amount', 'position')
+            if ct_id is None:
+                qset = qset.filter(content_type__isnull=True)
+            else:
+                qset = qset.filter(content_type=ct_id)
+            entries.extend(qset.values_list('amount', 'target_ct', 'target_id')[:count])
+
+        if len(boards) > 1:
+            entries.sort(reverse=True)
+        return fetch_targets([(target_ct_id, target_id) for amount, target_ct_id, target_id in entries[:count]], hints)
+
+class Leaderboard(models.Model):
+    """
+    Precomputed list of top rated objects of given content type (or of all
+    content types) in given time window.
+    """
+    content_type = models.ForeignKey(ContentType, null=True, blank=True, related_name='leaderboards')
+    window = models.CharField(_('Window'), max_length=1, choices=WINDOW_CHOICES)
+    position = models.PositiveIntegerField(_('Position'))
+
+    target_ct = models.ForeignKey(ContentType, related_name='leaderboard_entries')
+    target_id = models.PositiveIntegerField(_('Object ID'))
+    target = generic.GenericForeignKey('target_ct', 'target_id')
+    amount = models.DecimalField(_('Amount'), max_digits=10, decimal_places=2)
+
+    objects = LeaderboardManager()
+
+    def __unicode__(self):
+        return u'%s. %s' % (self.position + 1, self.target)
+
+    class Meta:
+        verbose_name = _('Leaderboard entry')
+        verbose_name_plural = _('Leaderboard entries')
+        ordering = ('content_type', 'window', 'position',)
+
+
+class WatermarkManager(models.Manager):
+
+    def get_value(self, name):
+        """
+        Return value stored under given name, 0 if there is none.
+        """
+        try:
+            return self.values('value').get(name=name)['value']
+        except self.model.DoesNotExist:
+            return 0
+
+    def set_value(self, name, value):
+        """
+        Store value under given name.
+        """
+        updated = self.filter(name=name).update(value=value, time=datetime.now())
+        if updated == 0:
+            self.create(name=name, value=value)
+
+class Watermark(models.Model):
+    """
+    Remembers how far the aggregation jobs got, typically the highest
+    primary key already processed.
+    """
+    name = models.CharField(_('Name'), max_length=30, unique=True)
+    value = models.IntegerField(_('Value'), default=0)
+    time = models.DateTimeField(_('Time'), default=datetime.now)
+
+    objects = WatermarkManager()
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.value)
+
+    class Meta:
+        verbose_name = _('Watermark')
+        verbose_name_plural = _('Watermarks')
+
+
 class AggManager(models.Manager):
 
-    def move_agg_to_agg(self, time_limit, time_format):
+    def get_movable(self, time_limit, target_ct_id=None):
+        "Return Agg records move_agg_to_agg would move."
+        qset = self.filter(bucket__lte=get_day_key(time_limit), detract=0)
+        if target_ct_id is not None:
+            qset = qset.filter(target_ct=target_ct_id)
+        return qset
+
+    def move_agg_to_agg(self, time_limit, time_format, target_ct_id=None):
         """
         Coppy aggregated Agg data to table Agg
 
         time_limit: limit for time of transfering data
 
-        time_format: format for date_trunc
+        time_format: period to aggregate to, one of PERIOD_DIVISORS
+
+        target_ct_id: if given, only Agg of this content type is moved
         """
         qn = connection.ops.quote_name
-        date_trunc = connection.ops.date_trunc_sql
+        params = [get_day_key(time_limit)]
+        qset = self.get_movable(time_limit, target_ct_id)
+        where = ''
+        if target_ct_id is not None:
+            where = 'AND target_ct_id = %s'
+            params.append(target_ct_id)
 
         sql = '''INSERT INTO %(agg_table)s
-                    (detract, period, people, amount, time, target_ct_id, target_id)
+                    (detract, period, people, amount, time, bucket, target_ct_id, target_id)
                  SELECT
-                    1, %%s, SUM(people), SUM(amount), %(truncated_date)s, target_ct_id, target_id
+                    1, %%s, SUM(people), SUM(amount), MIN(time), %(bucket)s, target_ct_id, target_id
                  FROM
                     %(agg_table)s
                  WHERE
-                    time <= %%s AND detract = 0
+                    detract = 0 AND bucket <= %%s %(where)s
                  GROUP BY
-                    target_ct_id, target_id, %(truncated_date)s''' % {
+                    target_ct_id, target_id, %(bucket)s''' % {
             'agg_table' : qn(Agg._meta.db_table),
-            'truncated_date': date_trunc(time_format, qn('time')),
+            'bucket': get_bucket_sql('bucket', time_format),
+            'where': where,
+        }
+        buckets_sql = '''SELECT DISTINCT %(bucket)s
+                 FROM %(agg_table)s
+                 WHERE detract = 0 AND bucket <= %%s %(where)s''' % {
+            'agg_table' : qn(Agg._meta.db_table),
+            'bucket': get_bucket_sql('bucket', time_format),
+            'where': where,
         }
 
         cursor = connection.cursor()
-        cursor.execute(sql, (time_format[0], time_limit,))
-        self.filter(time__lte=time_limit, detract=0).delete()
+        cursor.execute(buckets_sql, params)
+        buckets = [row[0] for row in cursor.fetchall()]
+        cursor.execute(sql, [time_format[0]] + params)
+        qset.delete()
+        self.fix_times(time_format, buckets, target_ct_id)
 
-    def agg_assume(self):
+    def fix_times(self, time_format, buckets, target_ct_id=None):
+        """
+        Set time of Agg records of given period and buckets to the first day
+        of their bucket, one UPDATE per bucket.
+
+        target_ct_id: if given, only Agg of this content type is updated
+        """
+        qset = self.filter(period=time_format[0])
+        if target_ct_id is not None:
+            qset = qset.filter(target_ct=target_ct_id)
+        for bucket in buckets:
+            qset.filter(bucket=bucket).update(time=get_bucket_time(bucket))
+
+    def agg_assume(self, target_ct_id=None):
         """
         update objects field detract for futhure possibility aggregation
         """
-        self.all().update(detract=0)
+        qset = self.all()
+        if target_ct_id is not None:
+            qset = qset.filter(target_ct=target_ct_id)
+        qset.update(detract=0)
 
-    def agg_to_totalrate(self):
+    def agg_to_totalrate(self, targets=None, target_ct_id=None):
         """
         Transfer aggregation data from table Agg to table TotalRate
+
+        targets: if given, only recompute TotalRate for these
+            (target_ct_id, target_id) pairs, their old TotalRate records are
+            replaced. Otherwise TotalRate is expected to be empty.
+
+        target_ct_id: if given instead of targets, TotalRate of all objects
+            of this content type is replaced
+
+        TotalRateShard of recomputed objects is reset, otherwise ratings
+        counted in a shard and moved to Agg since the last fold would be
+        counted twice.
         """
         qn = connection.ops.quote_name
 
@@ -184,14 +868,32 @@ class AggManager(models.Manager):
                     SUM(amount), target_ct_id, target_id
                  FROM
                     %(tab_agg)s
+                 %(where)s
                  GROUP BY
-                    target_ct_id, target_id''' % {
+                    target_ct_id, target_id'''
+        params = {
             'tab_agg' : qn(Agg._meta.db_table),
-            'tab_tr' : qn(TotalRate._meta.db_table)
+            'tab_tr' : qn(TotalRate._meta.db_table),
+            'where': '',
         }
 
         cursor = connection.cursor()
-        cursor.execute(sql, ())
+        if targets is None and target_ct_id is not None:
+            TotalRate.objects.filter(target_ct=target_ct_id).delete()
+            params['where'] = 'WHERE target_ct_id = %s'
+            TotalRateShard.objects.reset(target_ct_id)
+            cursor.execute(sql % params, (target_ct_id,))
+            return
+        if targets is None:
+            TotalRateShard.objects.reset()
+            cursor.execute(sql % params, ())
+            return
+
+        for target_ct_id, ids in group_targets(targets):
+            TotalRate.objects.filter(target_ct=target_ct_id, target_id__in=ids).delete()
+            TotalRateShard.objects.reset(target_ct_id, ids)
+            params['where'] = 'WHERE target_ct_id = %%s AND target_id IN (%s)' % ', '.join(['%s'] * len(ids))
+            cursor.execute(sql % params, [target_ct_id] + ids)
 
 
 class Agg(models.Model):
@@ -203,6 +905,7 @@ class Agg(models.Model):
     target = generic.GenericForeignKey('target_ct', 'target_id')
 
     time = models.DateField(_('Time'))
+    bucket = models.IntegerField(_('Bucket'), default=0, editable=False)
     people = models.IntegerField(_('People'))
     amount = models.DecimalField(_('Amount'), max_digits=10, decimal_places=2)
     period = models.CharField(_('Period'), max_length="1", choices=PERIOD_CHOICES)
@@ -210,6 +913,8 @@ class Agg(models.Model):
 
     objects = AggManager()
 
+    composite_indexes = (('detract', 'bucket'), ('detract', 'time'),)
+
     def __unicode__(self):
         return u'%s points for %s' % (self.amount, self.target)
 
@@ -218,9 +923,153 @@ class Agg(models.Model):
         verbose_name_plural = _('Aggregations')
         ordering = ('-time',)
 
+    def save(self, **kwargs):
+        if not self.bucket:
+            divisor = PERIOD_DIVISORS[dict(PERIOD_CHOICES)[self.period]]
+            day = get_day_key(self.time)
+            self.bucket = day - day % divisor
+        super(Agg, self).save(**kwargs)
+
+
+# statuses of ratings passed to RatingManager.bulk_rate
+RATING_ACCEPTED = 'accepted'
+RATING_DUPLICATE = 'duplicate'
+
+# number of ratings checked and inserted at once by RatingManager.bulk_rate
+BULK_RATE_CHUNK_SIZE = 1000
 
 class RatingManager(models.Manager):
 
+    def bulk_rate(self, ratings, chunk_size=BULK_RATE_CHUNK_SIZE):
+        """
+        Save given unsaved ratings in batches of chunk_size ratings, return
+        list of their statuses, RATING_ACCEPTED or RATING_DUPLICATE, in the
+        order of ratings.
+
+        Every batch is checked for duplicities with a couple of set based
+        queries, inserted with executemany() and TotalRate is updated once
+        per rated object. If a conflicting rating gets inserted meanwhile,
+        the batch is saved one rating at a time instead. Transactions are up
+        to the caller.
+        """
+        statuses = []
+        batch = []
+        for rating in ratings:
+            batch.append(rating)
+            if len(batch) >= chunk_size:
+                statuses.extend(self._rate_batch(batch))
+                batch = []
+        if batch:
+            statuses.extend(self._rate_batch(batch))
+        return statuses
+
+    def _rate_batch(self, ratings):
+        for r in ratings:
+            if r.time is None:
+                r.time = datetime.now()
+        duplicates = self._get_duplicates(ratings)
+        accepted = [r for r, duplicate in zip(ratings, duplicates) if not duplicate]
+
+        sid = transaction.savepoint()
+        try:
+            AnonymousVote.objects.insert_many(accepted)
+            self.insert_many(accepted)
+        except IntegrityError:
+            # somebody else inserted a conflicting rating meanwhile
+            transaction.savepoint_rollback(sid)
+            statuses = []
+            for r in ratings:
+                r.save()
+                statuses.append(r.pk and RATING_ACCEPTED or RATING_DUPLICATE)
+            return statuses
+        transaction.savepoint_commit(sid)
+
+        TotalRate.objects.add_amounts(accepted)
+        for r in accepted:
+            r.remember_voter()
+        return [duplicate and RATING_DUPLICATE or RATING_ACCEPTED for duplicate in duplicates]
+
+    def _get_duplicates(self, ratings):
+        """
+        Return list of flags telling which of given ratings would be refused
+        by Rating.save(), both the database and the ratings themselves are
+        checked for duplicities. Ratings found in the index of recently rated
+        objects are refused without querying the database.
+        """
+        known = set()
+        if RATINGS_VOTED_INDEX:
+            votes = [(get_voter(r.user_id, r.ip_address, r.time)[0], r.target_ct_id, r.target_id) for r in ratings]
+            indexed = caching.voted.contains_many([v for v in votes if v[0]])
+            known = set(id(r) for r, v in zip(ratings, votes) if v in indexed)
+
+        user_ratings = [r for r in ratings if r.user_id and id(r) not in known]
+        ip_ratings = [r for r in ratings if not r.user_id and r.ip_address and id(r) not in known]
+
+        voted = set()
+        if user_ratings:
+            voted.update(self.filter(
+                    target_ct__in=set(r.target_ct_id for r in user_ratings),
+                    target_id__in=set(r.target_id for r in user_ratings),
+                    user__in=set(r.user_id for r in user_ratings),
+                ).values_list('target_ct', 'target_id', 'user'))
+
+        ip_voted = set()
+        if ip_ratings:
+            ip_voted.update(AnonymousVote.objects.filter(
+                    target_ct__in=set(r.target_ct_id for r in ip_ratings),
+                    target_id__in=set(r.target_id for r in ip_ratings),
+                    ip_address__in=set(r.ip_address for r in ip_ratings),
+                    bucket__in=set(get_vote_bucket(r.time) for r in ip_ratings),
+                ).values_list('target_ct', 'target_id', 'ip_address', 'bucket'))
+
+        duplicates = []
+        for r in ratings:
+            if id(r) in known:
+                duplicates.append(True)
+                continue
+            if r.user_id:
+                key, keys = (r.target_ct_id, r.target_id, r.user_id), voted
+            elif r.ip_address:
+                key, keys = (r.target_ct_id, r.target_id, r.ip_address, get_vote_bucket(r.time)), ip_voted
+            else:
+                duplicates.append(False)
+                continue
+            duplicates.append(key in keys)
+            keys.add(key)
+        return duplicates
+
+    def insert_many(self, ratings):
+        """
+        Insert given ratings using one executemany() call.
+
+        No duplicity checks are performed and TotalRate is not touched, see
+        bulk_rate for a method that takes care of both.
+        """
+        if not ratings:
+            return
+        qn = connection.ops.quote_name
+        ops = connection.ops
+
+        sql = '''INSERT INTO %(rating_table)s
+                    (target_ct_id, target_id, time, day, user_id, amount, ip_address)
+                 VALUES
+                    (%%s, %%s, %%s, %%s, %%s, %%s, %%s)''' % {
+            'rating_table' : qn(Rating._meta.db_table),
+        }
+
+        params = [(
+                r.target_ct_id,
+                r.target_id,
+                ops.value_to_db_datetime(r.time),
+                get_day_key(r.time),
+                r.user_id,
+                ops.value_to_db_decimal(Decimal(str(r.amount)), 10, 2),
+                r.ip_address or '',
+            ) for r in ratings]
+
+        cursor = connection.cursor()
+        cursor.executemany(sql, params)
+
     def get_for_object(self, obj):
         """
         Return the rating for a given object.
@@ -228,38 +1077,183 @@ class RatingManager(models.Manager):
         Params:
             obj: object to work with
         """
-        content_type = ContentType.objects.get_for_model(obj)
+        content_type = content_types.get_for_model(obj)
         aggs = self.filter(target_ct=content_type, target_id=obj.pk).aggregate(amount_sum=models.Sum('amount'))['amount_sum']
         if aggs is None:
             return 0
         return aggs
 
-    def move_rate_to_agg(self, time_limit, time_format):
+    def rate_to_totalrate(self):
+        """
+        Add sums of ratings not moved to Agg yet to TotalRate, used when
+        TotalRate is rebuilt from Agg by AggManager.agg_to_totalrate.
+        """
+        qn = connection.ops.quote_name
+        params = {
+            'tab_rate': qn(self.model._meta.db_table),
+            'tab_tr': qn(TotalRate._meta.db_table),
+        }
+        cursor = connection.cursor()
+        cursor.execute('''UPDATE %(tab_tr)s
+                 SET amount = amount + (
+                    SELECT SUM(r.amount) FROM %(tab_rate)s r
+                    WHERE r.target_ct_id = %(tab_tr)s.target_ct_id AND r.target_id = %(tab_tr)s.target_id
+                 )
+                 WHERE EXISTS (
+                    SELECT 1 FROM %(tab_rate)s r
+                    WHERE r.target_ct_id = %(tab_tr)s.target_ct_id AND r.target_id = %(tab_tr)s.target_id
+                 )''' % params, ())
+        cursor.execute('''INSERT INTO %(tab_tr)s
+                    (amount, target_ct_id, target_id)
+                 SELECT
+                    SUM(r.amount), r.target_ct_id, r.target_id
+                 FROM %(tab_rate)s r
+                 WHERE NOT EXISTS (
+                    SELECT 1 FROM %(tab_tr)s t
+                    WHERE t.target_ct_id = r.target_ct_id AND t.target_id = r.target_id
+                 )
+                 GROUP BY r.target_ct_id, r.target_id''' % params, ())
+
+    def get_movable(self, time_limit, target_ct_id=None, time_from=None):
+        "Return ratings move_rate_to_agg would move."
+        qset = self.filter(time__lte=time_limit)
+        if target_ct_id is not None:
+            qset = qset.filter(target_ct=target_ct_id)
+        if time_from is not None:
+            qset = qset.filter(time__gt=time_from)
+        return qset
+
+    @instrumented('rating.move_rate_to_agg')
+    def move_rate_to_agg(self, time_limit, time_format, target_ct_id=None, time_from=None):
         """
         Coppy aggregated Rating to table Agg
 
         time_limit: limit for time of transfering data
 
-        time_format: format for date_trunc
+        time_format: period to aggregate to, one of PERIOD_DIVISORS
+
+        target_ct_id, time_from: if given, only ratings of this content type
+            and/or newer than time_from are moved
         """
         qn = connection.ops.quote_name
-        date_trunc = connection.ops.date_trunc_sql
+        params = [time_limit]
+        qset = self.get_movable(time_limit, target_ct_id, time_from)
+        where = ''
+        if target_ct_id is not None:
+            where += ' AND target_ct_id = %s'
+            params.append(target_ct_id)
+        if time_from is not None:
+            where += ' AND time > %s'
+            params.append(time_from)
 
         sql = '''INSERT INTO %(agg_table)s
-                    (detract, period, people, amount, time, target_ct_id, target_id)
+                    (detract, period, people, amount, time, bucket, target_ct_id, target_id)
                  SELECT
-                    0, %%s, COUNT(*), SUM(amount), %(truncated_date)s, target_ct_id, target_id
+                    0, %%s, COUNT(*), SUM(amount), MIN(time), %(bucket)s, target_ct_id, target_id
                  FROM %(rating_table)s
-                 WHERE time <= %%s
-                 GROUP BY target_ct_id, target_id, %(truncated_date)s''' % {
+                 WHERE time <= %%s%(where)s
+                 GROUP BY target_ct_id, target_id, %(bucket)s''' % {
             'rating_table' : qn(Rating._meta.db_table),
             'agg_table' : qn(Agg._meta.db_table),
-            'truncated_date': date_trunc(time_format, qn('time')),
+            'bucket': get_bucket_sql('day', time_format),
+            'where': where,
+        }
+        buckets_sql = '''SELECT DISTINCT %(bucket)s
+                 FROM %(rating_table)s
+                 WHERE time <= %%s%(where)s''' % {
+            'rating_table' : qn(Rating._meta.db_table),
+            'bucket': get_bucket_sql('day', time_format),
+            'where': where,
+        }
+
+        if partitions.is_enabled() and target_ct_id is None and time_from is None:
+            # whole old partitions are dropped, the rest is deleted row by row
+            partitions.move_partitions_to_agg(time_limit, time_format)
+
+        cursor = connection.cursor()
+        cursor.execute(buckets_sql, params)
+        buckets = [row[0] for row in cursor.fetchall()]
+        cursor.execute(sql, [time_format[0]] + params)
+        qset.delete()
+        Agg.objects.fix_times(time_format, buckets, target_ct_id)
+
+
+def get_vote_bucket(time):
+    """
+    Return number of MINIMAL_ANONYMOUS_IP_DELAY long period the given time
+    belongs to.
+    """
+    return int(mktime(time.timetuple())) // MINIMAL_ANONYMOUS_IP_DELAY
+
+def get_voter(user_id, ip_address, time):
+    """
+    Return tuple (voter, timeout) identifying who cast a rating in the index
+    of recently rated objects, voter is None for ratings that are not checked
+    for duplicities. Anonymous voters only count within one vote bucket,
+    timeout of None means the index's default.
+    """
+    if user_id:
+        return 'user:%s' % user_id, None
+    if ip_address:
+        return 'ip:%s:%s' % (ip_address, get_vote_bucket(time)), MINIMAL_ANONYMOUS_IP_DELAY
+    return None, None
+
+class AnonymousVoteManager(models.Manager):
+
+    def insert_many(self, ratings):
+        """
+        Record votes of given anonymous ratings using one executemany() call.
+        """
+        qn = connection.ops.quote_name
+        params = [(r.target_ct_id, r.target_id, r.ip_address, get_vote_bucket(r.time))
+                for r in ratings if not r.user_id and r.ip_address]
+        if not params:
+            return
+
+        sql = '''INSERT INTO %(vote_table)s
+                    (target_ct_id, target_id, ip_address, bucket)
+                 VALUES
+                    (%%s, %%s, %%s, %%s)''' % {
+            'vote_table' : qn(self.model._meta.db_table),
         }
 
         cursor = connection.cursor()
-        cursor.execute(sql, (time_format[0], time_limit,))
-        self.filter(time__lte=time_limit).delete()
+        cursor.executemany(sql, params)
+
+    def purge(self, time_limit):
+        """
+        Delete votes that can no longer block new ratings.
+        """
+        qn = connection.ops.quote_name
+
+        sql = '''DELETE FROM %(vote_table)s WHERE bucket < %%s''' % {
+            'vote_table' : qn(self.model._meta.db_table),
+        }
+
+        cursor = connection.cursor()
+        cursor.execute(sql, (get_vote_bucket(time_limit),))
+
+class AnonymousVote(models.Model):
+    """
+    Anonymous rating of an object from an IP address. Only one vote per
+    address and object is allowed in every MINIMAL_ANONYMOUS_IP_DELAY long
+    bucket, which is enforced by unique constraint.
+    """
+    target_ct = models.ForeignKey(ContentType)
+    target_id = models.PositiveIntegerField(_('Object ID'))
+    target = generic.GenericForeignKey('target_ct', 'target_id')
+    ip_address = models.CharField(_('IP Address'), max_length="15")
+    bucket = models.IntegerField(_('Bucket'), db_index=True)
+
+    objects = AnonymousVoteManager()
+
+    def __unicode__(self):
+        return u'%s voted for %s' % (self.ip_address, self.target)
+
+    class Meta:
+        verbose_name = _('Anonymous vote')
+        verbose_name_plural = _('Anonymous votes')
+        unique_together = (('target_ct', 'target_id', 'ip_address', 'bucket',),)
 
 
 class Rating(models.Model):
@@ -270,46 +1264,85 @@ class Rating(models.Model):
     target_id = models.PositiveIntegerField(_('Object ID'), db_index=True)
     target = generic.GenericForeignKey('target_ct', 'target_id')
 
-    time = models.DateTimeField(_('Time'), default=datetime.now, editable=False)
+    time = models.DateTimeField(_('Time'), default=datetime.now, editable=False, db_index=True)
+    day = models.IntegerField(_('Day'), default=0, editable=False)
     user = models.ForeignKey(User, blank=True, null=True)
     amount = models.DecimalField(_('Amount'), max_digits=10, decimal_places=2)
     ip_address = models.CharField(_('IP Address'), max_length="15", blank=True)
 
     objects = RatingManager()
 
+    # chunked aggregation
+    composite_indexes = (('target_ct', 'time'),)
+
     def __unicode__(self):
         return u'%s points for %s' % (self.amount, self.target)
 
     class Meta:
         verbose_name = _('Rating')
         verbose_name_plural = _('Ratings')
+        unique_together = (('target_ct', 'target_id', 'user',),)
 
     def save(self, **kwargs):
         """
         Modified save() method that checks for duplicit entries.
+
+        Duplicities are detected by the database - by unique constraint on
+        (target_ct, target_id, user) for users and on AnonymousVote for
+        anonymous ratings, so inserting a rating is just one INSERT. Ratings
+        of users are checked by an extra query when Rating is partitioned,
+        see django_ratings.partitions.
         """
-        if not self.pk:
-            # fail silently on inserting duplicate ratings
-            if self.user:
-                try:
-                    Rating.objects.get(target_ct=self.target_ct, target_id=self.target_id, user=self.user)
-                    return
-                except Rating.DoesNotExist:
-                    pass
-            elif (self.ip_address and Rating.objects.filter(
-                        target_ct=self.target_ct,
-                        target_id=self.target_id,
-                        user__isnull=True,
-                        ip_address=self.ip_address ,
-                        time__gte=(self.time or datetime.now()) - timedelta(seconds=MINIMAL_ANONYMOUS_IP_DELAY)
-                    ).count() > 0):
+        if self.pk:
+            self.day = get_day_key(self.time)
+            super(Rating, self).save(**kwargs)
+            return
+
+        if self.time is None:
+            self.time = datetime.now()
+        self.day = get_day_key(self.time)
+
+        if RATINGS_VOTED_INDEX:
+            voter, timeout = get_voter(self.user_id, self.ip_address, self.time)
+            if voter and caching.voted.contains(voter, self.target_ct_id, self.target_id):
+                return
+
+        if self.user_id and partitions.is_enabled():
+            # unique constraint only covers one partition
+            if Rating.objects.filter(target_ct=self.target_ct_id, target_id=self.target_id, user=self.user_id).count():
                 return
-            # denormalize the total rate
-            cnt = TotalRate.objects.filter(target_ct=self.target_ct, target_id=self.target_id).update(amount=models.F('amount')+self.amount)
-            if cnt == 0:
-                tr = TotalRate.objects.create(target_ct=self.target_ct, target_id=self.target_id, amount=self.amount)
 
+        sid = transaction.savepoint()
+        try:
+            if not self.user_id and self.ip_address:
+                AnonymousVote.objects.create(
+                        target_ct_id=self.target_ct_id,
+                        target_id=self.target_id,
+                        ip_address=self.ip_address,
+                        bucket=get_vote_bucket(self.time)
+                    )
+            super(Rating, self).save(**kwargs)
+        except IntegrityError:
+            # fail silently on inserting duplicate ratings
+            transaction.savepoint_rollback(sid)
+            self.remember_voter()
+            return
+        transaction.savepoint_commit(sid)
+        self.remember_voter()
+
+        # denormalize the total rate
+        TotalRate.objects.add_amount(self.target_ct_id, self.target_id, self.amount)
+
+    def remember_voter(self):
+        "Record the rating in the index of recently rated objects."
+        if not RATINGS_VOTED_INDEX:
+            return
+        voter, timeout = get_voter(self.user_id, self.ip_address, self.time)
+        if voter:
+            caching.voted.add(voter, self.target_ct_id, self.target_id, timeout)
 
-        super(Rating, self).save(**kwargs)
 
+post_syncdb.connect(indexes.create_composite_indexes)
 
+if RATINGS_KARMA_INCREMENTAL:
+    total_rate_changed.connect(karma.deltas.receive, sender=TotalRate)
@@ -0,0 +1,191 @@
+"""
+Daily partitions of the Rating table on PostgreSQL.
+
+When RATINGS_PARTITIONED is set, ratings are stored in child tables named
+``<rating table>_YYYYMMDD`` inheriting from the Rating table, one per day.
+A trigger routes every INSERT into the partition of the rating's day, so
+the ORM keeps working with the Rating table as usual - PostgreSQL reads the
+partitions whenever the parent table is queried. Ratings of days without a
+partition stay in the parent table.
+
+The aggregation job then moves whole old partitions to Agg and drops them
+instead of deleting the ratings row by row. Ratings are aggregated once they
+are a day old, so partitions by day leave at most one day of ratings - those
+in the partition the time limit falls into - to the row by row DELETE.
+Monthly partitions would leave up to a month of them.
+
+Partitions are created ahead of time by the ``partition_ratings`` management
+command. Other databases have no table inheritance, the setting is ignored
+there and Rating stays one table.
+
+Note that the unique constraint on (target_ct, target_id, user) is only
+enforced within one partition, Rating.save() therefore checks ratings of
+logged in users with an extra query in partitioned mode.
+"""
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection
+
+RATINGS_PARTITIONED = getattr(settings, 'RATINGS_PARTITIONED', False)
+
+# suffix of partition names
+PARTITION_FORMAT = '%Y%m%d'
+
+def is_supported():
+    return settings.DATABASE_ENGINE in ('postgresql', 'postgresql_psycopg2')
+
+def is_enabled():
+    return RATINGS_PARTITIONED and is_supported()
+
+def get_day_start(time):
+    return datetime(time.year, time.month, time.day)
+
+def get_next_day(time):
+    return get_day_start(time) + timedelta(days=1)
+
+def get_parent_table():
+    from django_ratings.models import Rating
+    return Rating._meta.db_table
+
+def get_partition_name(time):
+    return '%s_%s' % (get_parent_table(), get_day_start(time).strftime(PARTITION_FORMAT))
+
+def get_partitions():
+    """
+    Return list of (name, start, end) tuples describing existing partitions
+    ordered by time, end being the first moment not in the partition.
+    """
+    cursor = connection.cursor()
+    cursor.execute('''SELECT c.relname
+             FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+             WHERE p.relname = %s''', (get_parent_table(),))
+
+    prefix = get_parent_table() + '_'
+    partitions = []
+    for name, in cursor.fetchall():
+        try:
+            start = datetime.strptime(name[len(prefix):], PARTITION_FORMAT)
+        except ValueError:
+            # not ours
+            continue
+        partitions.append((name, start, get_next_day(start)))
+    partitions.sort(key=lambda p: p[1])
+    return partitions
+
+def install_trigger():
+    """
+    Create the trigger routing inserts into partitions, ratings of days
+    without a partition are kept in the parent table.
+    """
+    qn = connection.ops.quote_name
+    parent = get_parent_table()
+    function = '%s_insert' % parent
+
+    cursor = connection.cursor()
+    cursor.execute('''CREATE OR REPLACE FUNCTION %(function)s() RETURNS TRIGGER AS $$
+            BEGIN
+                EXECUTE 'INSERT INTO ' || quote_ident('%(parent)s_' || to_char(NEW.time, 'YYYYMMDD')) || ' SELECT ($1).*' USING NEW;
+                RETURN NULL;
+            EXCEPTION WHEN undefined_table THEN
+                RETURN NEW;
+            END;
+        $$ LANGUAGE plpgsql''' % {
+        'function': qn(function),
+        'parent': parent,
+    })
+    cursor.execute('DROP TRIGGER IF EXISTS %s ON %s' % (qn(function), qn(parent)))
+    cursor.execute('CREATE TRIGGER %s BEFORE INSERT ON %s FOR EACH ROW EXECUTE PROCEDURE %s()' % (
+        qn(function), qn(parent), qn(function)
+    ))
+
+def create_partition(time):
+    """
+    Create partition for the day of given time unless it exists, move
+    ratings of that day stored in the parent table into it. Return True
+    if the partition was created.
+    """
+    qn = connection.ops.quote_name
+    ops = connection.ops
+    name = get_partition_name(time)
+    if name in [p[0] for p in get_partitions()]:
+        return False
+
+    start = get_day_start(time)
+    end = get_next_day(start)
+    parent = get_parent_table()
+    params = (ops.value_to_db_datetime(start), ops.value_to_db_datetime(end))
+
+    cursor = connection.cursor()
+    cursor.execute('''CREATE TABLE %(name)s (
+                CHECK (time >= %%s AND time < %%s),
+                UNIQUE (target_ct_id, target_id, user_id)
+            ) INHERITS (%(parent)s)''' % {'name': qn(name), 'parent': qn(parent)}, params)
+    cursor.execute('CREATE INDEX %s ON %s (target_ct_id, target_id)' % (qn(name + '_target'), qn(name)))
+    cursor.execute('CREATE INDEX %s ON %s (time)' % (qn(name + '_time'), qn(name)))
+    cursor.execute('''INSERT INTO %(name)s SELECT * FROM ONLY %(parent)s WHERE time >= %%s AND time < %%s''' % {
+        'name': qn(name), 'parent': qn(parent)
+    }, params)
+    cursor.execute('DELETE FROM ONLY %s WHERE time >= %%s AND time < %%s' % qn(parent), params)
+    return True
+
+def create_partitions(days_ahead=7, now=None):
+    """
+    Install the routing trigger and create partitions for the days of all
+    ratings in the parent table, the current day and days_ahead days
+    ahead. Return names of created partitions.
+    """
+    qn = connection.ops.quote_name
+    now = now or datetime.now()
+    install_trigger()
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT MIN(time) FROM ONLY %s' % qn(get_parent_table()))
+    oldest = cursor.fetchone()[0]
+
+    day = get_day_start(min(oldest or now, now))
+    last = get_day_start(now) + timedelta(days=days_ahead)
+
+    created = []
+    while day <= last:
+        if create_partition(day):
+            created.append(get_partition_name(day))
+        day = get_next_day(day)
+    return created
+
+def move_partitions_to_agg(time_limit, time_format):
+    """
+    Aggregate partitions that only hold ratings older than time_limit into
+    Agg and drop them, return number of dropped partitions. Partitions of
+    days that haven't ended yet are kept.
+    """
+    from django_ratings.models import Agg, get_bucket_sql
+
+    qn = connection.ops.quote_name
+    limit = min(time_limit, datetime.now())
+
+    cursor = connection.cursor()
+    dropped = 0
+    for name, start, end in get_partitions():
+        if end > limit:
+            break
+        params = {
+            'partition' : qn(name),
+            'agg_table' : qn(Agg._meta.db_table),
+            'bucket': get_bucket_sql('day', time_format),
+        }
+        cursor.execute('SELECT DISTINCT %(bucket)s FROM %(partition)s' % params, ())
+        buckets = [row[0] for row in cursor.fetchall()]
+        cursor.execute('''INSERT INTO %(agg_table)s
+                    (detract, period, people, amount, time, bucket, target_ct_id, target_id)
+                 SELECT
+                    0, %%s, COUNT(*), SUM(amount), MIN(time), %(bucket)s, target_ct_id, target_id
+                 FROM %(partition)s
+                 GROUP BY target_ct_id, target_id, %(bucket)s''' % params, (time_format[0],))
+        cursor.execute('DROP TABLE %s' % qn(name))
+        Agg.objects.fix_times(time_format, buckets)
+        dropped += 1
+    return dropped
@@ -0,0 +1,148 @@
+"""
+In-memory rank index of total rates used by TotalRateManager.get_normalized_rating.
+
+For every content type the index keeps sorted lists of positive and negative
+total rates, so the position of any score among other objects of the same
+type is a bisect away instead of two COUNT queries. A content type is loaded
+with a single query on first use - amounts collected in TotalRateShard
+included - and then kept up to date by Rating.save() once the rating commits.
+Changes done by other processes are picked up once the index gets older than
+RATINGS_PERCENTILE_TIMEOUT or once the aggregation job invalidates it, which
+is announced through the cache and so requires one shared by all processes.
+"""
+
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+
+from django.conf import settings
+from django.db import transaction
+
+from django_ratings import transactions
+from django_ratings.caching import backend as cache, RATINGS_CACHE_PREFIX
+
+RATINGS_PERCENTILE_TIMEOUT = getattr(settings, 'RATINGS_PERCENTILE_TIMEOUT', 600)
+
+# cache key holding time of the last invalidation
+INVALIDATED_KEY = '%s:percentiles:invalidated' % RATINGS_CACHE_PREFIX
+
+class PercentileIndex(object):
+    def __init__(self, timeout=RATINGS_PERCENTILE_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        "Forget all loaded content types."
+        self._lock.acquire()
+        try:
+            self._amounts = {}
+            self._positive = {}
+            self._negative = {}
+            self._loaded = {}
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """
+        Force all processes to reload the index once the current transaction
+        commits, called when total rates change in bulk.
+        """
+        transactions.on_commit(self._invalidate)
+
+    def _invalidate(self):
+        self.clear()
+        cache.set(INVALIDATED_KEY, time.time(), self.timeout)
+
+    def _is_fresh(self, ct_id):
+        loaded = self._loaded.get(ct_id)
+        if loaded is None or time.time() - loaded > self.timeout:
+            return False
+        invalidated = cache.get(INVALIDATED_KEY)
+        return invalidated is None or invalidated < loaded
+
+    def load(self, ct_id):
+        "Load total rates of given content type from the database."
+        from django_ratings.models import TotalRate, TotalRateShard
+        amounts = dict(TotalRate.objects.filter(target_ct=ct_id).values_list('target_id', 'amount'))
+        for target_id, amount in TotalRateShard.objects.filter(target_ct=ct_id).exclude(amount=0).values_list('target_id', 'amount'):
+            amounts[target_id] = amounts.get(target_id, 0) + amount
+        positive = sorted(a for a in amounts.itervalues() if a > 0)
+        negative = sorted(a for a in amounts.itervalues() if a < 0)
+
+        self._lock.acquire()
+        try:
+            self._amounts[ct_id] = amounts
+            self._positive[ct_id] = positive
+            self._negative[ct_id] = negative
+            self._loaded[ct_id] = time.time()
+        finally:
+            self._lock.release()
+
+    def get_rank(self, ct_id, amount):
+        """
+        Return tuple (worse, total) where total is the number of objects of
+        given content type with score of the same sign as amount and worse is
+        the number of those that are closer to zero than amount. Return None
+        if the content type was dropped from the index meanwhile or if it has
+        to be loaded within a transaction with uncommitted changes, which
+        must not get into the index before they commit.
+        """
+        if not self._is_fresh(ct_id):
+            if transaction.is_managed() and transaction.is_dirty():
+                return None
+            self.load(ct_id)
+
+        self._lock.acquire()
+        try:
+            if amount > 0:
+                positive = self._positive.get(ct_id)
+                if positive is None:
+                    return None
+                return bisect_left(positive, amount), len(positive)
+            negative = self._negative.get(ct_id)
+            if negative is None:
+                return None
+            return len(negative) - bisect_right(negative, amount), len(negative)
+        finally:
+            self._lock.release()
+
+    def update(self, ct_id, target_id, delta):
+        """
+        Add delta to the score of given object once the current transaction
+        commits, content types that are not loaded are left alone.
+        """
+        transactions.on_commit(self._update, ct_id, target_id, delta)
+
+    def _update(self, ct_id, target_id, delta):
+        self._lock.acquire()
+        try:
+            if ct_id not in self._amounts:
+                return
+            amounts = self._amounts[ct_id]
+            old = amounts.get(target_id, 0)
+            new = old + delta
+            amounts[target_id] = new
+
+            self._remove(ct_id, old)
+            if new > 0:
+                insort(self._positive[ct_id], new)
+            elif new < 0:
+                insort(self._negative[ct_id], new)
+        finally:
+            self._lock.release()
+
+    def _remove(self, ct_id, amount):
+        if amount > 0:
+            values = self._positive[ct_id]
+        elif amount < 0:
+            values = self._negative[ct_id]
+        else:
+            return
+        i = bisect_left(values, amount)
+        if i < len(values) and values[i] == amount:
+            del values[i]
+
+
+# global index used by TotalRateManager when RATINGS_PERCENTILE_INDEX is set
+index = PercentileIndex()
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# sent with sender=TotalRate whenever total rate of an object changes by amount
+total_rate_changed = Signal(providing_args=['target_ct_id', 'target_id', 'amount'])
+
+# sent by django_ratings.instrumentation after every measured call
+measured = Signal(providing_args=['name', 'queries', 'seconds', 'cache_hits'])
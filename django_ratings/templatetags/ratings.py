@@ -6,12 +6,13 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
 
-from django_ratings.models import TotalRate
+from django_ratings.models import TotalRate, Leaderboard, RATINGS_LEADERBOARDS
+from django_ratings.content_types import content_types
+from django_ratings.instrumentation import instrumented
 from django_ratings.forms import RateForm
 from django_ratings.views import get_was_rated
 from django.utils.translation import ugettext as _
-
-from recepty import settings
+from django.conf import settings
 
 register = template.Library()
 
@@ -45,7 +46,7 @@ class RateUrlNode(template.Node):
         if obj and hasattr(obj, 'get_absolute_url'):
             context[self.url_var_name] = '%s%s/' % (obj.get_absolute_url(), slugify(_('rate')))
         elif obj:
-            ct = ContentType.objects.get_for_model(obj)
+            ct = content_types.get_for_model(obj)
             context[self.form_name] = RateForm(initial={'content_type' : ct.id, 'target' : obj._get_pk_val()})
             context[self.url_var_name] = reverse('rate')
         return ''
@@ -106,6 +107,7 @@ class RatingNode(template.Node):
         self.object, self.name = object, name
         self.min, self.max, self.step, self.min2 = min, max, step, min2
 
+    @instrumented('tags.rating')
     def render(self, context):
         obj = template.Variable(self.object).resolve(context)
         if obj:
@@ -144,7 +146,7 @@ class RatingNode(template.Node):
             elif (self.min is not None and self.max is not None):
                 value = TotalRate.objects.get_normalized_rating(obj, Decimal(self.max), Decimal(self.step))
             else:
-                value = TotalRate.objects.get_total_rating(obj)
+                value = TotalRate.objects.get_for_object(obj)
             # Set as string to be able to compare value in template
             context[self.name] = str(value)
         return ''
@@ -194,14 +196,62 @@ def do_rating(parser, token):
     raise template.TemplateSyntaxError, \
         "{% rating for OBJ as VAR %} or {% rating for OBJ max X step Y as VAR %}"
 
+class PrefetchRatingsNode(template.Node):
+    def __init__(self, objects, attr=None):
+        self.objects, self.attr = objects, attr
+
+    def render(self, context):
+        objects = template.Variable(self.objects).resolve(context)
+        if objects:
+            TotalRate.objects.prefetch_for_objects(objects, self.attr)
+        return ''
+
+@register.tag('prefetch_ratings')
+def do_prefetch_ratings(parser, token):
+    """
+    Fetch ratings for all objects in given list with one query, and their
+    ranks needed by normalized ratings with one more query per content type,
+    following {% rating %} tags for these objects won't hit the database.
+
+    Usage::
+
+        {% prefetch_ratings for OBJECTS %}
+
+        {% prefetch_ratings for OBJECTS as ATTR %}
+
+    Examples::
+
+        {% prefetch_ratings for object_list %}
+        {% for object in object_list %}
+            {% rating for object as object_rating %} ...
+        {% endfor %}
+
+        {% prefetch_ratings for object_list as total_rate %}
+        {% for object in object_list %}
+            {{ object }} has rating of {{ object.total_rate }}
+        {% endfor %}
+
+    Notice:
+
+        The list must not be a queryset that gets evaluated again later,
+        the ratings are stored on the object instances.
+    """
+    bits = token.split_contents()
+    if len(bits) == 3 and bits[1] == 'for':
+        return PrefetchRatingsNode(bits[2])
+    if len(bits) == 5 and bits[1] == 'for' and bits[3] == 'as':
+        return PrefetchRatingsNode(bits[2], bits[4])
+    raise template.TemplateSyntaxError, "{% prefetch_ratings for OBJECTS %} or {% prefetch_ratings for OBJECTS as ATTR %}"
+
 class WasRatedNode(template.Node):
 
     def __init__(self, object, name):
         self.object, self.name = object, name
 
+    @instrumented('tags.was_rated')
     def render(self, context):
         object = template.Variable(self.object).resolve(context)
-        ct = ContentType.objects.get_for_model(object)
+        ct = content_types.get_for_model(object)
         context[self.name] = get_was_rated(context['request'], ct, object)
         return ''
 
@@ -217,13 +267,22 @@ def do_was_rated(parser, token):
 
 
 class TopRatedNode(template.Node):
-    def __init__(self, count, name, mods=None):
-        self.count, self.name, self.mods = count, name, mods
+    def __init__(self, count, name, mods=None, window=None):
+        self.count, self.name, self.mods, self.window = count, name, mods, window
 
+    @instrumented('tags.top_rated')
     def render(self, context):
-        context[self.name] = TotalRate.objects.get_top_objects(self.count, self.mods)
+        objects = []
+        if self.window:
+            objects = Leaderboard.objects.get_top_objects(self.count, self.mods, self.window)
+        if not objects and self.window in (None, WINDOWS['all']):
+            # all time leaderboards are not refreshed yet
+            objects = TotalRate.objects.get_top_objects(self.count, self.mods)
+        context[self.name] = objects
         return ''
 
+WINDOWS = {'day': 'd', 'week': 'w', 'month': 'm', 'all': 'a'}
+
 @register.tag('top_rated')
 def do_top_rated(parser, token):
     """
@@ -233,6 +292,13 @@ def do_top_rated(parser, token):
 
         {% top_rated 5 [app.model ...] as var %}
 
+        Read from precomputed leaderboards (see RATINGS_LEADERBOARDS):
+        {% top_rated 5 [app.model ...] for day|week|month|all as var %}
+
+        Without leaderboards only the all window can be used, it is read
+        from total rates just like without any window. So is the all
+        window before leaderboards get refreshed for the first time.
+
     Example::
 
         {% top_rated 10 as top_rated_objects %}
@@ -243,6 +309,9 @@ def do_top_rated(parser, token):
 
         {% top_rated 10 articles.article photos.photo as top_objects %}
         {% for obj in top_objects %}   ...   {% endfor %}
+
+        {% top_rated 10 articles.article for week as top_articles %}
+        {% for article in top_articles %}   ...   {% endfor %}
     """
     bits = token.split_contents()
     if len(bits) < 3 or bits[-2] != 'as':
@@ -250,15 +319,25 @@ def do_top_rated(parser, token):
 
     count = int(bits[1])
 
+    window = None
+    mod_bits = bits[2:-2]
+    if len(mod_bits) >= 2 and mod_bits[-2] == 'for':
+        if mod_bits[-1] not in WINDOWS:
+            raise template.TemplateSyntaxError, "%r window must be one of %s" % (bits[0], ', '.join(WINDOWS.keys()))
+        if not RATINGS_LEADERBOARDS and mod_bits[-1] != 'all':
+            raise template.TemplateSyntaxError, "%r window %s requires RATINGS_LEADERBOARDS" % (bits[0], mod_bits[-1])
+        if RATINGS_LEADERBOARDS:
+            window = WINDOWS[mod_bits[-1]]
+        mod_bits = mod_bits[:-2]
 
     mods = []
-    for mod in bits[2:-2]:
+    for mod in mod_bits:
         model = models.get_model(*mod.split('.', 1))
         if not model:
             raise template.TemplateSyntaxError, "%r .... TODO ....." % token.contents.split()[0]
         mods.append(model)
 
-    return TopRatedNode(count, bits[-1], mods)
+    return TopRatedNode(count, bits[-1], mods, window)
 
 class IfWasRatedNode(template.Node):
 
@@ -271,11 +350,12 @@ class IfWasRatedNode(template.Node):
         self.ct = ct
         self.pk = pk
 
+    @instrumented('tags.if_was_rated')
     def render(self, context):
 
         if self.obj:
             obj = self.obj.resolve(context)
-            ct = ContentType.objects.get_for_model(obj).id
+            ct = content_types.get_id(obj)
             pk = obj.pk
         else:
             ct = self.ct
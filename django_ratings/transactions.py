@@ -0,0 +1,76 @@
+"""
+Callbacks run once the current transaction commits.
+
+In-memory indexes, caches and karma must not learn about a change before
+other processes can read it from the database, nor at all when it gets
+rolled back. Django doesn't announce commits, so the database wrapper's
+_commit and _rollback get wrapped when this module is imported - a commit
+runs callbacks registered by the thread since the last commit, a rollback
+drops them. Outside transaction management Django commits every change
+right away and callbacks run immediately.
+"""
+
+import threading
+
+from django.db import connection, transaction
+
+_state = threading.local()
+
+def _get_pending():
+    if not hasattr(_state, 'callbacks'):
+        _state.callbacks = []
+    return _state.callbacks
+
+def on_commit(func, *args):
+    """
+    Call func with given arguments once the current transaction commits,
+    right away when transactions are not managed.
+    """
+    if not transaction.is_managed():
+        func(*args)
+        return
+    _get_pending().append((func, args))
+
+def get_transaction_id():
+    """
+    Return number identifying the thread's current transaction, it changes
+    with every commit and rollback.
+    """
+    return getattr(_state, 'transaction_id', 0)
+
+def _end_transaction():
+    _state.transaction_id = get_transaction_id() + 1
+
+def run_pending():
+    "Run callbacks registered since the last commit or rollback."
+    _end_transaction()
+    callbacks = _get_pending()
+    while callbacks:
+        func, args = callbacks.pop(0)
+        func(*args)
+
+def discard_pending():
+    "Forget callbacks registered since the last commit or rollback."
+    _end_transaction()
+    del _get_pending()[:]
+
+def install():
+    wrapper = type(connection)
+    if getattr(wrapper, '_ratings_callbacks_installed', False):
+        return
+    commit, rollback = wrapper._commit, wrapper._rollback
+
+    def _commit(self):
+        result = commit(self)
+        run_pending()
+        return result
+
+    def _rollback(self):
+        discard_pending()
+        return rollback(self)
+
+    wrapper._commit = _commit
+    wrapper._rollback = _rollback
+    wrapper._ratings_callbacks_installed = True
+
+install()
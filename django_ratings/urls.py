@@ -6,6 +6,7 @@ else:
     from django.utils.translation import ugettext as _
 
     from ella.core.custom_urls import dispatcher
-    from django_ratings.views import rate
+    from django_ratings.views import rate, rate_deferred
 
     dispatcher.register(_('rate'),  rate)
+    dispatcher.register(_('rate-deferred'),  rate_deferred)
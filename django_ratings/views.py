@@ -5,32 +5,55 @@ from django.utils import simplejson
 from django.db import models
 
 from django_ratings.models import *
+from django_ratings import caching
+from django_ratings.buffer import votes
+from django_ratings.cookies import decode_votes, is_legacy, set_votes_cookie
+from django_ratings.instrumentation import instrumented
 
 current_site = Site.objects.get_current()
 
 UPDOWN = {'up' : 1, 'down' : -1}
 
+# request attribute holding votes parsed from the cookie
+VOTES_ATTR = '_ratings_voted'
+# request attribute telling that the cookie should be signed again
+REISSUE_ATTR = '_ratings_reissue'
+
 def _get_cookie(request):
     """
-    Returns cookie split by ','
+    Returns tuple (list, set) of (ct_id, object_id) pairs stored in the cookie,
+    parsed once per request
     """
-    try:
-        return request.COOKIES[RATINGS_COOKIE_NAME].split(',')
-    except KeyError:
-        # Cookie not set
-        return []
+    if not hasattr(request, VOTES_ATTR):
+        value = request.COOKIES.get(RATINGS_COOKIE_NAME, '')
+        votes = decode_votes(value)
+        setattr(request, VOTES_ATTR, (votes, set(votes)))
+        setattr(request, REISSUE_ATTR, bool(votes) and is_legacy(value))
+    return getattr(request, VOTES_ATTR)
 
 def get_was_rated(request, ct, target):
     """
     Returns whether object was rated by current user
 
-    Rating can fail later on db query, this checks user cookies
+    Rating can fail later on db query, this checks user cookies and the
+    index of recently rated objects if RATINGS_VOTED_INDEX is set
     """
     if isinstance(ct, ContentType):
         ct = ct.id
     if isinstance(target, models.Model):
         target = target.pk
-    return '%s:%s' % (ct, target) in _get_cookie(request)
+    try:
+        vote = (int(ct), int(target))
+    except (TypeError, ValueError):
+        return False
+    if vote in _get_cookie(request)[1]:
+        return True
+
+    if RATINGS_VOTED_INDEX:
+        user_id = request.user.is_authenticated() and request.user.pk or None
+        voter, timeout = get_voter(user_id, request.META.get('REMOTE_ADDR', None), datetime.now())
+        return voter is not None and caching.voted.contains(voter, ct, target)
+    return False
 
 def set_was_rated(request, response, ct, target):
     """
@@ -38,15 +61,15 @@ def set_was_rated(request, response, ct, target):
 
     Adds object content_type and id to RATINGS_COOKIE_NAME cookie
     """
-    cook = _get_cookie(request)
-    if len(cook) > RATINGS_MAX_COOKIE_LENGTH:
-        cook = cook[1:]
-    cook.append('%s:%s' % (ct.id, target.id))
-    expires = datetime.strftime(datetime.utcnow() + timedelta(seconds=RATINGS_MAX_COOKIE_AGE), "%a, %d-%b-%Y %H:%M:%S GMT")
-    domain = settings.SESSION_COOKIE_DOMAIN
-    response.set_cookie(RATINGS_COOKIE_NAME, value=','.join(cook),
-            max_age=RATINGS_MAX_COOKIE_AGE, expires=expires,  path='/',
-            domain=domain, secure=None)
+    votes, voted = _get_cookie(request)
+    vote = (ct.id, target.id)
+    if vote not in voted:
+        votes.append(vote)
+        voted.add(vote)
+    while len(votes) > RATINGS_MAX_COOKIE_LENGTH:
+        voted.discard(votes.pop(0))
+    set_votes_cookie(response, votes)
+    setattr(request, REISSUE_ATTR, False)
 
 
 def get_response(request, target, message=None):
@@ -65,8 +88,16 @@ def get_response(request, target, message=None):
             url = request.META.get('HTTP_REFERER', '/')
         return HttpResponseRedirect(url)
 
-def do_rate(request, ct, target, plusminus):
+@instrumented('views.do_rate')
+def do_rate(request, ct, target, plusminus, deferred=False):
+    """
+    Rate target by the current user.
 
+    deferred: don't write the rating on the request thread, it is handed to
+        the vote buffer which writes it in the background, even when
+        RATINGS_BUFFERED is not set. The response doesn't wait for the
+        write, so it can't tell whether the rating was a duplicate.
+    """
     if get_was_rated(request, ct, target):
         return get_response(request, target, _('You have already rated this object.'))
 
@@ -81,13 +112,18 @@ def do_rate(request, ct, target, plusminus):
     # Do the rating
     # Rating will not be neccessary added but fail silently
     rt = Rating(target_ct_id=ct.id, target_id=target.id, **kwa)
-    rt.save()
+    if deferred:
+        votes.add(rt, wait=False)
+    elif RATINGS_BUFFERED:
+        votes.add(rt)
+    else:
+        rt.save()
 
     response =  get_response(request, target, message=_('Your rating was succesfully added.'))
     set_was_rated(request, response, ct, target)
     return response
 
-def rate(request, bits, context):
+def rate(request, bits, context, deferred=False):
     """
     View for ella custom urls
 
@@ -104,9 +140,21 @@ def rate(request, bits, context):
         request,
         context['content_type'],
         context['object'],
-        plusminus
+        plusminus,
+        deferred=deferred
     )
 
+def rate_deferred(request, bits, context):
+    """
+    Same as rate, but returns without waiting for the rating to be written,
+    for heavily voted objects during live events. See do_rate.
+
+    The success response only means the rating was accepted into the vote
+    buffer, not that it was saved - it is lost if the process dies before
+    the buffer is flushed and dropped when it turns out to be a duplicate.
+    """
+    return rate(request, bits, context, deferred=True)
+
 
 # This method is not used in the moment and untested so commented out...
 #@require_POST
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+'''
+benchmarks of the vote write path and the rating read paths
+
+Creates a test database, fills it with a synthetic dataset of given size,
+measures every benchmark and prints one JSON object per benchmark and
+dataset size. Runs against the database configured in the settings module,
+use --settings to point it to a PostgreSQL configured one.
+
+Usage::
+
+    ./run_benchmarks.py --sizes 10000,100000 --output results.json
+    ./run_benchmarks.py --sizes 10000 --compare results.json
+'''
+
+import os
+import sys
+import random
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from os.path import join, pardir, abspath, dirname
+
+
+# pythonpath dirs
+PYTHONPATH = [
+    abspath(join( dirname(__file__), pardir, pardir)),
+    abspath(join( dirname(__file__), pardir)),
+]
+
+# inject few paths to pythonpath
+for p in PYTHONPATH:
+    if p not in sys.path:
+        sys.path.insert(0, p)
+
+
+# number of distinct objects the synthetic ratings are spread over
+TARGETS = 1000
+# number of operations measured by read benchmarks
+READS = 1000
+# number of votes measured by write benchmarks
+VOTES = 1000
+# ratings are inserted in chunks of this size
+CHUNK_SIZE = 10000
+# synthetic ratings are spread over this many days back
+DAYS = 2*365
+
+
+class Benchmark(object):
+    """
+    Measures one operation - runs it count times, recording wall time and
+    number of queries it issued.
+    """
+    name = None
+    count = READS
+
+    def setup(self, targets):
+        self.targets = targets
+
+    def run(self, i):
+        raise NotImplementedError()
+
+    def measure(self, targets):
+        from django.db import connection, reset_queries
+
+        self.setup(targets)
+        reset_queries()
+        start = time.time()
+        for i in xrange(self.count):
+            self.run(i)
+        seconds = time.time() - start
+        queries = len(connection.queries)
+        return {
+            'name': self.name,
+            'operations': self.count,
+            'seconds': seconds,
+            'ops_per_sec': seconds and self.count / seconds or None,
+            'queries_per_op': float(queries) / self.count,
+        }
+
+
+class VoteBenchmark(Benchmark):
+    name = 'views.do_rate'
+    count = VOTES
+
+    def setup(self, targets):
+        from django.contrib.auth.models import AnonymousUser
+        from django.contrib.contenttypes.models import ContentType
+        from django.http import HttpRequest
+        super(VoteBenchmark, self).setup(targets)
+        self.ct = ContentType.objects.get_for_model(targets[0])
+        self.user = AnonymousUser()
+        self.request_class = HttpRequest
+
+    def run(self, i):
+        from django_ratings.views import do_rate
+        request = self.request_class()
+        request.user = self.user
+        request.META['REMOTE_ADDR'] = '10.%d.%d.%d' % (i // 65536 % 256, i // 256 % 256, i % 256)
+        request.META['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+        do_rate(request, self.ct, random.choice(self.targets), 1)
+
+
+class GetForObjectBenchmark(Benchmark):
+    name = 'TotalRate.objects.get_for_object'
+
+    def run(self, i):
+        from django_ratings.models import TotalRate
+        TotalRate.objects.get_for_object(random.choice(self.targets))
+
+
+class NormalizedRatingBenchmark(Benchmark):
+    name = 'TotalRate.objects.get_normalized_rating'
+
+    def run(self, i):
+        from decimal import Decimal
+        from django_ratings.models import TotalRate
+        TotalRate.objects.get_normalized_rating(random.choice(self.targets), Decimal(1), Decimal('0.5'))
+
+
+class TopObjectsBenchmark(Benchmark):
+    name = 'TotalRate.objects.get_top_objects'
+    count = 100
+
+    def run(self, i):
+        from django_ratings.models import TotalRate
+        TotalRate.objects.get_top_objects(10)
+
+
+class AggregationBenchmark(Benchmark):
+    name = 'aggregate_ratings'
+    count = 1
+
+    def run(self, i):
+        from django.db import transaction
+        from django_ratings.aggregation import transfer_data
+        transaction.commit_on_success(transfer_data)()
+
+
+# aggregation moves the ratings away, keep it last
+BENCHMARKS = [
+    GetForObjectBenchmark,
+    NormalizedRatingBenchmark,
+    TopObjectsBenchmark,
+    VoteBenchmark,
+    AggregationBenchmark,
+]
+
+
+def create_targets(count):
+    "Create count users to be rated."
+    from django.contrib.auth.models import User, UNUSABLE_PASSWORD
+    from django.db import transaction
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        for i in xrange(count):
+            User.objects.create(username='benchmark_%d' % i, password=UNUSABLE_PASSWORD)
+        transaction.commit()
+    finally:
+        transaction.leave_transaction_management()
+    return list(User.objects.filter(username__startswith='benchmark_'))
+
+
+def create_ratings(targets, size):
+    """
+    Insert size anonymous ratings of given targets spread over last DAYS days
+    and compute their total rates.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection, transaction
+    from django_ratings.models import Rating, TotalRate
+
+    ct_id = ContentType.objects.get_for_model(targets[0]).pk
+    now = datetime.now()
+    ids = [t.pk for t in targets]
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        for start in xrange(0, size, CHUNK_SIZE):
+            Rating.objects.insert_many([Rating(
+                    target_ct_id=ct_id,
+                    target_id=random.choice(ids),
+                    amount=random.choice((-1, 1)),
+                    time=now - timedelta(seconds=random.randint(0, DAYS*24*60*60)),
+                    ip_address='10.0.%d.%d' % (i // 256 % 256, i % 256),
+                ) for i in xrange(start, min(start + CHUNK_SIZE, size))])
+
+        qn = connection.ops.quote_name
+        connection.cursor().execute('''INSERT INTO %(tab_tr)s
+                    (amount, target_ct_id, target_id)
+                 SELECT
+                    SUM(amount), target_ct_id, target_id
+                 FROM
+                    %(tab_rating)s
+                 GROUP BY
+                    target_ct_id, target_id''' % {
+            'tab_tr': qn(TotalRate._meta.db_table),
+            'tab_rating': qn(Rating._meta.db_table),
+        })
+        transaction.commit()
+    finally:
+        transaction.leave_transaction_management()
+
+
+def run(sizes):
+    from django.conf import settings
+    from django.db import connection
+
+    settings.DEBUG = True
+    results = []
+    for size in sizes:
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            targets = create_targets(TARGETS)
+            create_ratings(targets, size)
+            for benchmark in BENCHMARKS:
+                result = benchmark().measure(targets)
+                result.update({
+                    'ratings': size,
+                    'backend': settings.DATABASE_ENGINE,
+                })
+                results.append(result)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def print_result(result, previous=None):
+    from django.utils import simplejson
+    if previous and previous.get('seconds') and result['seconds']:
+        result = dict(result, speedup=previous['seconds'] / result['seconds'])
+    print simplejson.dumps(result)
+
+
+def compare(results, path):
+    "Print results together with their speedup over results stored in path."
+    from django.utils import simplejson
+    previous = {}
+    for line in open(path):
+        if line.strip():
+            r = simplejson.loads(line)
+            previous[(r['name'], r['ratings'], r['backend'])] = r
+    for result in results:
+        print_result(result, previous.get((result['name'], result['ratings'], result['backend'])))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', dest='sizes', default='10000',
+            help='comma separated numbers of synthetic ratings, e.g. 10000,100000,10000000')
+    parser.add_option('--settings', dest='settings', default='unit_project.settings',
+            help='django settings module, defaults to unit_project.settings')
+    parser.add_option('--output', dest='output', default=None,
+            help='store results into given file, one JSON object per line')
+    parser.add_option('--compare', dest='compare', default=None,
+            help='compare results with previously stored ones')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+            help='seed of the random data generator')
+    options, args = parser.parse_args()
+
+    # django needs this env variable
+    os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
+    random.seed(options.seed)
+
+    results = run([int(s) for s in options.sizes.split(',')])
+
+    if options.compare:
+        compare(results, options.compare)
+    else:
+        for result in results:
+            print_result(result)
+    if options.output:
+        from django.utils import simplejson
+        f = open(options.output, 'w')
+        try:
+            for result in results:
+                f.write(simplejson.dumps(result) + '\n')
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
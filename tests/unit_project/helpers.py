@@ -1,4 +1,4 @@
-from djangosanetesting.cases import DatabaseTestCase
+from djangosanetesting.cases import DatabaseTestCase, DestructiveDatabaseTestCase
 
 from django.contrib.contenttypes.models import ContentType
 
@@ -28,3 +28,8 @@ class MultipleRatedObjectsTestCase(DatabaseTestCase):
                     )
                 )
 
+class DestructiveSimpleRateTestCase(DestructiveDatabaseTestCase, SimpleRateTestCase):
+    "SimpleRateTestCase for code that commits, the database is flushed afterwards."
+
+class DestructiveMultipleRatedObjectsTestCase(DestructiveDatabaseTestCase, MultipleRatedObjectsTestCase):
+    "MultipleRatedObjectsTestCase for code that commits, the database is flushed afterwards."
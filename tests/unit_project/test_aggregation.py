@@ -1,9 +1,16 @@
+from time import mktime
 from datetime import date, timedelta, datetime
 
-from django_ratings.models import TotalRate, Rating, Agg
-from django_ratings.aggregation import transfer_data
+from django.conf import settings
+from django.db import connection
+from django.contrib.contenttypes.models import ContentType
 
-from helpers import SimpleRateTestCase
+from django_ratings import models
+from django_ratings.models import TotalRate, Rating, Agg, Watermark
+from django_ratings.aggregation import transfer_data, get_rating_chunks, get_workers, \
+        WATERMARK_STAGE, WATERMARK_RUN, STAGE_AGGS
+
+from helpers import SimpleRateTestCase, DestructiveSimpleRateTestCase
 
 class TestAggregation(SimpleRateTestCase):
     def test_totalrate_from_aggregation(self):
@@ -93,4 +100,135 @@ class TestAggregation(SimpleRateTestCase):
         self.assert_equals(expected, [(a.time, a.people, a.amount) for a in Agg.objects.order_by('time')])
 
 
+class TestPeriodBuckets(SimpleRateTestCase):
+    def test_day_key(self):
+        self.assert_equals(20090315, models.get_day_key(datetime(2009, 3, 15, 23, 59)))
+
+    def test_bucket_time_of_month(self):
+        self.assert_equals(date(2009, 3, 1), models.get_bucket_time(20090300))
+
+    def test_bucket_time_of_year(self):
+        self.assert_equals(date(2009, 1, 1), models.get_bucket_time(20090000))
+
+    def test_agg_gets_bucket_of_its_period(self):
+        a = Agg.objects.create(people=1, amount=1, time=date(2009, 3, 15), period='m', detract=0, **self.kw)
+        self.assert_equals(20090300, a.bucket)
+
+    def test_rating_gets_day_key(self):
+        r = Rating.objects.create(amount=1, time=datetime(2009, 3, 15, 12), **self.kw)
+        self.assert_equals(20090315, Rating.objects.get(pk=r.pk).day)
+
+    def test_day_key_sql_of_datetime(self):
+        r = Rating.objects.create(amount=1, time=datetime(2009, 3, 15, 23, 59), **self.kw)
+        day, params = models.get_day_key_sql('time')
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s FROM %s' % (day, connection.ops.quote_name(Rating._meta.db_table)), params)
+        self.assert_equals(20090315, cursor.fetchone()[0])
+
+    def test_day_key_sql_of_date(self):
+        Agg.objects.create(people=1, amount=1, time=date(2009, 3, 5), period='d', detract=0, **self.kw)
+        day, params = models.get_day_key_sql('time')
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s FROM %s' % (day, connection.ops.quote_name(Agg._meta.db_table)), params)
+        self.assert_equals(20090305, cursor.fetchone()[0])
+
+    def test_fixing_times_of_content_type_leaves_others_alone(self):
+        rating_ct = ContentType.objects.get_for_model(Rating)
+        Agg.objects.create(people=1, amount=1, time=date(2009, 3, 15), period='m', detract=0, **self.kw)
+        Agg.objects.create(people=1, amount=1, time=date(2009, 3, 15), period='m', detract=0, target_ct=rating_ct, target_id=1)
+        Agg.objects.fix_times('month', [20090300], rating_ct.pk)
+        self.assert_equals(date(2009, 3, 1), Agg.objects.get(target_ct=rating_ct).time)
+        self.assert_equals(date(2009, 3, 15), Agg.objects.get(**self.kw).time)
+
+
+class TestIncrementalAggregation(SimpleRateTestCase):
+    def setUp(self):
+        super(TestIncrementalAggregation, self).setUp()
+        self.other = ContentType.objects.get_for_model(Rating)
+        self.other_kw = {
+                'target_ct': ContentType.objects.get_for_model(self.other),
+                'target_id': self.other.pk
+        }
+
+    def test_incremental_run_creates_total_rate(self):
+        Rating.objects.create(amount=1, **self.kw)
+        Rating.objects.create(amount=2, **self.kw)
+        transfer_data(incremental=True)
+        self.assert_equals(1, TotalRate.objects.count())
+        self.assert_equals(3, TotalRate.objects.get_for_object(self.obj))
+
+    def test_incremental_run_doesnt_touch_objects_without_new_ratings(self):
+        Rating.objects.create(amount=1, **self.kw)
+        Rating.objects.create(amount=2, **self.other_kw)
+        transfer_data(incremental=True)
+
+        # drift that only a full rebuild would fix
+        TotalRate.objects.filter(**self.other_kw).update(amount=100)
+        Rating.objects.create(amount=4, **self.kw)
+        transfer_data(incremental=True)
+
+        self.assert_equals(5, TotalRate.objects.get_for_object(self.obj))
+        self.assert_equals(100, TotalRate.objects.get_for_object(self.other))
+
+    def test_watermark_is_moved_after_run(self):
+        Rating.objects.create(amount=1, **self.kw)
+        transfer_data(incremental=True)
+        self.assert_equals(Agg.objects.order_by('-pk')[0].pk, Watermark.objects.get_value('agg'))
 
+    def test_ratings_with_reused_ids_are_found(self):
+        r = Rating.objects.create(amount=1, **self.kw)
+        transfer_data(incremental=True)
+        Rating.objects.create(pk=r.pk, amount=2, **self.kw)
+        transfer_data(incremental=True)
+        self.assert_equals(3, TotalRate.objects.get_for_object(self.obj))
+
+
+class TestChunkedAggregation(DestructiveSimpleRateTestCase):
+    def test_chunked_run_gives_same_results(self):
+        old = date.today() - timedelta(days=70)
+        Rating.objects.create(amount=1, time=old, **self.kw)
+        older = old - timedelta(days=40)
+        Rating.objects.create(amount=4, time=older, **self.kw)
+        Rating.objects.create(amount=8, time=older, **self.kw)
+
+        transfer_data(chunk_days=10)
+        expected = [
+                (older.replace(day=1),  2,  12  ),
+                (old.replace(day=1),    1,  1   ),
+            ]
+
+        self.assert_equals(0, Rating.objects.count())
+        self.assert_equals(expected, [(a.time, a.people, a.amount) for a in Agg.objects.order_by('time')])
+        self.assert_equals(13, TotalRate.objects.get_for_object(self.obj))
+        self.assert_equals(0, Watermark.objects.get_value(WATERMARK_STAGE))
+
+    def test_rating_chunks_cover_whole_range(self):
+        now = datetime.now()
+        Rating.objects.create(amount=1, time=now - timedelta(days=25), **self.kw)
+        chunks = list(get_rating_chunks(now, 10))
+        self.assert_equals(3, len(chunks))
+        self.assert_equals(None, chunks[0][1])
+        self.assert_equals(now, chunks[-1][2])
+        self.assert_equals([c[2] for c in chunks[:-1]], [c[1] for c in chunks[1:]])
+
+    def test_killed_run_is_resumed_from_checkpoint(self):
+        now = datetime.now().replace(microsecond=0)
+        Agg.objects.create(people=1, amount=5, time=now.date(), period='d', detract=0, **self.kw)
+        Watermark.objects.set_value(WATERMARK_RUN, int(mktime(now.timetuple())))
+        Watermark.objects.set_value(WATERMARK_STAGE, STAGE_AGGS)
+        # ratings are not moved again by the resumed run
+        Rating.objects.insert_many([Rating(amount=100, time=now, **self.kw)])
+
+        transfer_data(chunk_days=10)
+        self.assert_equals(1, Rating.objects.count())
+        self.assert_equals(5, TotalRate.objects.get_for_object(self.obj))
+        self.assert_equals(0, Watermark.objects.get_value(WATERMARK_STAGE))
+
+    def test_workers_run_serially_on_sqlite(self):
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            return
+        self.assert_equals(1, get_workers(4))
+        Rating.objects.create(amount=3, **self.kw)
+        transfer_data(chunk_days=10, workers=4)
+        self.assert_equals(0, Rating.objects.count())
+        self.assert_equals(3, TotalRate.objects.get_for_object(self.obj))
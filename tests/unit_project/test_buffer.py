@@ -0,0 +1,96 @@
+from datetime import datetime
+
+from django.contrib.auth.models import User, AnonymousUser, UNUSABLE_PASSWORD
+from django.http import HttpRequest
+
+from django_ratings.models import TotalRate, Rating
+from django_ratings.buffer import VoteBuffer
+
+from helpers import DestructiveSimpleRateTestCase
+
+class TestVoteBuffer(DestructiveSimpleRateTestCase):
+    def setUp(self):
+        super(TestVoteBuffer, self).setUp()
+        self.buffer = VoteBuffer(size=10, timeout=None)
+        self.user = User.objects.create(
+                username='some_username',
+                password=UNUSABLE_PASSWORD
+            )
+
+    def test_ratings_are_not_saved_before_flush(self):
+        self.buffer.add(Rating(amount=10, **self.kw))
+        self.assert_equals(0, Rating.objects.count())
+        self.assert_equals(1, self.buffer.stats()['queue_depth'])
+
+    def test_flush_saves_ratings_and_total_rate(self):
+        self.buffer.add(Rating(amount=10, **self.kw))
+        self.buffer.add(Rating(amount=5, **self.kw))
+        self.assert_equals(2, self.buffer.flush())
+        self.assert_equals(2, Rating.objects.count())
+        self.assert_equals(15, TotalRate.objects.get_for_object(self.obj))
+
+    def test_buffer_flushes_when_full(self):
+        for i in range(10):
+            self.buffer.add(Rating(amount=1, **self.kw))
+        self.assert_equals(10, Rating.objects.count())
+        self.assert_equals(0, self.buffer.stats()['queue_depth'])
+        self.assert_equals(1, self.buffer.stats()['flushes'])
+
+    def test_duplicate_user_ratings_are_dropped(self):
+        Rating.objects.create(amount=10, user=self.user, **self.kw)
+        self.buffer.add(Rating(amount=5, user=self.user, **self.kw))
+        self.assert_equals(0, self.buffer.flush())
+        self.assert_equals(1, self.buffer.stats()['dropped'])
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+
+    def test_duplicate_ip_ratings_within_one_batch_are_dropped(self):
+        now = datetime.now()
+        self.buffer.add(Rating(amount=5, ip_address='127.0.0.1', time=now, **self.kw))
+        self.buffer.add(Rating(amount=5, ip_address='127.0.0.1', time=now, **self.kw))
+        self.assert_equals(1, self.buffer.flush())
+        self.assert_equals(5, TotalRate.objects.get_for_object(self.obj))
+
+    def test_full_buffer_is_not_flushed_by_caller_that_doesnt_wait(self):
+        buffer = VoteBuffer(size=1, timeout=60)
+        buffer._start_flusher = lambda: None
+        buffer._flusher = object()
+        buffer.add(Rating(amount=1, **self.kw), wait=False)
+        self.assert_equals(0, Rating.objects.count())
+        self.assert_true(buffer._wakeup.isSet())
+
+
+class TestDeferredRate(DestructiveSimpleRateTestCase):
+    def setUp(self):
+        super(TestDeferredRate, self).setUp()
+        # views get the current site on import
+        from django_ratings import views
+        self.views = views
+        self.votes = views.votes
+        views.votes = self.buffer = VoteBuffer(size=10, timeout=None)
+
+    def tearDown(self):
+        self.views.votes = self.votes
+        super(TestDeferredRate, self).tearDown()
+
+    def rate(self):
+        request = HttpRequest()
+        request.method = 'POST'
+        request.POST = {'rating': '1'}
+        request.COOKIES = {}
+        request.META = {'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+        request.user = AnonymousUser()
+        return self.views.rate_deferred(request, [], {'content_type': self.kw['target_ct'], 'object': self.obj})
+
+    def test_response_doesnt_wait_for_rating_to_be_saved(self):
+        response = self.rate()
+        self.assert_equals(200, response.status_code)
+        self.assert_equals(0, Rating.objects.count())
+        self.assert_equals(1, self.buffer.flush())
+        self.assert_equals(1, Rating.objects.count())
+
+    def test_success_is_reported_for_rating_dropped_later(self):
+        Rating.objects.create(amount=1, ip_address='127.0.0.1', time=datetime.now(), **self.kw)
+        response = self.rate()
+        self.assert_equals(200, response.status_code)
+        self.assert_equals(0, self.buffer.flush())
+        self.assert_equals(1, Rating.objects.count())
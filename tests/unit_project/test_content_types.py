@@ -0,0 +1,33 @@
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+from django_ratings.content_types import ContentTypeMap
+
+from helpers import SimpleRateTestCase
+
+class TestContentTypeMap(SimpleRateTestCase):
+    def setUp(self):
+        super(TestContentTypeMap, self).setUp()
+        ContentType.objects.clear_cache()
+        self.map = ContentTypeMap()
+
+    def test_lookup_by_model_and_instance(self):
+        ct = ContentType.objects.get_for_model(User)
+        self.assert_equals(ct, self.map.get_for_model(User))
+        self.assert_equals(ct.pk, self.map.get_id(User()))
+
+    def test_lookup_by_id(self):
+        ct = ContentType.objects.get_for_model(User)
+        self.assert_equals(ct, self.map.get_for_id(ct.pk))
+        self.assert_equals(User, self.map.get_model(ct.pk))
+
+    def test_instances_are_shared_with_content_type_manager(self):
+        self.assert_true(ContentType.objects.get_for_model(User) is self.map.get_for_model(User))
+        self.assert_true(ContentType.objects.get_for_model(ContentType) is self.map.get_for_id(self.kw['target_ct'].pk))
+
+    def test_map_is_warmed_with_one_query(self):
+        self.map.reset_stats()
+        self.map.get_for_model(User)
+        self.map.get_for_model(ContentType)
+        self.map.get_for_id(self.kw['target_ct'].pk)
+        self.assert_equals({'hits': 3, 'queries': 1}, self.map.stats())
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+from djangosanetesting.cases import UnitTestCase
+
+from django_ratings import cookies
+from django_ratings.cookies import pack_varint, unpack_varints, encode_votes, decode_votes
+
+class TestVarints(UnitTestCase):
+    def test_small_numbers_take_one_byte(self):
+        self.assert_equals(1, len(pack_varint(127)))
+
+    def test_numbers_survive_round_trip(self):
+        values = [0, 1, 127, 128, 300, 2**31 - 1]
+        self.assert_equals(values, unpack_varints(''.join(map(pack_varint, values))))
+
+    def test_truncated_data_raises_error(self):
+        self.assert_raises(ValueError, unpack_varints, pack_varint(300)[:1])
+
+
+class TestVoteCookie(UnitTestCase):
+    def test_votes_survive_round_trip(self):
+        votes = [(12, 1), (12, 100000), (3, 7)]
+        self.assert_equals(votes, decode_votes(encode_votes(votes)))
+
+    def test_forged_cookie_is_ignored(self):
+        data, signature = encode_votes([(12, 1)]).split('.')
+        forged = encode_votes([(12, 2)]).split('.')[0]
+        self.assert_equals([], decode_votes('%s.%s' % (forged, signature)))
+
+    def test_old_format_is_understood_until_given_time(self):
+        cookies.RATINGS_LEGACY_COOKIES_UNTIL = datetime.now() + timedelta(days=1)
+        try:
+            self.assert_equals([(12, 1), (3, 7)], decode_votes(u'12:1,3:7'))
+        finally:
+            cookies.RATINGS_LEGACY_COOKIES_UNTIL = None
+
+    def test_old_format_is_ignored_after_given_time(self):
+        cookies.RATINGS_LEGACY_COOKIES_UNTIL = datetime.now() - timedelta(seconds=1)
+        try:
+            self.assert_equals([], decode_votes(u'12:1,3:7'))
+        finally:
+            cookies.RATINGS_LEGACY_COOKIES_UNTIL = None
+
+    def test_old_format_is_understood_for_one_cookie_lifetime_by_default(self):
+        from django_ratings.models import RATINGS_MAX_COOKIE_AGE
+        self.assert_equals([(12, 1), (3, 7)], decode_votes(u'12:1,3:7'))
+        self.assert_equals(cookies.STARTED + timedelta(seconds=RATINGS_MAX_COOKIE_AGE), cookies.get_legacy_deadline())
+
+    def test_default_number_of_votes_fits_in_cookie(self):
+        from django_ratings.models import RATINGS_MAX_COOKIE_LENGTH
+        votes = [(100, 2 ** 28 + i) for i in range(RATINGS_MAX_COOKIE_LENGTH)]
+        self.assert_true(len(encode_votes(votes)) <= 1024)
+
+    def test_broken_cookie_is_ignored(self):
+        self.assert_equals([], decode_votes('garbage'))
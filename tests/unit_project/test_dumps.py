@@ -0,0 +1,77 @@
+from StringIO import StringIO
+from datetime import datetime
+from decimal import Decimal
+
+from django.contrib.contenttypes.models import ContentType
+
+from django_ratings.models import Rating, Agg, TotalRate, AnonymousVote
+from django_ratings import dumps
+
+from helpers import DestructiveMultipleRatedObjectsTestCase
+
+class TestDumps(DestructiveMultipleRatedObjectsTestCase):
+    def export(self, names, chunk_size=2):
+        out = StringIO()
+        dumps.write_jsonl(names, out, chunk_size)
+        return out.getvalue().splitlines()
+
+    def test_export_writes_all_records_in_chunks(self):
+        lines = self.export(['rating'])
+        self.assert_equals(len(self.objs), len(lines))
+
+    def test_round_trip_recomputes_totalrate(self):
+        Rating.objects.move_rate_to_agg(self.ratings[-1].time, 'day')
+        self.assert_true(Agg.objects.count() > 0)
+        totals = dict((tr.target_id, tr.amount) for tr in TotalRate.objects.all())
+        lines = self.export(['rating', 'agg', 'totalrate'])
+
+        Rating.objects.all().delete()
+        Agg.objects.all().delete()
+        TotalRate.objects.all().delete()
+
+        counts = dumps.import_records(dumps.read_jsonl(lines), chunk_size=2)
+        self.assert_equals(0, TotalRate.objects.count())
+        self.assert_false('totalrate' in counts)
+        dumps.recompute_totalrate()
+        self.assert_equals(totals, dict((tr.target_id, tr.amount) for tr in TotalRate.objects.all()))
+
+    def test_recompute_counts_ratings_without_moving_them(self):
+        totals = dict((tr.target_id, tr.amount) for tr in TotalRate.objects.all())
+        ratings = Rating.objects.count()
+        TotalRate.objects.all().delete()
+        dumps.recompute_totalrate()
+        self.assert_equals(totals, dict((tr.target_id, tr.amount) for tr in TotalRate.objects.all()))
+        self.assert_equals(ratings, Rating.objects.count())
+        self.assert_equals(0, Agg.objects.count())
+
+    def test_import_recreates_votes_of_anonymous_ratings(self):
+        now = datetime.now()
+        Rating.objects.all().delete()
+        AnonymousVote.objects.all().delete()
+        record = {'target_ct_id': 'contenttypes.contenttype', 'target_id': self.objs[0].pk,
+                'time': now.isoformat(), 'amount': '1', 'ip_address': '127.0.0.1'}
+        dumps.import_records([('rating', record), ('rating', dict(record))])
+        self.assert_equals(1, AnonymousVote.objects.count())
+
+        Rating.objects.create(amount=1, ip_address='127.0.0.1', time=now, target_ct=ContentType.objects.get_for_model(ContentType), target_id=self.objs[0].pk)
+        self.assert_equals(2, Rating.objects.count())
+
+    def test_csv_round_trip(self):
+        out = StringIO()
+        dumps.write_csv('rating', out)
+        amounts = sorted(Rating.objects.values_list('amount', flat=True))
+        Rating.objects.all().delete()
+
+        dumps.import_records(dumps.read_csv('rating', StringIO(out.getvalue())))
+        self.assert_equals(amounts, sorted(Rating.objects.values_list('amount', flat=True)))
+        self.assert_equals(Decimal, type(amounts[0]))
+
+    def test_unknown_content_type_raises_value_error(self):
+        records = [('rating', {'target_ct_id': 'nosuchapp.model', 'target_id': 1, 'time': '2009-03-15T12:00:00', 'amount': '1'})]
+        self.assert_raises(ValueError, dumps.import_records, records)
+
+    def test_datetime_with_microseconds_is_loaded(self):
+        self.assert_equals(datetime(2009, 3, 15, 12, 0, 0, 500), dumps._load_value('datetime', '2009-03-15T12:00:00.000500', {}))
+
+    def test_datetime_without_microseconds_is_loaded(self):
+        self.assert_equals(datetime(2009, 3, 15, 12), dumps._load_value('datetime', '2009-03-15T12:00:00', {}))
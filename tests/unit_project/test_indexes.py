@@ -0,0 +1,28 @@
+from djangosanetesting.cases import DatabaseTestCase, DestructiveDatabaseTestCase
+
+from django.db import connection
+
+from django_ratings import indexes
+from django_ratings.models import TotalRate, Rating, Agg
+
+class TestCompositeIndexes(DatabaseTestCase):
+    def test_syncdb_creates_composite_indexes(self):
+        cursor = connection.cursor()
+        for model in (TotalRate, Rating, Agg):
+            for fields in model.composite_indexes:
+                self.assert_true(indexes.index_exists(cursor, model, indexes.get_index_name(model, fields)))
+
+    def test_existing_index_is_not_created_again(self):
+        self.assert_false(indexes.create_index(TotalRate, ('target_ct', 'amount')))
+
+    def test_index_name_contains_columns(self):
+        self.assert_equals('django_ratings_totalrate_target_ct_id_amount', indexes.get_index_name(TotalRate, ('target_ct', 'amount')))
+
+class TestIndexMigration(DestructiveDatabaseTestCase):
+    def test_dropped_index_gets_created(self):
+        fields = ('target_ct', 'time')
+        indexes.drop_index(Rating, fields)
+        cursor = connection.cursor()
+        self.assert_false(indexes.index_exists(cursor, Rating, indexes.get_index_name(Rating, fields)))
+        self.assert_true(indexes.create_index(Rating, fields))
+        self.assert_true(indexes.index_exists(cursor, Rating, indexes.get_index_name(Rating, fields)))
@@ -0,0 +1,32 @@
+from djangosanetesting.cases import UnitTestCase
+
+from django_ratings.instrumentation import instrumented
+from django_ratings.signals import measured
+
+class TestInstrumented(UnitTestCase):
+    def setUp(self):
+        super(TestInstrumented, self).setUp()
+        self.measurements = []
+        measured.connect(self.receive)
+
+    def tearDown(self):
+        measured.disconnect(self.receive)
+        super(TestInstrumented, self).tearDown()
+
+    def receive(self, sender, name, queries, seconds, cache_hits, **kwargs):
+        self.measurements.append((name, queries, cache_hits))
+
+    def test_disabled_decorator_returns_function_untouched(self):
+        f = lambda: 1
+        self.assert_true(f is instrumented('f', enabled=False)(f))
+
+    def test_enabled_decorator_reports_calls(self):
+        f = instrumented('f', enabled=True)(lambda x: x * 2)
+        self.assert_equals(4, f(2))
+        self.assert_equals([('f', 0, 0)], self.measurements)
+
+    def test_failing_calls_are_reported(self):
+        def f():
+            raise ValueError()
+        self.assert_raises(ValueError, instrumented('f', enabled=True)(f))
+        self.assert_equals(1, len(self.measurements))
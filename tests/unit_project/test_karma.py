@@ -1,11 +1,23 @@
 from django.contrib.auth.models import User, UNUSABLE_PASSWORD
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ImproperlyConfigured
+from django.db import models, transaction
 
 from django_ratings import karma
-from django_ratings.models import TotalRate, UserKarma
+from django_ratings.models import TotalRate, UserKarma, Rating
+from django_ratings.signals import total_rate_changed
 
-from helpers import SimpleRateTestCase
+from helpers import SimpleRateTestCase, DestructiveSimpleRateTestCase
+
+class ContentTypeProxy(ContentType):
+    class Meta:
+        proxy = True
+        app_label = 'contenttypes'
+
+class OtherContentTypeProxy(ContentType):
+    class Meta:
+        proxy = True
+        app_label = 'contenttypes'
 
 class KarmaTestCase(SimpleRateTestCase):
     def setUp(self):
@@ -47,6 +59,22 @@ class TestKarmaCalculation(KarmaTestCase):
         self.assert_equals(self.user, k.user)
         self.assert_equals(100,  k.karma)
 
+    def test_karma_gets_created_for_owner_field(self):
+        karma.sources.register(Rating, None, 3, owner_field='user')
+        r = Rating.objects.create(amount=1, user=self.user, **self.kw)
+        TotalRate.objects.create(amount=10, target_ct=ContentType.objects.get_for_model(Rating), target_id=r.pk)
+        UserKarma.objects.total_rate_to_karma()
+
+        # 1 for the ContentType rated by the rating, 30 for the rating itself
+        self.assert_equals(31, UserKarma.objects.get(user=self.user).karma)
+
+    def test_karma_is_summed_over_chunks(self):
+        other = ContentType.objects.get_for_model(User)
+        TotalRate.objects.create(amount=100, **self.kw)
+        TotalRate.objects.create(amount=10, target_ct=self.kw['target_ct'], target_id=other.pk)
+        UserKarma.objects.total_rate_to_karma(chunk_size=1)
+        self.assert_equals(110, UserKarma.objects.get(user=self.user).karma)
+
     def test_calculate_can_cope_with_existing_karmas(self):
         UserKarma.objects.create(user=self.user, karma=10000)
         TotalRate.objects.create(amount=100, **self.kw)
@@ -76,6 +104,23 @@ class TestKarmaSources(KarmaTestCase):
         karma.sources.register(User, lambda u:u)
         self.assert_raises(ImproperlyConfigured, karma.sources.register, User, lambda u: u.pk)
 
+    def test_returns_owner_for_owner_field(self):
+        karma.sources.register(UserKarma, None, owner_field='user')
+        k = UserKarma.objects.create(user=self.user, karma=0)
+        self.assert_equals((self.user, 1), karma.sources.get_owner(k))
+
+    def test_get_owner_ids_for_owner_field(self):
+        karma.sources.register(UserKarma, None, owner_field='user')
+        k = UserKarma.objects.create(user=self.user, karma=0)
+        self.assert_equals({k.pk: self.user.pk}, karma.sources.get_owner_ids(UserKarma, [k.pk]))
+
+    def test_get_owner_ids_for_owner_getter(self):
+        karma.sources.register(User, lambda u:u)
+        self.assert_equals({self.user.pk: self.user.pk}, karma.sources.get_owner_ids(User, [self.user.pk]))
+
+    def test_raises_error_without_getter_and_field(self):
+        self.assert_raises(ImproperlyConfigured, karma.sources.register, User, None)
+
     def test_weight_gets_matched_correctly(self):
         karma.sources.register(User, lambda u:u, 100)
         self.assert_equals((self.user, 100), karma.sources.get_owner(self.user))
@@ -100,3 +145,136 @@ class TestKarmaSources(KarmaTestCase):
                 sorted(karma.sources.registered_content_types())
             )
 
+
+
+class TestKarmaDeltas(DestructiveSimpleRateTestCase, KarmaTestCase):
+    def setUp(self):
+        super(TestKarmaDeltas, self).setUp()
+        karma.sources.register(ContentType, lambda u: self.user, 2)
+        self.deltas = karma.KarmaDeltas()
+        total_rate_changed.connect(self.deltas.receive, sender=TotalRate)
+        transaction.commit()
+
+    def tearDown(self):
+        total_rate_changed.disconnect(self.deltas.receive, sender=TotalRate)
+        super(TestKarmaDeltas, self).tearDown()
+
+    def test_rating_adds_weighted_karma_to_owner(self):
+        Rating.objects.create(amount=10, **self.kw)
+        transaction.commit()
+        self.assert_equals(20, UserKarma.objects.get(user=self.user).karma)
+
+    def test_ratings_add_up(self):
+        Rating.objects.create(amount=10, **self.kw)
+        transaction.commit()
+        Rating.objects.create(amount=-4, **self.kw)
+        transaction.commit()
+        self.assert_equals(12, UserKarma.objects.get(user=self.user).karma)
+
+    def test_changes_are_applied_once_transaction_commits(self):
+        Rating.objects.create(amount=10, **self.kw)
+        Rating.objects.create(amount=5, **self.kw)
+        self.assert_equals(0, UserKarma.objects.count())
+        transaction.commit()
+        self.assert_equals(30, UserKarma.objects.get(user=self.user).karma)
+
+    def test_changes_of_rolled_back_transaction_are_dropped(self):
+        Rating.objects.create(amount=10, **self.kw)
+        transaction.rollback()
+        Rating.objects.create(amount=5, **self.kw)
+        transaction.commit()
+        self.assert_equals(10, UserKarma.objects.get(user=self.user).karma)
+
+    def test_discarded_changes_are_not_applied(self):
+        Rating.objects.create(amount=10, **self.kw)
+        self.deltas.discard()
+        transaction.commit()
+        self.assert_equals(0, UserKarma.objects.count())
+
+    def test_unregistered_models_are_ignored(self):
+        user_ct = ContentType.objects.get_for_model(User)
+        Rating.objects.create(amount=10, target_ct=user_ct, target_id=self.user.pk)
+        self.assert_equals(0, UserKarma.objects.count())
+
+    def test_karma_created_meanwhile_gets_updated(self):
+        UserKarma.objects.create(user=self.user, karma=1)
+        # the other process inserted the record after it was looked up
+        UserKarma.objects.filter = lambda **kwargs: UserKarma.objects.none()
+        try:
+            UserKarma.objects.add_karmas({self.user.pk: 5})
+        finally:
+            del UserKarma.objects.filter
+        self.assert_equals(6, UserKarma.objects.get(user=self.user).karma)
+
+    def test_failing_karma_doesnt_fail_rating(self):
+        def fail(amounts):
+            raise ValueError()
+        karma.sources.get_karmas = fail
+        try:
+            Rating.objects.create(amount=10, **self.kw)
+            transaction.commit()
+        finally:
+            del karma.sources.get_karmas
+        self.assert_equals(1, Rating.objects.count())
+
+
+class TestKarmaSourcesIndex(KarmaTestCase):
+
+    def test_subclasses_share_registration_of_their_ancestor(self):
+        karma.sources.register(models.Model, lambda o: o, 5)
+        self.assert_equals((self.user, 5), karma.sources.get_owner(self.user))
+
+    def test_get_source_for_ct_returns_model_and_source(self):
+        f = lambda u:u
+        karma.sources.register(User, f, 2)
+        user_ct = ContentType.objects.get_for_model(User)
+        self.assert_equals((User, (f, 2, None)), karma.sources.get_source_for_ct(user_ct.pk))
+
+    def test_get_source_for_ct_returns_none_for_non_registered_model(self):
+        self.assert_equals(None, karma.sources.get_source_for_ct(self.kw['target_ct'].pk))
+
+    def test_registration_resets_index(self):
+        ct_id = self.kw['target_ct'].pk
+        self.assert_equals(None, karma.sources.get_source_for_ct(ct_id))
+        karma.sources.register(ContentType, lambda u: self.user)
+        self.assert_equals(ContentType, karma.sources.get_source_for_ct(ct_id)[0])
+
+    def test_get_karmas_resolves_owners_from_targets(self):
+        karma.sources.register(UserKarma, None, 2, owner_field='user')
+        k = UserKarma.objects.create(user=self.user, karma=0)
+        user_karma_ct = ContentType.objects.get_for_model(UserKarma)
+        amounts = {
+            (user_karma_ct.pk, k.pk): 10,
+            (self.kw['target_ct'].pk, self.obj.pk): 100,
+        }
+        self.assert_equals({self.user.pk: 20}, karma.sources.get_karmas(amounts))
+
+    def test_karma_is_computed_for_subclasses(self):
+        karma.sources.register(models.Model, lambda o: self.user)
+        TotalRate.objects.create(amount=100, **self.kw)
+        UserKarma.objects.total_rate_to_karma()
+        self.assert_equals(100, UserKarma.objects.get(user=self.user).karma)
+
+    def test_registered_proxy_resolves_owners_of_its_content_type(self):
+        owners = []
+        def get_owner(o):
+            owners.append(o)
+            return self.user
+        karma.sources.register(ContentTypeProxy, get_owner, 3)
+        ct_id = self.kw['target_ct'].pk
+        self.assert_equals(ContentTypeProxy, karma.sources.get_source_for_ct(ct_id)[0])
+        TotalRate.objects.create(amount=10, **self.kw)
+        UserKarma.objects.total_rate_to_karma()
+        self.assert_equals(30, UserKarma.objects.get(user=self.user).karma)
+        self.assert_equals([ContentTypeProxy], [o.__class__ for o in owners])
+
+    def test_registered_concrete_model_takes_precedence_over_proxy(self):
+        f = lambda o: self.user
+        karma.sources.register(ContentTypeProxy, lambda o: None)
+        karma.sources.register(ContentType, f)
+        ct_id = self.kw['target_ct'].pk
+        self.assert_equals((ContentType, (f, 1, None)), karma.sources.get_source_for_ct(ct_id))
+
+    def test_proxies_of_the_same_model_cannot_be_registered(self):
+        karma.sources.register(ContentTypeProxy, lambda o: self.user)
+        self.assert_raises(ImproperlyConfigured, karma.sources.register, OtherContentTypeProxy, lambda o: self.user)
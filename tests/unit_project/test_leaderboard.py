@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.template import Template, Context, TemplateSyntaxError
+
+from django_ratings import models
+from django_ratings.models import Leaderboard, Rating, Agg
+
+from helpers import MultipleRatedObjectsTestCase
+
+class TestLeaderboard(MultipleRatedObjectsTestCase):
+    def setUp(self):
+        super(TestLeaderboard, self).setUp()
+        self.meta_ct = ContentType.objects.get_for_model(ContentType)
+        self.rating_ct = ContentType.objects.get_for_model(Rating)
+
+    def tearDown(self):
+        super(TestLeaderboard, self).tearDown()
+        models.RATINGS_LEADERBOARD_LIVE = False
+        models.RATINGS_LEADERBOARDS = False
+
+    def test_all_time_leaderboard_follows_total_rate(self):
+        Leaderboard.objects.refresh()
+        self.assert_equals(list(ContentType.objects.order_by('-pk')[:3]), Leaderboard.objects.get_top_objects(3))
+
+    def test_size_limits_leaderboard(self):
+        Leaderboard.objects.refresh(size=2)
+        self.assert_equals(2, len(Leaderboard.objects.get_top_objects(10)))
+
+    def test_day_window_ignores_old_ratings(self):
+        Rating.objects.all().delete()
+        old = datetime.now() - timedelta(days=3)
+        Agg.objects.create(target_ct=self.meta_ct, target_id=self.objs[0].pk, amount=1000, people=1, time=old.date(), period='d')
+        Rating.objects.create(target_ct=self.meta_ct, target_id=self.objs[1].pk, amount=1)
+        Leaderboard.objects.refresh()
+        self.assert_equals([self.objs[1]], Leaderboard.objects.get_top_objects(10, window='d'))
+        self.assert_equals([self.objs[0], self.objs[1]], Leaderboard.objects.get_top_objects(10, window='w'))
+
+    def test_leaderboards_per_content_type(self):
+        Rating.objects.create(target_ct=self.rating_ct, target_id=self.ratings[0].pk, amount=1)
+        Leaderboard.objects.refresh()
+        self.assert_equals([self.ratings[0]], Leaderboard.objects.get_top_objects(10, mods=[Rating]))
+        self.assert_equals(self.objs[-1], Leaderboard.objects.get_top_objects(1, mods=[Rating, ContentType])[0])
+
+    def test_live_updates_reorder_leaderboard(self):
+        models.RATINGS_LEADERBOARDS = True
+        models.RATINGS_LEADERBOARD_LIVE = True
+        Leaderboard.objects.refresh()
+        Rating.objects.create(target_ct=self.meta_ct, target_id=self.objs[0].pk, amount=100000)
+        self.assert_equals(self.objs[0], Leaderboard.objects.get_top_objects(1)[0])
+
+    def test_refresh_replaces_entries(self):
+        Leaderboard.objects.refresh(size=2)
+        count = Leaderboard.objects.count()
+        Leaderboard.objects.refresh(size=2)
+        self.assert_equals(count, Leaderboard.objects.count())
+
+
+class TestTopRatedTag(MultipleRatedObjectsTestCase):
+    def setUp(self):
+        super(TestTopRatedTag, self).setUp()
+        # {% load %} imports the tags as django.templatetags.ratings
+        from django.templatetags import ratings
+        self.tags = ratings
+
+    def tearDown(self):
+        super(TestTopRatedTag, self).tearDown()
+        self.tags.RATINGS_LEADERBOARDS = False
+
+    def render_top(self, window):
+        context = Context()
+        Template('{%% load ratings %%}{%% top_rated 3 for %s as top %%}' % window).render(context)
+        return context['top']
+
+    def test_all_window_without_leaderboards_reads_total_rate(self):
+        self.assert_equals(list(ContentType.objects.order_by('-pk')[:3]), self.render_top('all'))
+
+    def test_other_windows_without_leaderboards_are_refused(self):
+        self.assert_raises(TemplateSyntaxError, self.render_top, 'week')
+
+    def test_all_window_reads_total_rate_before_first_refresh(self):
+        self.tags.RATINGS_LEADERBOARDS = True
+        self.assert_equals(list(ContentType.objects.order_by('-pk')[:3]), self.render_top('all'))
+
+    def test_window_reads_leaderboard(self):
+        self.tags.RATINGS_LEADERBOARDS = True
+        Leaderboard.objects.refresh(size=1)
+        self.assert_equals(list(ContentType.objects.order_by('-pk')[:1]), self.render_top('day'))
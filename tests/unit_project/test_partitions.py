@@ -0,0 +1,18 @@
+from datetime import datetime
+
+from djangosanetesting.cases import UnitTestCase
+
+from django_ratings import partitions
+
+class TestPartitionNames(UnitTestCase):
+    def test_partition_is_named_by_day(self):
+        self.assert_equals('django_ratings_rating_20091231', partitions.get_partition_name(datetime(2009, 12, 31, 23, 59)))
+
+    def test_next_day_rolls_over_year(self):
+        self.assert_equals(datetime(2010, 1, 1), partitions.get_next_day(datetime(2009, 12, 31, 15)))
+
+    def test_next_day_rolls_over_month(self):
+        self.assert_equals(datetime(2009, 3, 1), partitions.get_next_day(datetime(2009, 2, 28)))
+
+    def test_day_start(self):
+        self.assert_equals(datetime(2009, 2, 28), partitions.get_day_start(datetime(2009, 2, 28, 12)))
@@ -1,8 +1,18 @@
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User, UNUSABLE_PASSWORD
 from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import transaction, connection
+from django.template import Template, Context
 
-from django_ratings.models import TotalRate, Rating
+from django_ratings import models, percentiles, caching
+from django_ratings.models import TotalRate, TotalRateShard, Rating, Agg, MINIMAL_ANONYMOUS_IP_DELAY, \
+        RATING_ACCEPTED, RATING_DUPLICATE
 
-from helpers import SimpleRateTestCase, MultipleRatedObjectsTestCase
+from helpers import SimpleRateTestCase, MultipleRatedObjectsTestCase, \
+        DestructiveSimpleRateTestCase, DestructiveMultipleRatedObjectsTestCase
 
 class TestTotalRate(SimpleRateTestCase):
     def test_default_rating_of_an_object(self):
@@ -24,6 +34,88 @@ class TestTotalRate(SimpleRateTestCase):
         r = Rating.objects.create(amount=100, **self.kw)
         self.assert_equals(110, TotalRate.objects.get_for_object(self.obj))
 
+class TestSharedCache(SimpleRateTestCase):
+    def test_local_memory_cache_is_not_shared(self):
+        self.assert_false(caching.is_shared(get_cache('locmem://')))
+        self.assert_false(caching.is_shared(get_cache('dummy://')))
+
+    def test_database_cache_is_shared(self):
+        self.assert_true(caching.is_shared(get_cache('db://ratings_cache')))
+
+class CallRecordingCache(object):
+    "Cache wrapper remembering names of methods called."
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.backend, name)
+
+class TestCachedTotalRate(DestructiveSimpleRateTestCase):
+    # invalidations take effect once the transaction commits
+    def setUp(self):
+        super(TestCachedTotalRate, self).setUp()
+        models.RATINGS_CACHE = True
+        self.orig_totals = caching.totals
+        self.backend = CallRecordingCache(get_cache('locmem://'))
+        caching.totals = caching.TotalRateCache(self.backend)
+
+    def tearDown(self):
+        super(TestCachedTotalRate, self).tearDown()
+        models.RATINGS_CACHE = False
+        caching.totals = self.orig_totals
+
+    def test_second_read_is_served_from_cache(self):
+        Rating.objects.create(amount=10, **self.kw)
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+        TotalRate.objects.all().update(amount=100)
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+        self.assert_equals({'hits': 1, 'misses': 1}, caching.totals.stats())
+
+    def test_cached_read_is_one_request(self):
+        Rating.objects.create(amount=10, **self.kw)
+        TotalRate.objects.get_for_object(self.obj)
+        self.backend.calls = []
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+        self.assert_equals(['get_many'], self.backend.calls)
+
+    def test_unrated_object_is_cached(self):
+        self.assert_equals(0, TotalRate.objects.get_for_object(self.obj))
+        self.assert_equals(0, TotalRate.objects.get_for_object(self.obj))
+        self.assert_equals({'hits': 1, 'misses': 1}, caching.totals.stats())
+
+    def test_rating_invalidates_cached_value_once_it_commits(self):
+        Rating.objects.create(amount=10, **self.kw)
+        transaction.commit()
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+        Rating.objects.create(amount=5, **self.kw)
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+        transaction.commit()
+        self.assert_equals(15, TotalRate.objects.get_for_object(self.obj))
+
+    def test_value_read_before_invalidation_is_not_cached(self):
+        ct_id = self.kw['target_ct'].pk
+        amount, stamp = caching.totals.get(ct_id, self.obj.pk)
+        caching.totals.invalidate(ct_id, self.obj.pk)
+        transaction.commit()
+        caching.totals.set(ct_id, self.obj.pk, 10, stamp)
+        self.assert_equals(None, caching.totals.get(ct_id, self.obj.pk)[0])
+
+    def test_invalidate_all_drops_cached_values(self):
+        Rating.objects.create(amount=10, **self.kw)
+        TotalRate.objects.get_for_object(self.obj)
+        TotalRate.objects.all().update(amount=100)
+        caching.totals.invalidate_all()
+        transaction.commit()
+        self.assert_equals(100, TotalRate.objects.get_for_object(self.obj))
+
+    def test_bulk_lookup_uses_cache(self):
+        Rating.objects.create(amount=10, **self.kw)
+        TotalRate.objects.get_for_object(self.obj)
+        TotalRate.objects.all().update(amount=100)
+        self.assert_equals({(self.kw['target_ct'].pk, self.obj.pk): 10}, TotalRate.objects.get_for_objects([self.obj]))
+
 class TestNormalizedRating(MultipleRatedObjectsTestCase):
     def test_distribution_in_smaller_universum(self):
         objs = []
@@ -39,6 +131,126 @@ class TestNormalizedRating(MultipleRatedObjectsTestCase):
             objs.append((TotalRate.objects.get_for_object(ct), TotalRate.objects.get_normalized_rating(ct, top)))
         self.assert_equals([(ct.pk*10, (ct.pk-1)*10) for ct in self.objs], objs)
 
+class TestNormalizedRatingFromPercentileIndex(DestructiveMultipleRatedObjectsTestCase, TestNormalizedRating):
+    def setUp(self):
+        super(TestNormalizedRatingFromPercentileIndex, self).setUp()
+        models.RATINGS_PERCENTILE_INDEX = True
+        percentiles.index.clear()
+        # the index is only loaded and updated with committed changes
+        transaction.commit()
+        self.ct_id = self.ratings[0].target_ct_id
+
+    def tearDown(self):
+        super(TestNormalizedRatingFromPercentileIndex, self).tearDown()
+        models.RATINGS_PERCENTILE_INDEX = False
+        percentiles.index.clear()
+
+    def test_index_gets_updated_on_rating(self):
+        top = len(self.objs)
+        worst = self.objs[0]
+        self.assert_equals(0, TotalRate.objects.get_normalized_rating(worst, top))
+        Rating.objects.create(target_ct_id=self.ct_id, target_id=worst.pk, amount=10000)
+        transaction.commit()
+        self.assert_equals(top - 1, TotalRate.objects.get_normalized_rating(worst, top))
+
+    def test_negative_ratings_are_ranked_separately(self):
+        bad, worst = self.objs[:2]
+        Rating.objects.create(target_ct_id=self.ct_id, target_id=bad.pk, amount=-10000)
+        Rating.objects.create(target_ct_id=self.ct_id, target_id=worst.pk, amount=-20000)
+        transaction.commit()
+        self.assert_equals(0, TotalRate.objects.get_normalized_rating(bad, 2))
+        self.assert_equals(-1, TotalRate.objects.get_normalized_rating(worst, 2))
+
+    def test_content_type_dropped_meanwhile_falls_back_to_queries(self):
+        # another thread clears the index right after it gets loaded
+        percentiles.index.load = lambda ct_id: None
+        try:
+            top = len(self.objs)
+            self.assert_equals(top - 1, TotalRate.objects.get_normalized_rating(self.objs[-1], top))
+        finally:
+            del percentiles.index.load
+
+    def test_index_is_updated_once_rating_commits(self):
+        top = len(self.objs)
+        self.assert_equals(0, TotalRate.objects.get_normalized_rating(self.objs[0], top))
+        Rating.objects.create(target_ct_id=self.ct_id, target_id=self.objs[0].pk, amount=10000)
+        self.assert_equals((top, top), percentiles.index.get_rank(self.ct_id, 10000))
+        transaction.commit()
+        self.assert_equals((top - 1, top), percentiles.index.get_rank(self.ct_id, 10000))
+
+    def test_rolled_back_rating_doesnt_get_into_index(self):
+        top = len(self.objs)
+        self.assert_equals(0, TotalRate.objects.get_normalized_rating(self.objs[0], top))
+        Rating.objects.create(target_ct_id=self.ct_id, target_id=self.objs[0].pk, amount=10000)
+        transaction.rollback()
+        self.assert_equals((top, top), percentiles.index.get_rank(self.ct_id, 10000))
+
+    def test_index_isnt_loaded_with_uncommitted_changes(self):
+        top = len(self.objs)
+        Rating.objects.create(target_ct_id=self.ct_id, target_id=self.objs[0].pk, amount=10000)
+        self.assert_equals(None, percentiles.index.get_rank(self.ct_id, 10000))
+        self.assert_equals(top - 1, TotalRate.objects.get_normalized_rating(self.objs[0], top))
+        transaction.rollback()
+        self.assert_equals(0, TotalRate.objects.get_normalized_rating(self.objs[0], top))
+
+class TestBulkLookup(MultipleRatedObjectsTestCase):
+    def test_get_for_objects_returns_ratings_of_all_objects(self):
+        ct_id = ContentType.objects.get_for_model(ContentType).pk
+        expected = dict(((ct_id, ct.pk), ct.pk*10) for ct in self.objs)
+        self.assert_equals(expected, TotalRate.objects.get_for_objects(self.objs))
+
+    def test_get_for_objects_returns_zero_for_unrated_objects(self):
+        rating_ct_id = ContentType.objects.get_for_model(Rating).pk
+        ratings = TotalRate.objects.get_for_objects(self.ratings[:1])
+        self.assert_equals({(rating_ct_id, self.ratings[0].pk): 0}, ratings)
+
+    def test_get_for_objects_on_empty_list(self):
+        self.assert_equals({}, TotalRate.objects.get_for_objects([]))
+
+    def test_prefetched_rating_is_used_by_get_for_object(self):
+        objs = TotalRate.objects.prefetch_for_objects(self.objs)
+        TotalRate.objects.all().delete()
+        self.assert_equals([ct.pk*10 for ct in self.objs], [TotalRate.objects.get_for_object(o) for o in objs])
+
+    def test_prefetch_stores_rating_under_given_attribute(self):
+        objs = TotalRate.objects.prefetch_for_objects(self.objs, 'total_rate')
+        self.assert_equals([ct.pk*10 for ct in self.objs], [o.total_rate for o in objs])
+
+class TestPrefetchedNormalizedRating(MultipleRatedObjectsTestCase):
+    def setUp(self):
+        super(TestPrefetchedNormalizedRating, self).setUp()
+        ct = self.ratings[0].target_ct
+        for obj in self.objs[:3]:
+            Rating.objects.create(target_ct=ct, target_id=obj.pk, amount=-1000 * obj.pk)
+
+    def test_prefetched_ranks_give_the_same_results(self):
+        top = len(self.objs)
+        expected = [TotalRate.objects.get_normalized_rating(o, top) for o in self.objs]
+        objs = TotalRate.objects.prefetch_for_objects(ContentType.objects.order_by('pk'))
+        TotalRate.objects.all().delete()
+        self.assert_equals(expected, [TotalRate.objects.get_normalized_rating(o, top) for o in objs])
+
+    def test_ranks_are_fetched_in_chunks(self):
+        ct_id = self.ratings[0].target_ct_id
+        amounts = TotalRate.objects.values_list('amount', flat=True)
+        self.assert_equals(TotalRate.objects.get_ranks(ct_id, amounts), TotalRate.objects.get_ranks(ct_id, amounts, chunk_size=2))
+
+    def test_normalized_tags_use_fixed_number_of_queries(self):
+        template = Template('''{% load ratings %}{% prefetch_ratings for objs %}{% for o in objs %}
+                {% rating for o max 10 step 1 as r %}{{ r }}
+                {% rating for o min 1 max 5 step 1 as r %}{{ r }}
+            {% endfor %}''')
+        objs = list(ContentType.objects.order_by('pk'))
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            connection.queries = []
+            template.render(Context({'objs': objs}))
+            # total rates and ranks of the only content type
+            self.assert_equals(2, len(connection.queries))
+        finally:
+            settings.DEBUG = debug
+
 class TestTopObjects(MultipleRatedObjectsTestCase):
     def test_only_return_count_objects(self):
         self.assert_equals(1, len(TotalRate.objects.get_top_objects(1)))
@@ -57,6 +269,31 @@ class TestTopObjects(MultipleRatedObjectsTestCase):
     def test_return_only_given_model_type_even_if_no_ratings(self):
         self.assert_equals(0, len(TotalRate.objects.get_top_objects(10, mods=[TotalRate])))
 
+    def test_return_objects_of_different_models_in_order(self):
+        Rating.objects.create(
+                target_ct=ContentType.objects.get_for_model(Rating),
+                target_id=self.ratings[0].pk,
+                amount=self.objs[-1].pk*10 + 1
+            )
+        expected = [self.ratings[0]] + list(ContentType.objects.order_by('-pk')[:2])
+        self.assert_equals(expected, TotalRate.objects.get_top_objects(3))
+
+    def test_skip_objects_that_dont_exist(self):
+        Rating.objects.create(
+                target_ct=ContentType.objects.get_for_model(Rating),
+                target_id=self.ratings[-1].pk + 1000,
+                amount=1
+            )
+        self.assert_equals([], TotalRate.objects.get_top_objects(10, mods=[Rating]))
+
+    def test_hints_are_applied_per_model(self):
+        hints = {ContentType: {'only': ('id', 'name')}}
+        # deferred instances are of a subclass and don't compare equal
+        self.assert_equals(
+                [(ct.pk, ct.name) for ct in ContentType.objects.order_by('-pk')[:3]],
+                [(ct.pk, ct.name) for ct in TotalRate.objects.get_top_objects(3, hints=hints)]
+            )
+
         
 class TestRating(SimpleRateTestCase):
     def test_default_rating_of_an_object(self):
@@ -65,5 +302,134 @@ class TestRating(SimpleRateTestCase):
     def test_rating_shows_in_get_for_model(self):
         Rating.objects.create(amount=10, **self.kw)
         self.assert_equals(10, Rating.objects.get_for_object(self.obj))
+
+    def test_duplicate_user_rating_is_ignored(self):
+        user = User.objects.create(username='some_username', password=UNUSABLE_PASSWORD)
+        Rating.objects.create(amount=10, user=user, **self.kw)
+        r = Rating(amount=5, user=user, **self.kw)
+        r.save()
+        self.assert_equals(None, r.pk)
+        self.assert_equals(1, Rating.objects.count())
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+
+    def test_duplicate_anonymous_rating_is_ignored(self):
+        now = datetime.now()
+        Rating.objects.create(amount=10, ip_address='127.0.0.1', time=now, **self.kw)
+        Rating.objects.create(amount=5, ip_address='127.0.0.1', time=now, **self.kw)
+        self.assert_equals(1, Rating.objects.count())
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+
+    def test_anonymous_ratings_from_different_addresses_are_saved(self):
+        Rating.objects.create(amount=10, ip_address='127.0.0.1', **self.kw)
+        Rating.objects.create(amount=5, ip_address='127.0.0.2', **self.kw)
+        self.assert_equals(2, Rating.objects.count())
+        self.assert_equals(15, TotalRate.objects.get_for_object(self.obj))
+
+    def test_anonymous_rating_is_saved_after_delay(self):
+        now = datetime.now()
+        Rating.objects.create(amount=10, ip_address='127.0.0.1', time=now - timedelta(seconds=2*MINIMAL_ANONYMOUS_IP_DELAY), **self.kw)
+        Rating.objects.create(amount=5, ip_address='127.0.0.1', time=now, **self.kw)
+        self.assert_equals(2, Rating.objects.count())
         
 
+
+class TestBulkRate(SimpleRateTestCase):
+    def setUp(self):
+        super(TestBulkRate, self).setUp()
+        self.user = User.objects.create(username='some_username', password=UNUSABLE_PASSWORD)
+
+    def test_statuses_follow_order_of_ratings(self):
+        Rating.objects.create(amount=10, user=self.user, **self.kw)
+        statuses = Rating.objects.bulk_rate([
+                Rating(amount=5, ip_address='127.0.0.1', **self.kw),
+                Rating(amount=5, user=self.user, **self.kw),
+                Rating(amount=1, ip_address='127.0.0.2', **self.kw),
+            ])
+        self.assert_equals([RATING_ACCEPTED, RATING_DUPLICATE, RATING_ACCEPTED], statuses)
+        self.assert_equals(3, Rating.objects.count())
+        self.assert_equals(16, TotalRate.objects.get_for_object(self.obj))
+
+    def test_duplicates_within_ratings_are_detected(self):
+        now = datetime.now()
+        statuses = Rating.objects.bulk_rate([
+                Rating(amount=5, ip_address='127.0.0.1', time=now, **self.kw),
+                Rating(amount=5, ip_address='127.0.0.1', time=now, **self.kw),
+                Rating(amount=5, user=self.user, **self.kw),
+                Rating(amount=5, user=self.user, **self.kw),
+            ], chunk_size=3)
+        self.assert_equals([RATING_ACCEPTED, RATING_DUPLICATE, RATING_ACCEPTED, RATING_DUPLICATE], statuses)
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+
+
+class TestRatingWithVotedIndex(SimpleRateTestCase):
+    def setUp(self):
+        super(TestRatingWithVotedIndex, self).setUp()
+        models.RATINGS_VOTED_INDEX = True
+        self.orig_voted = caching.voted
+        caching.voted = caching.VotedIndex(get_cache('locmem://'))
+        self.user = User.objects.create(username='some_username', password=UNUSABLE_PASSWORD)
+
+    def tearDown(self):
+        super(TestRatingWithVotedIndex, self).tearDown()
+        models.RATINGS_VOTED_INDEX = False
+        caching.voted = self.orig_voted
+
+    def test_saved_rating_is_remembered(self):
+        Rating.objects.create(amount=10, user=self.user, **self.kw)
+        self.assert_true(caching.voted.contains('user:%s' % self.user.pk, self.kw['target_ct'].pk, self.obj.pk))
+
+    def test_remembered_rating_is_rejected_without_database(self):
+        caching.voted.add('user:%s' % self.user.pk, self.kw['target_ct'].pk, self.obj.pk)
+        r = Rating(amount=10, user=self.user, **self.kw)
+        r.save()
+        self.assert_equals(None, r.pk)
+        self.assert_equals(0, Rating.objects.count())
+
+    def test_anonymous_rating_is_remembered_within_bucket(self):
+        now = datetime.now()
+        Rating.objects.create(amount=10, ip_address='127.0.0.1', time=now, **self.kw)
+        voter = models.get_voter(None, '127.0.0.1', now)[0]
+        self.assert_true(caching.voted.contains(voter, self.kw['target_ct'].pk, self.obj.pk))
+        later = now + timedelta(seconds=2*MINIMAL_ANONYMOUS_IP_DELAY)
+        Rating.objects.create(amount=5, ip_address='127.0.0.1', time=later, **self.kw)
+        self.assert_equals(2, Rating.objects.count())
+
+
+class TestShardedTotalRate(SimpleRateTestCase):
+    def setUp(self):
+        super(TestShardedTotalRate, self).setUp()
+        models.RATINGS_TOTALRATE_SHARDS = {'contenttypes.contenttype': 4}
+        models._shard_counts = None
+
+    def tearDown(self):
+        super(TestShardedTotalRate, self).tearDown()
+        models.RATINGS_TOTALRATE_SHARDS = {}
+        models._shard_counts = None
+
+    def test_ratings_go_to_shards(self):
+        for i in range(10):
+            Rating.objects.create(amount=1, **self.kw)
+        self.assert_equals(0, TotalRate.objects.count())
+        self.assert_true(0 < TotalRateShard.objects.count() <= 4)
+
+    def test_reads_sum_the_shards(self):
+        for i in range(10):
+            Rating.objects.create(amount=1, **self.kw)
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+        self.assert_equals({(self.kw['target_ct'].pk, self.obj.pk): 10}, TotalRate.objects.get_for_objects([self.obj]))
+
+    def test_fold_moves_shards_to_total_rate(self):
+        for i in range(10):
+            Rating.objects.create(amount=1, **self.kw)
+        self.assert_equals(1, TotalRateShard.objects.fold())
+        self.assert_equals(10, TotalRate.objects.get(**self.kw).amount)
+        self.assert_equals(10, TotalRate.objects.get_for_object(self.obj))
+
+    def test_ratings_since_fold_are_not_counted_twice(self):
+        Rating.objects.create(amount=1, **self.kw)
+        TotalRateShard.objects.fold()
+        Rating.objects.create(amount=2, **self.kw)
+        Rating.objects.move_rate_to_agg(datetime.now(), 'day')
+        TotalRate.objects.all().delete()
+        Agg.objects.agg_to_totalrate()
+        self.assert_equals(3, TotalRate.objects.get_for_object(self.obj))